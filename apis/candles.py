@@ -0,0 +1,172 @@
+import os
+import json
+import threading
+import numpy as np
+
+from metrics import metrics
+
+# Minutes per candle of each resolution kept, finest first
+RESOLUTIONS = {'1m': 1, '1h': 60, '1d': 1440}
+
+
+def merge_candles(times, closes):
+    """
+    Return times and closes sorted by time, keeping the last close given for each time
+    """
+
+    order = np.argsort(times, kind='stable')
+    times, closes = times[order], closes[order]
+
+    last = np.append(times[1:] != times[:-1], True)
+
+    return times[last], closes[last]
+
+
+class CandleStore:
+    """
+    Candle closes by provider, symbol and resolution (1m, 1h or 1d), kept in monthly chunks under
+    data/candles/<provider>/<symbol>/<resolution>/<YYYY-MM>.npz as the candle open times (minutes since the epoch),
+    sorted, and their closes.
+
+    coverage.json beside each resolution's chunks lists the time ranges that have been fetched or imported, merged
+    together, so a range without candles (before a market was listed, a quiet hour on a thin market) is told apart
+    from one never asked for. Chunks are read once and kept for the run.
+    """
+
+    path = 'data/candles/'
+
+    def __init__(self, path=None):
+        self.path = path or CandleStore.path
+        self.chunks = {}
+        self.coverages = {}
+        self.lock = threading.RLock()
+
+    def directory(self, provider, symbol, resolution):
+        return os.path.join(self.path, provider, symbol, resolution)
+
+    def coverage(self, provider, symbol, resolution):
+        """
+        Return the covered ranges as arrays of starts and ends (minutes since the epoch), sorted and not
+        overlapping
+        """
+
+        key = (provider, symbol, resolution)
+        with self.lock:
+            if key not in self.coverages:
+                path = os.path.join(self.directory(*key), 'coverage.json')
+
+                ranges = []
+                if os.path.isfile(path):
+                    with open(path) as j:
+                        ranges = json.load(j)
+                    metrics.file_read(path)
+
+                self.coverages[key] = (np.array([i[0] for i in ranges], dtype=np.int64),
+                                       np.array([i[1] for i in ranges], dtype=np.int64))
+
+            return self.coverages[key]
+
+    def covered(self, provider, symbol, resolution, starts, ends):
+        """
+        Return a boolean array of whether each range from starts to ends (datetime64[m]) is covered
+        """
+
+        covered_starts, covered_ends = self.coverage(provider, symbol, resolution)
+        starts = np.asarray(starts, dtype='datetime64[m]').astype(np.int64)
+        ends = np.asarray(ends, dtype='datetime64[m]').astype(np.int64)
+
+        # The covered range starting last at or before each start
+        idx = np.searchsorted(covered_starts, starts, side='right') - 1
+        found = idx >= 0
+        found[found] = covered_ends[idx[found]] >= ends[found]
+
+        return found
+
+    def add(self, provider, symbol, resolution, start, end, times, closes):
+        """
+        Add candles (times datetime64[m]) fetched or imported for the range from start to end, merging them into
+        the chunks of the months they fall in
+        """
+
+        key = (provider, symbol, resolution)
+        directory = self.directory(*key)
+        times = np.asarray(times, dtype='datetime64[m]').astype(np.int64)
+        closes = np.asarray(closes, dtype=np.float64)
+        months = times.astype('datetime64[m]').astype('datetime64[M]')
+
+        with self.lock:
+            os.makedirs(directory, exist_ok=True)
+
+            for month in np.unique(months):
+                rows = months == month
+                saved_times, saved_closes = self.chunk(provider, symbol, resolution, str(month))
+                merged = merge_candles(np.concatenate([saved_times, times[rows]]),
+                                       np.concatenate([saved_closes, closes[rows]]))
+
+                path = os.path.join(directory, f'{month}.npz')
+                with open(path + '.tmp', 'wb') as f:
+                    np.savez(f, time=merged[0], close=merged[1])
+                os.replace(path + '.tmp', path)
+                metrics.file_written(path)
+
+                self.chunks[key + (str(month),)] = merged
+
+            self.add_coverage(key, np.datetime64(start, 'm').astype(np.int64), np.datetime64(end, 'm').astype(np.int64))
+
+    def add_coverage(self, key, start, end):
+        starts, ends = self.coverage(*key)
+        starts, ends = np.append(starts, start), np.append(ends, end)
+
+        # Merge overlapping and touching ranges
+        order = np.argsort(starts)
+        merged = []
+        for s, e in zip(starts[order], ends[order]):
+            if merged and s <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], int(e))
+            else:
+                merged.append([int(s), int(e)])
+
+        self.coverages[key] = (np.array([i[0] for i in merged], dtype=np.int64),
+                               np.array([i[1] for i in merged], dtype=np.int64))
+
+        path = os.path.join(self.directory(*key), 'coverage.json')
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(merged, f)
+        os.replace(path + '.tmp', path)
+        metrics.file_written(path)
+
+    def chunk(self, provider, symbol, resolution, month):
+        key = (provider, symbol, resolution, month)
+        with self.lock:
+            if key not in self.chunks:
+                path = os.path.join(self.directory(provider, symbol, resolution), f'{month}.npz')
+
+                if os.path.isfile(path):
+                    with np.load(path) as npz:
+                        self.chunks[key] = npz['time'], npz['close']
+                    metrics.file_read(path)
+                else:
+                    self.chunks[key] = np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+
+            return self.chunks[key]
+
+    def series(self, provider, symbol, resolution, start, end):
+        """
+        Return the candle times (datetime64[m]) and closes from start up to end
+        """
+
+        start = np.datetime64(start, 'm')
+        end = np.datetime64(end, 'm')
+        months = np.arange(start.astype('datetime64[M]'), end.astype('datetime64[M]') + 1)
+
+        chunks = [self.chunk(provider, symbol, resolution, str(i)) for i in months]
+        times = np.concatenate([i[0] for i in chunks])
+        closes = np.concatenate([i[1] for i in chunks])
+
+        rows = (times >= start.astype(np.int64)) & (times < end.astype(np.int64))
+
+        return times[rows].astype('datetime64[m]'), closes[rows]
+
+
+# Shared by every price lookup and import so chunks are only read once per run
+candle_store = CandleStore()
@@ -0,0 +1,213 @@
+import gzip
+import json
+import time
+import base64
+import threading
+import requests
+from collections import defaultdict, deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+# Query parameters that change on every call or carry credentials, these are left out of recordings and matching
+VOLATILE_PARAMS = ['timestamp', 'signature', 'recvWindow', 'access_key', 'apikey']
+
+# Headers that describe the original transfer rather than the content, these are recalculated on replay
+TRANSFER_HEADERS = ['content-encoding', 'content-length', 'transfer-encoding', 'connection']
+
+
+def request_key(method, url):
+    """
+    Key used to match a live request with its recording, e.g. 'GET api.binance.com/api/v3/klines?symbol=ETHBTC'
+    """
+
+    parts = urlsplit(url)
+    params = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in VOLATILE_PARAMS)
+
+    return f'{method} {parts.netloc}{parts.path}?{urlencode(params)}'
+
+
+class CassetteRecorder:
+    """
+    Context manager that records every HTTP exchange made through requests to a gzip JSON lines file.
+
+    with CassetteRecorder('cassettes/full_run.jsonl.gz'):
+        GetAllTransactions().get_all_transactions()
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = []
+        self.lock = threading.Lock()
+        self.original_send = None
+
+    def __enter__(self):
+        self.original_send = requests.Session.send
+        recorder = self
+
+        def send(session, request, **kwargs):
+            response = recorder.original_send(session, request, **kwargs)
+            recorder.record(request, response)
+            return response
+
+        requests.Session.send = send
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        requests.Session.send = self.original_send
+        self.save()
+
+    def record(self, request, response):
+        entry = {
+            'key': request_key(request.method, request.url),
+            'status': response.status_code,
+            'headers': {k: v for k, v in response.headers.items() if k.lower() not in TRANSFER_HEADERS},
+            'body': base64.b64encode(response.content).decode('ascii')
+        }
+
+        with self.lock:
+            self.entries.append(entry)
+
+    def save(self):
+        with gzip.open(self.path, 'wt', encoding='utf-8') as f:
+            for entry in self.entries:
+                f.write(json.dumps(entry) + '\n')
+
+
+class CassetteServer:
+    """
+    Local HTTP server that replays a recorded cassette.
+
+    Requests are expected as http://127.0.0.1:<port>/<original host>/<original path>. Repeated identical requests
+    are answered with their recordings in order, the last one being repeated once they run out. latency adds a delay
+    to every response and rate_limit (requests per second per host) answers excess requests with a 429, the same
+    way the exchanges do. Requests that were never recorded get a 404 with an empty JSON list.
+    """
+
+    def __init__(self, path, latency=0.0, rate_limit=None, port=0):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.port = port
+        self.recordings = defaultdict(list)
+        self.served = defaultdict(int)
+        self.recent = defaultdict(deque)
+        self.misses = []
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                entry = json.loads(line)
+                self.recordings[entry['key']].append(entry)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def start(self):
+        cassette = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                cassette.handle(self)
+
+            def do_POST(self):
+                cassette.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def rate_limited(self, host):
+        if not self.rate_limit:
+            return False
+
+        now = time.monotonic()
+        with self.lock:
+            recent = self.recent[host]
+            while recent and now - recent[0] > 1:
+                recent.popleft()
+
+            if len(recent) >= self.rate_limit:
+                return True
+
+            recent.append(now)
+
+        return False
+
+    def handle(self, handler):
+        if self.latency:
+            time.sleep(self.latency)
+
+        host, _, path = handler.path.lstrip('/').partition('/')
+
+        if self.rate_limited(host):
+            body = json.dumps({'code': -1003, 'message': 'Too many requests'}).encode()
+            self.respond(handler, 429, {'Content-Type': 'application/json', 'Retry-After': '1'}, body)
+            return
+
+        key = request_key(handler.command, f'https://{host}/{path}')
+
+        with self.lock:
+            recordings = self.recordings.get(key)
+            if recordings:
+                entry = recordings[min(self.served[key], len(recordings) - 1)]
+                self.served[key] += 1
+            else:
+                entry = None
+                self.misses.append(key)
+
+        if entry is None:
+            self.respond(handler, 404, {'Content-Type': 'application/json'}, b'[]')
+        else:
+            self.respond(handler, entry['status'], entry['headers'], base64.b64decode(entry['body']))
+
+    @staticmethod
+    def respond(handler, status, headers, body):
+        handler.send_response(status)
+        for k, v in headers.items():
+            handler.send_header(k, v)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+class CassetteReplay:
+    """
+    Context manager that starts a CassetteServer and sends every requests call to it instead of the network.
+
+    with CassetteReplay('cassettes/full_run.jsonl.gz', latency=0.05, rate_limit=10):
+        GetAllTransactions().get_all_transactions()
+    """
+
+    def __init__(self, path, latency=0.0, rate_limit=None):
+        self.server = CassetteServer(path, latency=latency, rate_limit=rate_limit)
+        self.original_send = None
+
+    def __enter__(self):
+        self.server.start()
+        self.original_send = requests.Session.send
+        replay = self
+
+        def send(session, request, **kwargs):
+            parts = urlsplit(request.url)
+            request.url = f"{replay.server.url}/{parts.netloc}{parts.path}{'?' + parts.query if parts.query else ''}"
+            return replay.original_send(session, request, **kwargs)
+
+        requests.Session.send = send
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        requests.Session.send = self.original_send
+        self.server.stop()
@@ -7,7 +7,9 @@ from datetime import timedelta
 from datetime import datetime as dt
 
 from apis.authentication import BinanceAuth
-from apis.helpers import Transaction, BinanceConvertToGBP
+from apis.helpers import Transaction, convert_columns_to_gbp, normalize_records
+from apis.rate_cache import rate_cache
+from metrics import metrics
 
 
 class Binance:
@@ -78,7 +80,7 @@ class Binance:
             binance_pairs = json.load(j)
 
         count = 0
-        df_trades_list = []
+        trade_records = []
         for symbol in symbols:
             if binance_pairs.get(symbol['symbol']):
                 trades = self.get_symbol_trades(symbol['symbol'], start=most_recent_transaction)
@@ -88,13 +90,14 @@ class Binance:
                     print(f'{count}/{len(symbols)} checked.')
                     print(f"{symbol['symbol']}: {len(trades)} trades")
                     for trade in trades:
-                        df_trades_list.append(Binance.create_trades_dataframes(symbol, trade))
+                        trade_records.append((symbol, trade))
                 # else:
                 #     df_trades = pd.DataFrame(Transaction().transaction, index=[0]).dropna()
             count += 1
 
-        if len(df_trades_list) > 0:
-            df_trades = pd.concat(df_trades_list)
+        if len(trade_records) > 0:
+            # Normalised once every symbol is fetched, across processes when there are many trades
+            df_trades = normalize_records(Binance.create_trades_dataframes, trade_records)
             # df_trades = pd.read_csv(r"C:\Users\alasd\Documents\Projects Misc\binance.csv")
 
             # df_final = pd.concat([df_deposits, df_withdrawals, df_trades, df_dust_transactions, df_dividend_transactions])
@@ -105,106 +108,21 @@ class Binance:
 
             # df_final = pd.read_csv(r"C:\Users\alasd\Documents\Projects Misc\binance_temp.csv")
 
-            # Check whether cached_rates_gbp.json exists
-            if not os.path.isfile('data/cached_gbp_rates.json'):
-                with open('data/cached_gbp_rates.json', 'w') as f:
-                    json.dump({}, f)
-
-            # Read cached crypto/gbp rates
-            with open('data/cached_gbp_rates.json') as j:
-                cached_rates = json.load(j)
-
             # GBP conversions
-            # Loop through and get GBP values where missing
-            final_asset_gbp = []
-            fee_gbp = []
-            count_api = 0
-            count_cache = 0
-            for row in df_final.itertuples():
-                # Calculate GBP value for all disposals
-                if row.action in ['exchange_fiat_for_crypto', 'exchange_crypto_for_fiat', 'exchange_crypto_for_crypto']:
-                    if row.final_asset_currency == 'GBP':
-                        final_asset_gbp.append(row.final_asset_quantity)
-                    else:
-                        asset = row.final_asset_currency
-                        datetime = dt.strptime(str(row.datetime), '%Y-%m-%d %H:%M:%S').strftime('%Y-%m-%d %H:%M:00')
-                        quantity = row.final_asset_quantity
-
-                        # Check whether we have already cached the GBP rate for the asset and datetime in question
-                        if asset in cached_rates.keys():
-                            if not cached_rates[asset].get(datetime):
-                                # Convert to GBP
-                                c = BinanceConvertToGBP(asset, datetime, quantity)
-                                quantity_gbp = c.convert_to_gbp()
-                                final_asset_gbp.append(quantity_gbp)
-                                # Calculate the asset GBP rate at this datetime and cache
-                                rate_gbp = quantity_gbp / float(quantity)
-                                cached_rates[asset][datetime] = rate_gbp
-                                count_api += 1
-                            else:
-                                rate_gbp = cached_rates[asset].get(datetime)
-                                quantity_gbp = rate_gbp * float(quantity)
-                                final_asset_gbp.append(quantity_gbp)
-                                count_cache += 1
-                        else:
-                            c = BinanceConvertToGBP(asset, datetime, quantity)
-                            quantity_gbp = c.convert_to_gbp()
-                            final_asset_gbp.append(quantity_gbp)
-                            rate_gbp = quantity_gbp / float(quantity)
-                            cached_rates[asset] = {}
-                            cached_rates[asset][datetime] = rate_gbp
-                            count_api += 1
-                else:
-                    final_asset_gbp.append(None)
-
-                # Calculate all fees in GBP
-                if not pd.isna(row.fee_currency):
-                    if any([row.fee_currency == 'GBP', row.fee_quantity == 0.0]):
-                        fee_gbp.append(row.fee_quantity)
-                    else:
-                        asset = row.fee_currency
-                        datetime = dt.strptime(str(row.datetime), '%Y-%m-%d %H:%M:%S').strftime('%Y-%m-%d %H:%M:00')
-                        quantity = row.fee_quantity
-
-                        # Check whether we have already cached the GBP rate for the asset and datetime in question
-                        if asset in cached_rates.keys():
-                            if not cached_rates[asset].get(datetime):
-                                # Convert to GBP
-                                c = BinanceConvertToGBP(asset, datetime, quantity)
-                                quantity_gbp = c.convert_to_gbp()
-                                fee_gbp.append(quantity_gbp)
-                                # Calculate the asset GBP rate at this datetime and cache
-                                rate_gbp = quantity_gbp / float(quantity)
-                                cached_rates[asset][datetime] = rate_gbp
-                                count_api += 1
-                            else:
-                                rate_gbp = cached_rates[asset].get(datetime)
-                                quantity_gbp = rate_gbp * float(row.fee_quantity)
-                                fee_gbp.append(quantity_gbp)
-                                count_cache += 1
-                        else:
-                            c = BinanceConvertToGBP(asset, datetime, quantity)
-                            quantity_gbp = c.convert_to_gbp()
-                            fee_gbp.append(quantity_gbp)
-                            rate_gbp = quantity_gbp / float(quantity)
-                            cached_rates[asset] = {}
-                            cached_rates[asset][datetime] = rate_gbp
-                            count_api += 1
-                else:
-                    fee_gbp.append(None)
-
-                print(f'{count_api} : API')
-                print(f'{count_cache}   : Cache')
+            # Convert every rate missing from the cache in one batch over the Binance markets
+            final_asset_gbp, fee_gbp, price_resolution, count_api, count_cache = convert_columns_to_gbp(
+                df_final, rate_cache, ['binance'])
 
             print(f'Count API:\t {count_api}')
             print(f'Count cache:\t {count_cache}')
+            metrics.cache('gbp_rates', hits=count_cache, misses=count_api)
 
-            # Save cached_rates back to json file for quicker conversions on next run
-            with open('data/cached_gbp_rates.json', 'w', encoding='utf-8') as f:
-                json.dump(cached_rates, f, ensure_ascii=False, indent=4)
+            # Write the rates still queued for quicker conversions on next run
+            rate_cache.flush()
 
             df_final['final_asset_gbp'] = final_asset_gbp
             df_final['fee_gbp'] = fee_gbp
+            df_final['price_resolution'] = price_resolution
         else:
             df_final = pd.DataFrame(Transaction().transaction, index=[0]).dropna()
 
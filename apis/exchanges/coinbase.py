@@ -1,12 +1,93 @@
 import os
-import json
-import re
 import requests
+import numpy as np
 import pandas as pd
+from collections import namedtuple
 from datetime import datetime as dt
 
 from apis.authentication import CoinbaseAuth
-from apis.helpers import Transaction, CoinbaseConvertToGBP
+from apis.helpers import Transaction, convert_columns_to_gbp
+from apis.rate_cache import rate_cache
+from metrics import metrics
+
+# Fields of the raw transactions the mapping uses, once flattened by pd.json_normalize
+FLATTENED_FIELDS = ['id', 'type', 'status', 'created_at', 'amount.amount', 'native_amount.amount', 'details.title',
+                    'details.subtitle', 'trade.id', 'from.id', 'to.address', 'application.id', 'transaction_fee.amount',
+                    'transaction_fee.currency', 'network.transaction_fee.amount', 'network.transaction_fee.currency']
+
+# A Transaction column taken from a flattened (or derived, see Coinbase.flatten_transactions) field, other values in
+# the mapping are used as they are
+Field = namedtuple('Field', 'name')
+
+ASSET = Field('asset')
+QUANTITY = Field('quantity')
+GBP = Field('gbp')
+
+# Columns every transaction has, rules below may replace them
+COMMON_COLUMNS = {
+    'asset': ASSET,
+    'type': Field('type'),
+    'datetime': Field('datetime'),
+    'source_transaction_id': Field('id')
+}
+
+# (transaction type, condition on the flattened transactions or None, Transaction columns). Rules are tried in order
+# and a transaction takes the columns of the first its type and condition match, columns not given are left empty.
+# A new type of transaction is added here as another rule.
+TRANSACTION_MAP = [
+    # Crypto to crypto conversions, each side is its own transaction paired by the trade id
+    ('trade', lambda f: f['details.title'].str.startswith('Converted from '),
+     {'action': 'exchange_crypto_for_crypto', 'disposal': True, 'initial_asset_quantity': QUANTITY,
+      'initial_asset_currency': ASSET, 'initial_asset_location': 'Coinbase', 'final_asset_location': 'Coinbase',
+      'fee_type': 'exchange', 'source_trade_id': Field('trade.id')}),
+    ('trade', None,
+     {'action': 'exchange_crypto_for_crypto', 'disposal': True, 'initial_asset_location': 'Coinbase',
+      'final_asset_quantity': QUANTITY, 'final_asset_currency': ASSET, 'final_asset_gbp': GBP,
+      'final_asset_location': 'Coinbase', 'fee_type': 'exchange', 'source_trade_id': Field('trade.id')}),
+
+    ('send', lambda f: f['details.subtitle'] == 'From Coinbase Earn',
+     {'action': 'gifted_crypto', 'disposal': False, 'final_asset_quantity': QUANTITY, 'final_asset_currency': ASSET,
+      'final_asset_gbp': GBP, 'final_asset_location': 'Coinbase', 'source_trade_id': Field('from.id')}),
+    ('send', lambda f: f['details.title'].str.startswith('Sent '),
+     {'action': 'withdraw_crypto', 'disposal': False, 'initial_asset_quantity': QUANTITY,
+      'initial_asset_currency': ASSET, 'initial_asset_location': 'Coinbase', 'final_asset_address': Field('to.address'),
+      'fee_type': 'transfer', 'fee_quantity': Field('send_fee_quantity'), 'fee_currency': Field('send_fee_currency'),
+      'source_trade_id': Field('application.id')}),
+    ('send', lambda f: f['details.title'].str.startswith('Received '),
+     {'action': 'deposit_crypto', 'disposal': False, 'final_asset_quantity': QUANTITY, 'final_asset_currency': ASSET,
+      'final_asset_gbp': GBP, 'final_asset_location': 'Coinbase'}),
+    # Sends not recognised above are kept without an action and reported
+    ('send', None, {'disposal': False}),
+
+    ('exchange_deposit', None,
+     {'action': Field('deposit_action'), 'disposal': False, 'initial_asset_quantity': QUANTITY,
+      'initial_asset_currency': ASSET, 'initial_asset_location': 'Coinbase', 'final_asset_quantity': QUANTITY,
+      'final_asset_currency': ASSET, 'final_asset_gbp': GBP, 'final_asset_location': 'Coinbase Pro',
+      'fee_type': 'exchange', 'source_transaction_id': Field('application_transaction_id'),
+      'source_trade_id': Field('application.id')}),
+    ('exchange_withdrawal', None,
+     {'action': Field('withdraw_action'), 'disposal': False, 'initial_asset_quantity': QUANTITY,
+      'initial_asset_currency': ASSET, 'initial_asset_location': Field('withdrawal_location'),
+      'final_asset_quantity': QUANTITY, 'final_asset_currency': ASSET, 'fee_type': 'transfer'}),
+    # Moves to Coinbase Pro are withdrawals from Coinbase, Coinbase Pro records the deposit
+    ('pro_deposit', None,
+     {'action': Field('withdraw_action'), 'disposal': False, 'initial_asset_quantity': QUANTITY,
+      'initial_asset_currency': ASSET, 'initial_asset_location': 'Coinbase', 'final_asset_quantity': QUANTITY,
+      'final_asset_currency': ASSET, 'final_asset_gbp': GBP, 'final_asset_location': 'Coinbase Pro',
+      'fee_type': 'exchange', 'source_trade_id': Field('application.id')}),
+    ('pro_withdrawal', None,
+     {'action': Field('withdraw_action'), 'disposal': False, 'initial_asset_quantity': QUANTITY,
+      'initial_asset_currency': ASSET, 'initial_asset_location': 'Coinbase Pro', 'final_asset_quantity': QUANTITY,
+      'final_asset_currency': ASSET, 'fee_type': 'transfer', 'source_trade_id': Field('application.id')}),
+
+    ('fiat_deposit', None,
+     {'action': 'deposit_fiat', 'disposal': False, 'final_asset_quantity': QUANTITY, 'final_asset_currency': ASSET,
+      'final_asset_gbp': GBP, 'final_asset_location': 'Coinbase', 'fee_type': 'transfer'}),
+    ('fiat_withdrawal', None,
+     {'action': 'withdraw_fiat', 'disposal': False, 'initial_asset_quantity': QUANTITY,
+      'initial_asset_currency': ASSET, 'initial_asset_location': 'Coinbase', 'final_asset_quantity': QUANTITY,
+      'final_asset_currency': ASSET, 'final_asset_gbp': GBP, 'fee_type': 'transfer'})
+]
 
 
 class Coinbase:
@@ -149,107 +230,21 @@ class Coinbase:
         # Sort by datetime again
         df_final.sort_values(by='datetime', inplace=True)
 
-        # Check whether cached_rates_gbp.json exists
-        if not os.path.isfile('data/cached_gbp_rates.json'):
-            with open('data/cached_gbp_rates.json', 'w') as f:
-                json.dump({}, f)
-
-        # Read cached crypto/gbp rates
-        with open('data/cached_gbp_rates.json') as j:
-            cached_rates = json.load(j)
-
-        # Loop through and get GBP values where missing
-        final_asset_gbp = []
-        fee_gbp = []
-        count_api = 0
-        count_cache = 0
-        for row in df_final.itertuples():
-            # Calculate GBP value for all disposals
-            if row.action in ['exchange_fiat_for_crypto', 'exchange_crypto_for_fiat', 'exchange_crypto_for_crypto']:
-                if pd.isna(row.final_asset_gbp):
-                    if not pd.isna(row.final_asset_gbp):
-                        final_asset_gbp.append(None)
-                    elif row.final_asset_currency == 'GBP':
-                        final_asset_gbp.append(row.final_asset_quantity)
-                    else:
-                        asset = row.final_asset_currency
-                        datetime = row.datetime.strftime('%Y-%m-%d %H:%M:00')
-                        quantity = row.final_asset_quantity
-
-                        # Check whether we have already cached the GBP rate for the asset and datetime in question
-                        if asset in cached_rates.keys():
-                            if not cached_rates[asset].get(datetime):
-                                c = CoinbaseConvertToGBP(asset, datetime, quantity)
-                                gbp_value = c.convert_to_gbp()
-                                final_asset_gbp.append(gbp_value)
-                                if float(quantity):
-                                    rate_gbp = gbp_value / float(quantity)
-                                    cached_rates[asset][datetime] = rate_gbp
-                                count_api += 1
-                            else:
-                                rate_gbp = cached_rates[asset].get(datetime)
-                                quantity_gbp = rate_gbp * float(quantity)
-                                final_asset_gbp.append(quantity_gbp)
-                                count_cache += 1
-                        else:
-                            c = CoinbaseConvertToGBP(asset, datetime, quantity)
-                            gbp_value = c.convert_to_gbp()
-                            final_asset_gbp.append(gbp_value)
-                            if float(quantity):
-                                rate_gbp = gbp_value / float(quantity)
-                                cached_rates[asset] = {}
-                                cached_rates[asset][datetime] = rate_gbp
-                            count_api += 1
-                else:
-                    final_asset_gbp.append(row.final_asset_gbp)
-            else:
-                final_asset_gbp.append(row.final_asset_gbp)
-
-            # Calculate all fees in GBP
-            if not pd.isna(row.fee_currency):
-                if any([row.fee_currency == 'GBP', row.fee_quantity == 0.0]):
-                    fee_gbp.append(row.fee_quantity)
-                else:
-                    asset = row.fee_currency
-                    datetime = row.datetime.strftime('%Y-%m-%d %H:%M:00')
-                    quantity = row.fee_quantity
-
-                    # Check whether we have already cached the GBP rate for the asset and datetime in question
-                    if asset in cached_rates.keys():
-                        if not cached_rates[asset].get(datetime):
-                            c = CoinbaseConvertToGBP(asset, datetime, quantity)
-                            gbp_value = c.convert_to_gbp()
-                            fee_gbp.append(gbp_value)
-                            if float(quantity):
-                                rate_gbp = gbp_value / float(quantity)
-                                cached_rates[asset][datetime] = rate_gbp
-                            count_api += 1
-                        else:
-                            rate_gbp = cached_rates[asset].get(datetime)
-                            quantity_gbp = rate_gbp * float(quantity)
-                            fee_gbp.append(quantity_gbp)
-                            count_cache += 1
-                    else:
-                        c = CoinbaseConvertToGBP(asset, datetime, quantity)
-                        quantity_gbp = c.convert_to_gbp()
-                        fee_gbp.append(quantity_gbp)
-                        if float(quantity):
-                            rate_gbp = quantity_gbp / float(quantity)
-                            cached_rates[asset] = {}
-                            cached_rates[asset][datetime] = rate_gbp
-                        count_api += 1
-            else:
-                fee_gbp.append(None)
+        # GBP conversions
+        # Convert every rate missing from the cache in one batch over the Coinbase Pro markets, keeping GBP values given
+        final_asset_gbp, fee_gbp, price_resolution, count_api, count_cache = convert_columns_to_gbp(
+            df_final, rate_cache, ['coinbase_pro'])
 
         print(f'Count API:\t {count_api}')
         print(f'Count cache:\t {count_cache}')
+        metrics.cache('gbp_rates', hits=count_cache, misses=count_api)
 
-        # Save cached_rates back to json file for quicker conversions on next run
-        with open('data/cached_gbp_rates.json', 'w', encoding='utf-8') as f:
-            json.dump(cached_rates, f, ensure_ascii=False, indent=4)
+        # Write the rates still queued for quicker conversions on next run
+        rate_cache.flush()
 
         df_final['final_asset_gbp'] = final_asset_gbp
         df_final['fee_gbp'] = fee_gbp
+        df_final['price_resolution'] = price_resolution
 
         return df_final
 
@@ -444,392 +439,75 @@ class Coinbase:
         return sells
 
     @staticmethod
-    def handle_trade_transaction(asset, transaction):
-        tx = Transaction()
+    def flatten_transactions(transaction_history):
+        """
+        Return the raw transactions of every asset flattened into one dataframe of FLATTENED_FIELDS, with the asset
+        and the columns derived from them that TRANSACTION_MAP refers to
+        """
 
-        re_converted_from = re.compile(r'^Converted from ')
+        transactions = [i for v in transaction_history.values() for i in v]
+        f = pd.json_normalize(transactions).reindex(columns=FLATTENED_FIELDS)
+        f['asset'] = [k for k, v in transaction_history.items() for _ in v]
 
-        if re_converted_from.search(transaction['details']['title']):
-            tx.transaction['initial_asset_quantity'] = abs(float(transaction['amount']['amount']))
-            tx.transaction['initial_asset_currency'] = asset
-            tx.transaction['final_asset_quantity'] = None
-            tx.transaction['final_asset_currency'] = None
-            tx.transaction['final_asset_gbp'] = None
-        else:
-            tx.transaction['initial_asset_quantity'] = None
-            tx.transaction['initial_asset_currency'] = None
-            tx.transaction['final_asset_quantity'] = abs(float(transaction['amount']['amount']))
-            tx.transaction['final_asset_currency'] = asset
-            tx.transaction['final_asset_gbp'] = abs(float(transaction['native_amount']['amount']))
-
-        tx.transaction['asset'] = asset
-        tx.transaction['type'] = transaction['type']
-        tx.transaction['action'] = 'exchange_crypto_for_crypto'
-        tx.transaction['disposal'] = True
-        tx.transaction['datetime'] = dt.strptime(transaction['created_at'], '%Y-%m-%dT%H:%M:%SZ')
-        tx.transaction['initial_asset_location'] = 'Coinbase'
-        tx.transaction['initial_asset_address'] = None
-        tx.transaction['price'] = None
-        tx.transaction['final_asset_location'] = 'Coinbase'
-        tx.transaction['final_asset_address'] = None
-        tx.transaction['fee_type'] = 'exchange'
-        tx.transaction['fee_quantity'] = None
-        tx.transaction['fee_currency'] = None
-        tx.transaction['fee_gbp'] = None
-        tx.transaction['source_transaction_id'] = transaction['id']
-        tx.transaction['source_trade_id'] = transaction['trade']['id']
-
-        return pd.DataFrame(tx.transaction, index=[0])
+        f['datetime'] = pd.to_datetime(f['created_at'], format='%Y-%m-%dT%H:%M:%SZ')
+        f['quantity'] = pd.to_numeric(f['amount.amount']).abs()
+        f['gbp'] = pd.to_numeric(f['native_amount.amount']).abs()
 
-    @staticmethod
-    def handle_buy_transaction(asset, transaction):
-        pass
-        # tx = Transaction()
-        #
-        # tx.transaction['asset'] = asset
-        # tx.transaction['type'] = transaction['type']
-        # tx.transaction['action'] = 'exchange_fiat_for_crypto'
-        # tx.transaction['disposal'] = False
-        # tx.transaction['datetime'] = datetime.strptime(transaction['created_at'], '%Y-%m-%dT%H:%M:%SZ')
-        # tx.transaction['initial_asset_quantity'] = None
-        # tx.transaction['initial_asset_currency'] = transaction['details']['payment_method_name'].split(' ')[0]
-        # tx.transaction['initial_asset_location'] = 'Coinbase'
-        # tx.transaction['initial_asset_address'] = None
-        # tx.transaction['price'] = None
-        # tx.transaction['final_asset_quantity'] = abs(float(transaction['amount']['amount']))
-        # tx.transaction['final_asset_currency'] = asset
-        # tx.transaction['final_asset_gbp'] = abs(float(transaction['native_amount']['amount']))
-        # tx.transaction['final_asset_location'] = 'Coinbase'
-        # tx.transaction['final_asset_address'] = None
-        # tx.transaction['fee_type'] = 'exchange'
-        # tx.transaction['fee_quantity'] = None
-        # tx.transaction['fee_currency'] = None
-        # tx.transaction['fee_gbp'] = None
-        # tx.transaction['source_transaction_id'] = transaction['id']
-        # tx.transaction['source_trade_id'] = transaction['buy']['id']
-        #
-        # return pd.DataFrame(tx.transaction, index=[0])
+        fiat = f['asset'].isin(['GBP', 'EUR'])
+        f['deposit_action'] = np.where(fiat, 'deposit_fiat', 'deposit_crypto')
+        f['withdraw_action'] = np.where(fiat, 'withdraw_fiat', 'withdraw_crypto')
+        f['withdrawal_location'] = np.where(f['details.subtitle'] == 'From Coinbase Pro', 'Coinbase Pro', 'Coinbase')
 
-    @staticmethod
-    def handle_sell_transaction(asset, transaction):
-        pass
-        # Not had one here yet! But gonna take a punt based on the buy transaction response
-        # print(f'Sell transaction: {transaction}')
-        # tx = Transaction()
-        #
-        # tx.transaction['asset'] = asset
-        # tx.transaction['type'] = transaction['type']
-        # tx.transaction['action'] = 'exchange_crypto_for_fiat'
-        # tx.transaction['disposal'] = False
-        # tx.transaction['datetime'] = datetime.strptime(transaction['created_at'], '%Y-%m-%dT%H:%M:%SZ')
-        # tx.transaction['initial_asset_quantity'] = None
-        # tx.transaction['initial_asset_currency'] = transaction['details']['payment_method_name'].split(' ')[0]
-        # tx.transaction['initial_asset_location'] = 'Coinbase'
-        # tx.transaction['initial_asset_address'] = None
-        # tx.transaction['price'] = None
-        # tx.transaction['final_asset_quantity'] = abs(float(transaction['amount']['amount']))
-        # tx.transaction['final_asset_currency'] = transaction['details']['payment_method_name'].split(' ')[0]
-        # tx.transaction['final_asset_gbp'] = abs(float(transaction['native_amount']['amount']))
-        # tx.transaction['final_asset_location'] = 'Coinbase'
-        # tx.transaction['final_asset_address'] = None
-        # tx.transaction['fee_type'] = 'exchange'
-        # tx.transaction['fee_quantity'] = None
-        # tx.transaction['fee_currency'] = None
-        # tx.transaction['fee_gbp'] = None
-        # tx.transaction['source_transaction_id'] = transaction['id']
-        # tx.transaction['source_trade_id'] = transaction['buy']['id']
-        #
-        # return pd.DataFrame(tx.transaction, index=[0])
+        # Sends give their fee directly or under network
+        f['send_fee_quantity'] = pd.to_numeric(f['transaction_fee.amount']).abs() \
+            .fillna(pd.to_numeric(f['network.transaction_fee.amount']).abs())
+        f['send_fee_currency'] = f['transaction_fee.currency'].fillna(f['network.transaction_fee.currency'])
 
-    @staticmethod
-    def handle_send_transaction(asset, transaction):
-        tx = Transaction()
-
-        re_sent = re.compile(r'^Sent ')
-        re_received = re.compile(r'^Received ')
-
-        if transaction['details']['subtitle'] == 'From Coinbase Earn':
-            tx.transaction['type'] = transaction['type']
-            tx.transaction['action'] = 'gifted_crypto'
-            tx.transaction['initial_asset_location'] = None
-            tx.transaction['final_asset_address'] = None
-            tx.transaction['source_trade_id'] = transaction['from']['id']
-            tx.transaction['initial_asset_quantity'] = None
-            tx.transaction['initial_asset_currency'] = None
-            tx.transaction['final_asset_quantity'] = abs(float(transaction['amount']['amount']))
-            tx.transaction['final_asset_currency'] = asset
-            tx.transaction['final_asset_location'] = 'Coinbase'
-            tx.transaction['final_asset_gbp'] = abs(float(transaction['native_amount']['amount']))
-            tx.transaction['fee_type'] = None
-            tx.transaction['fee_quantity'] = None
-            tx.transaction['fee_currency'] = None
-            tx.transaction['fee_gbp'] = None
-        elif re_sent.search(transaction['details']['title']):
-            tx.transaction['type'] = transaction['type']
-            tx.transaction['action'] = 'withdraw_crypto'
-            tx.transaction['initial_asset_location'] = 'Coinbase'
-            tx.transaction['final_asset_address'] = transaction['to']['address']
-            if 'application' in transaction.keys():
-                tx.transaction['source_trade_id'] = transaction['application']['id']
-            else:
-                tx.transaction['source_transaction_id'] = None
-            tx.transaction['initial_asset_quantity'] = abs(float(transaction['amount']['amount']))
-            tx.transaction['initial_asset_currency'] = asset
-            tx.transaction['final_asset_quantity'] = None
-            tx.transaction['final_asset_currency'] = None
-            tx.transaction['final_asset_location'] = None
-            tx.transaction['final_asset_gbp'] = None
-            tx.transaction['fee_type'] = 'transfer'
-            if 'transaction_fee' in transaction.keys():
-                tx.transaction['fee_quantity'] = abs(float(transaction['transaction_fee']['amount']))
-                tx.transaction['fee_currency'] = transaction['transaction_fee']['currency']
-            else:
-                tx.transaction['fee_quantity'] = abs(float(transaction['network']['transaction_fee']['amount']))
-                tx.transaction['fee_currency'] = transaction['network']['transaction_fee']['currency']
-            tx.transaction['fee_gbp'] = None
-        elif re_received.search(transaction['details']['title']):
-            tx.transaction['type'] = transaction['type']
-            tx.transaction['action'] = 'deposit_crypto'
-            tx.transaction['initial_asset_location'] = None
-            tx.transaction['final_asset_address'] = None
-            tx.transaction['source_trade_id'] = None
-            tx.transaction['initial_asset_quantity'] = None
-            tx.transaction['initial_asset_currency'] = None
-            tx.transaction['final_asset_quantity'] = abs(float(transaction['amount']['amount']))
-            tx.transaction['final_asset_currency'] = asset
-            tx.transaction['final_asset_location'] = 'Coinbase'
-            tx.transaction['final_asset_gbp'] = abs(float(transaction['native_amount']['amount']))
-            tx.transaction['fee_type'] = None
-            tx.transaction['fee_quantity'] = None
-            tx.transaction['fee_currency'] = None
-            tx.transaction['fee_gbp'] = None
-        else:
-            print(f"New send action: {transaction['details']['title']}")
+        # Exchange deposits only keep their id when made through an application
+        f['application_transaction_id'] = f['id'].where(f['application.id'].notna())
 
-        tx.transaction['asset'] = asset
-        tx.transaction['disposal'] = False
-        tx.transaction['datetime'] = dt.strptime(transaction['created_at'], '%Y-%m-%dT%H:%M:%SZ')
-        tx.transaction['initial_asset_address'] = None
-        tx.transaction['price'] = None
-        tx.transaction['source_transaction_id'] = transaction['id']
-
-        return pd.DataFrame(tx.transaction, index=[0])
+        return f
 
     @staticmethod
-    def handle_exchange_deposit_transaction(asset, transaction):
-        tx = Transaction()
-
-        tx.transaction['asset'] = asset
-        tx.transaction['type'] = transaction['type']
-        if asset in ['GBP', 'EUR']:
-            tx.transaction['action'] = 'deposit_fiat'
-        else:
-            tx.transaction['action'] = 'deposit_crypto'
-        tx.transaction['disposal'] = False
-        tx.transaction['datetime'] = dt.strptime(transaction['created_at'], '%Y-%m-%dT%H:%M:%SZ')
-        tx.transaction['initial_asset_quantity'] = abs(float(transaction['amount']['amount']))
-        tx.transaction['initial_asset_currency'] = asset
-        tx.transaction['initial_asset_location'] = 'Coinbase'
-        tx.transaction['initial_asset_address'] = None
-        tx.transaction['price'] = None
-        tx.transaction['final_asset_quantity'] = abs(float(transaction['amount']['amount']))
-        tx.transaction['final_asset_currency'] = asset
-        tx.transaction['final_asset_gbp'] = abs(float(transaction['native_amount']['amount']))
-        tx.transaction['final_asset_location'] = 'Coinbase Pro'
-        tx.transaction['final_asset_address'] = None
-        tx.transaction['fee_type'] = 'exchange'
-        tx.transaction['fee_quantity'] = None
-        tx.transaction['fee_currency'] = None
-        tx.transaction['fee_gbp'] = None
-        tx.transaction['source_transaction_id'] = transaction['id']
-        if 'application' in transaction.keys():
-            tx.transaction['source_trade_id'] = transaction['application']['id']
-        else:
-            tx.transaction['source_transaction_id'] = None
-
-        return pd.DataFrame(tx.transaction, index=[0])
-
-    @staticmethod
-    def handle_exchange_withdrawal_transaction(asset, transaction):
-        tx = Transaction()
-
-        tx.transaction['asset'] = asset
-        tx.transaction['type'] = transaction['type']
-        if asset in ['GBP', 'EUR']:
-            tx.transaction['action'] = 'withdraw_fiat'
-        else:
-            tx.transaction['action'] = 'withdraw_crypto'
-        tx.transaction['disposal'] = False
-        tx.transaction['datetime'] = dt.strptime(transaction['created_at'], '%Y-%m-%dT%H:%M:%SZ')
-        tx.transaction['initial_asset_quantity'] = abs(float(transaction['amount']['amount']))
-        tx.transaction['initial_asset_currency'] = asset
-        if transaction['details']['subtitle'] == 'From Coinbase Pro':
-            tx.transaction['initial_asset_location'] = 'Coinbase Pro'
-        else:
-            tx.transaction['initial_asset_location'] = 'Coinbase'
-        tx.transaction['initial_asset_address'] = None
-        tx.transaction['price'] = None
-        tx.transaction['final_asset_quantity'] = abs(float(transaction['amount']['amount']))
-        tx.transaction['final_asset_currency'] = asset
-        tx.transaction['final_asset_gbp'] = None
-        tx.transaction['final_asset_location'] = None
-        tx.transaction['final_asset_address'] = None
-        tx.transaction['fee_type'] = 'transfer'
-        tx.transaction['fee_quantity'] = None
-        tx.transaction['fee_currency'] = None
-        tx.transaction['fee_gbp'] = None
-        tx.transaction['source_transaction_id'] = transaction['id']
-        tx.transaction['source_trade_id'] = None
-
-        return pd.DataFrame(tx.transaction, index=[0])
-
-    @staticmethod
-    def handle_pro_deposit_transaction(asset, transaction):
-        tx = Transaction()
+    def create_transactions_dataframe(transaction_history):
+        """
+        Convert the raw transaction data to a pandas dataframe containing cleaned data.
 
-        tx.transaction['asset'] = asset
-        tx.transaction['type'] = transaction['type']
-        if asset in ['GBP', 'EUR']:
-            tx.transaction['action'] = 'withdraw_fiat'
-        else:
-            tx.transaction['action'] = 'withdraw_crypto'
-        tx.transaction['disposal'] = False
-        tx.transaction['datetime'] = dt.strptime(transaction['created_at'], '%Y-%m-%dT%H:%M:%SZ')
-        tx.transaction['initial_asset_quantity'] = abs(float(transaction['amount']['amount']))
-        tx.transaction['initial_asset_currency'] = asset
-        tx.transaction['initial_asset_location'] = 'Coinbase'
-        tx.transaction['initial_asset_address'] = None
-        tx.transaction['price'] = None
-        tx.transaction['final_asset_quantity'] = abs(float(transaction['amount']['amount']))
-        tx.transaction['final_asset_currency'] = asset
-        tx.transaction['final_asset_gbp'] = abs(float(transaction['native_amount']['amount']))
-        tx.transaction['final_asset_location'] = 'Coinbase Pro'
-        tx.transaction['final_asset_address'] = None
-        tx.transaction['fee_type'] = 'exchange'
-        tx.transaction['fee_quantity'] = None
-        tx.transaction['fee_currency'] = None
-        tx.transaction['fee_gbp'] = None
-        tx.transaction['source_transaction_id'] = transaction['id']
-        tx.transaction['source_trade_id'] = transaction['application']['id']
-
-        return pd.DataFrame(tx.transaction, index=[0])
+        The transactions are flattened once and each rule of TRANSACTION_MAP fills its columns for the completed
+        transactions of its type it matches, the first matching rule winning. Types without a rule (buy and sell,
+        which come from their own endpoints) are left out.
+        """
 
-    @staticmethod
-    def handle_pro_withdrawal_transaction(asset, transaction):
-        tx = Transaction()
+        f = Coinbase.flatten_transactions(transaction_history)
+        if not len(f):
+            return None
 
-        tx.transaction['asset'] = asset
-        tx.transaction['type'] = transaction['type']
-        if asset in ['GBP', 'EUR']:
-            tx.transaction['action'] = 'withdraw_fiat'
-        else:
-            tx.transaction['action'] = 'withdraw_crypto'
-        tx.transaction['disposal'] = False
-        tx.transaction['datetime'] = dt.strptime(transaction['created_at'], '%Y-%m-%dT%H:%M:%SZ')
-        tx.transaction['initial_asset_quantity'] = abs(float(transaction['amount']['amount']))
-        tx.transaction['initial_asset_currency'] = asset
-        tx.transaction['initial_asset_location'] = 'Coinbase Pro'
-        tx.transaction['initial_asset_address'] = None
-        tx.transaction['price'] = None
-        tx.transaction['final_asset_quantity'] = abs(float(transaction['amount']['amount']))
-        tx.transaction['final_asset_currency'] = asset
-        tx.transaction['final_asset_gbp'] = None
-        tx.transaction['final_asset_location'] = None
-        tx.transaction['final_asset_address'] = None
-        tx.transaction['fee_type'] = 'transfer'
-        tx.transaction['fee_quantity'] = None
-        tx.transaction['fee_currency'] = None
-        tx.transaction['fee_gbp'] = None
-        tx.transaction['source_transaction_id'] = transaction['id']
-        tx.transaction['source_trade_id'] = transaction['application']['id']
-
-        return pd.DataFrame(tx.transaction, index=[0])
+        df = pd.DataFrame({k: None for k in Transaction().transaction}, index=f.index)
+        completed = (f['status'] == 'completed').to_numpy()
+        assigned = np.zeros(len(f), dtype=bool)
+        unrecognised = np.zeros(len(f), dtype=bool)
 
-    @staticmethod
-    def handle_fiat_deposit_transaction(asset, transaction):
-        tx = Transaction()
-
-        tx.transaction['asset'] = asset
-        tx.transaction['type'] = transaction['type']
-        tx.transaction['action'] = 'deposit_fiat'
-        tx.transaction['disposal'] = False
-        tx.transaction['datetime'] = dt.strptime(transaction['created_at'], '%Y-%m-%dT%H:%M:%SZ')
-        tx.transaction['initial_asset_quantity'] = None
-        tx.transaction['initial_asset_currency'] = None
-        tx.transaction['initial_asset_location'] = None
-        tx.transaction['initial_asset_address'] = None
-        tx.transaction['price'] = None
-        tx.transaction['final_asset_quantity'] = abs(float(transaction['amount']['amount']))
-        tx.transaction['final_asset_currency'] = asset
-        tx.transaction['final_asset_gbp'] = abs(float(transaction['native_amount']['amount']))
-        tx.transaction['final_asset_location'] = 'Coinbase'
-        tx.transaction['final_asset_address'] = None
-        tx.transaction['fee_type'] = 'transfer'
-        tx.transaction['fee_quantity'] = None
-        tx.transaction['fee_currency'] = None
-        tx.transaction['fee_gbp'] = None
-        tx.transaction['source_transaction_id'] = transaction['id']
-        tx.transaction['source_trade_id'] = None
-
-        return pd.DataFrame(tx.transaction, index=[0])
+        for transaction_type, condition, columns in TRANSACTION_MAP:
+            rows = completed & ~assigned & (f['type'] == transaction_type).to_numpy()
+            if condition is not None:
+                rows &= condition(f).fillna(False).to_numpy(dtype=bool)
+            if not rows.any():
+                continue
 
-    @staticmethod
-    def handle_fiat_withdrawal_transaction(asset, transaction):
-        tx = Transaction()
-
-        tx.transaction['asset'] = asset
-        tx.transaction['type'] = transaction['type']
-        tx.transaction['action'] = 'withdraw_fiat'
-        tx.transaction['disposal'] = False
-        tx.transaction['datetime'] = dt.strptime(transaction['created_at'], '%Y-%m-%dT%H:%M:%SZ')
-        tx.transaction['initial_asset_quantity'] = abs(float(transaction['amount']['amount']))
-        tx.transaction['initial_asset_currency'] = asset
-        tx.transaction['initial_asset_location'] = 'Coinbase'
-        tx.transaction['initial_asset_address'] = None
-        tx.transaction['price'] = None
-        tx.transaction['final_asset_quantity'] = abs(float(transaction['amount']['amount']))
-        tx.transaction['final_asset_currency'] = asset
-        tx.transaction['final_asset_gbp'] = abs(float(transaction['native_amount']['amount']))
-        tx.transaction['final_asset_location'] = None
-        tx.transaction['final_asset_address'] = None
-        tx.transaction['fee_type'] = 'transfer'
-        tx.transaction['fee_quantity'] = None
-        tx.transaction['fee_currency'] = None
-        tx.transaction['fee_gbp'] = None
-        tx.transaction['source_transaction_id'] = transaction['id']
-        tx.transaction['source_trade_id'] = None
-
-        return pd.DataFrame(tx.transaction, index=[0])
+            for column, value in {**COMMON_COLUMNS, **columns}.items():
+                df.loc[rows, column] = f.loc[rows, value.name].to_numpy() if isinstance(value, Field) else value
 
-    @staticmethod
-    def create_transactions_dataframe(transaction_history):
-        """
-        Convert the raw transaction data to a pandas dataframe containing cleaned data
-        """
+            assigned |= rows
+            if 'action' not in columns:
+                unrecognised |= rows
 
-        transaction_type_function_map = {
-            'trade': Coinbase.handle_trade_transaction,
-            'buy': Coinbase.handle_buy_transaction,
-            'sell': Coinbase.handle_sell_transaction,
-            'send': Coinbase.handle_send_transaction,
-            'exchange_deposit': Coinbase.handle_exchange_deposit_transaction,
-            'exchange_withdrawal': Coinbase.handle_exchange_withdrawal_transaction,
-            'pro_deposit': Coinbase.handle_pro_deposit_transaction,
-            'pro_withdrawal': Coinbase.handle_pro_withdrawal_transaction,
-            'fiat_deposit': Coinbase.handle_fiat_deposit_transaction,
-            'fiat_withdrawal': Coinbase.handle_fiat_withdrawal_transaction
-        }
-
-        transaction_dataframes = []
-        for k, v in transaction_history.items():
-            for i in v:
-                if i['status'] == 'completed':
-                    transaction_dataframes.append(transaction_type_function_map.get(i['type'])(k, i))
+        for title in f.loc[unrecognised, 'details.title']:
+            print(f'New send action: {title}')
 
-        if len(transaction_dataframes) > 0:
-            transaction_df = pd.concat(transaction_dataframes)
+        if not assigned.any():
+            return None
 
-            return transaction_df
+        return df[assigned].reset_index(drop=True)
 
     @staticmethod
     def create_buys_dataframe(buys_history):
@@ -1,11 +1,12 @@
 import os
-import json
 import requests
 import pandas as pd
 from datetime import datetime as dt
 
 from apis.authentication import CoinbaseProAuth
-from apis.helpers import Transaction, CoinbaseConvertToGBP
+from apis.helpers import Transaction, convert_columns_to_gbp, normalize_records
+from apis.rate_cache import rate_cache
+from metrics import metrics
 
 
 class CoinbasePro:
@@ -30,12 +31,8 @@ class CoinbasePro:
             if transactions:
                 all_fills = all_fills + transactions
 
-        # Create dataframe of all fills transactions
-        all_fills_dataframes = []
-        for fill in all_fills:
-            all_fills_dataframes.append(CoinbasePro.create_fills_dataframe(fill))
-
-        df_fills = pd.concat(all_fills_dataframes)
+        # Create dataframe of all fills transactions, across processes when there are many
+        df_fills = normalize_records(CoinbasePro.create_fills_dataframe, [(fill,) for fill in all_fills])
 
         # Get all account ids and their corresponding assets
         accounts = self.get_accounts()
@@ -44,125 +41,33 @@ class CoinbasePro:
         all_deposits = self.get_deposits(accounts)
 
         # Create dataframe of all deposit transactions
-        all_deposits_dataframes = []
-        for deposit in all_deposits:
-            all_deposits_dataframes.append(CoinbasePro.create_deposits_dataframe(deposit))
-
-        df_deposits = pd.concat(all_deposits_dataframes)
+        df_deposits = normalize_records(CoinbasePro.create_deposits_dataframe, [(deposit,) for deposit in all_deposits])
 
         # Get all withdrawal transactions
         all_withdrawals = self.get_withdrawals(accounts)
 
         # Create dataframe of all withdrawal transactions
-        all_withdrawals_dataframe = []
-        for withdrawal in all_withdrawals:
-            all_withdrawals_dataframe.append(CoinbasePro.create_withdrawals_dataframe(withdrawal))
-
-        df_withdrawals = pd.concat(all_withdrawals_dataframe)
+        df_withdrawals = normalize_records(CoinbasePro.create_withdrawals_dataframe,
+                                          [(withdrawal,) for withdrawal in all_withdrawals])
 
         # Union all transaction dataframes and sort by datetime
         df_transactions = pd.concat([df_fills, df_deposits, df_withdrawals]).sort_values(by='datetime')
 
-        # Check whether cached_rates_gbp.json exists
-        if not os.path.isfile('data/cached_gbp_rates.json'):
-            with open('data/cached_gbp_rates.json', 'w') as f:
-                json.dump({}, f)
-
-        # Read cached crypto/gbp rates
-        with open('data/cached_gbp_rates.json') as j:
-            cached_rates = json.load(j)
-
-        # Loop through and get GBP values where missing
-        final_asset_gbp = []
-        fee_gbp = []
-        count_api = 0
-        count_cache = 0
-        for row in df_transactions.itertuples():
-            # Calculate GBP value for all disposals
-            if row.action in ['exchange_fiat_for_crypto', 'exchange_crypto_for_fiat', 'exchange_crypto_for_crypto']:
-                if row.final_asset_currency == 'GBP':
-                    final_asset_gbp.append(row.final_asset_quantity)
-                else:
-                    asset = row.final_asset_currency
-                    datetime = dt.strptime(str(row.datetime), '%Y-%m-%d %H:%M:%S').strftime('%Y-%m-%d %H:%M:00')
-                    quantity = row.final_asset_quantity
-
-                    # Check whether we have already cached the GBP rate for the asset and datetime in question
-                    if asset in cached_rates.keys():
-                        if not cached_rates[asset].get(datetime):
-                            # Convert to GBP
-                            c = CoinbaseConvertToGBP(asset, datetime, quantity)
-                            quantity_gbp = c.convert_to_gbp()
-                            final_asset_gbp.append(quantity_gbp)
-                            # Calculate the asset GBP rate at this datetime and cache
-                            if float(quantity):
-                                rate_gbp = quantity_gbp / float(quantity)
-                                cached_rates[asset][datetime] = rate_gbp
-                            count_api += 1
-                        else:
-                            rate_gbp = cached_rates[asset].get(datetime)
-                            quantity_gbp = rate_gbp * float(quantity)
-                            final_asset_gbp.append(quantity_gbp)
-                            count_cache += 1
-                    else:
-                        c = CoinbaseConvertToGBP(asset, datetime, quantity)
-                        quantity_gbp = c.convert_to_gbp()
-                        final_asset_gbp.append(quantity_gbp)
-                        if float(row.initial_asset_quantity):
-                            rate_gbp = quantity_gbp / float(quantity)
-                            cached_rates[asset] = {}
-                            cached_rates[asset][datetime] = rate_gbp
-                        count_api += 1
-            else:
-                final_asset_gbp.append(None)
-
-            # Calculate all fees in GBP
-            if not pd.isna(row.fee_currency):
-                if any([row.fee_currency == 'GBP', row.fee_quantity == 0.0]):
-                    fee_gbp.append(row.fee_quantity)
-                else:
-                    asset = row.fee_currency
-                    datetime = dt.strptime(str(row.datetime), '%Y-%m-%d %H:%M:%S').strftime('%Y-%m-%d %H:%M:00')
-                    quantity = row.fee_quantity
-
-                    # Check whether we have already cached the GBP rate for the asset and datetime in question
-                    if asset in cached_rates.keys():
-                        if not cached_rates[asset].get(datetime):
-                            # Convert to GBP
-                            c = CoinbaseConvertToGBP(asset, datetime, quantity)
-                            quantity_gbp = c.convert_to_gbp()
-                            fee_gbp.append(quantity_gbp)
-                            # Calculate the asset GBP rate at this datetime and cache if amount is not zero
-                            if float(row.fee_quantity):
-                                rate_gbp = quantity_gbp / float(quantity)
-                                cached_rates[asset][datetime] = rate_gbp
-                            count_api += 1
-                        else:
-                            rate_gbp = cached_rates[asset].get(datetime)
-                            quantity_gbp = rate_gbp * float(quantity)
-                            fee_gbp.append(quantity_gbp)
-                            count_cache += 1
-                    else:
-                        c = CoinbaseConvertToGBP(asset, datetime, quantity)
-                        quantity_gbp = c.convert_to_gbp()
-                        fee_gbp.append(quantity_gbp)
-                        if float(quantity):
-                            rate_gbp = quantity_gbp / float(quantity)
-                            cached_rates[asset] = {}
-                            cached_rates[asset][datetime] = rate_gbp
-                        count_api += 1
-            else:
-                fee_gbp.append(None)
+        # GBP conversions
+        # Convert every rate missing from the cache in one batch over the Coinbase Pro markets
+        final_asset_gbp, fee_gbp, price_resolution, count_api, count_cache = convert_columns_to_gbp(
+            df_transactions, rate_cache, ['coinbase_pro'])
 
         print(f'Count API:\t {count_api}')
         print(f'Count cache:\t {count_cache}')
+        metrics.cache('gbp_rates', hits=count_cache, misses=count_api)
 
-        # Save cached_rates back to json file for quicker conversions on next run
-        with open('data/cached_gbp_rates.json', 'w', encoding='utf-8') as f:
-            json.dump(cached_rates, f, ensure_ascii=False, indent=4)
+        # Write the rates still queued for quicker conversions on next run
+        rate_cache.flush()
 
         df_transactions['final_asset_gbp'] = final_asset_gbp
         df_transactions['fee_gbp'] = fee_gbp
+        df_transactions['price_resolution'] = price_resolution
 
         return df_transactions
 
@@ -0,0 +1,444 @@
+import os
+import json
+import hashlib
+import threading
+import requests
+import numpy as np
+from io import BytesIO
+from datetime import datetime, timedelta
+from zipfile import ZipFile
+
+from apis.mt4 import read_hst
+from apis.single_flight import SingleFlight
+from metrics import metrics
+
+
+class ForexCache:
+    """
+    Minute bar closes for the FXDD forex pairs, kept as they are in monthly chunks under
+    data/forex/<pair>/<YYYY-MM>.npz and looked up as of a time, i.e. the last close at or before it.
+
+    manifest.json records for each pair the last minute covered, when FXDD was last checked, the hash of the last
+    download and the size and sha256 of every chunk. A lookup only downloads when it asks for a minute past the
+    pair's coverage, and then at most once every download_interval since FXDD only update weekly. Chunks for
+    completed months are never rewritten, only the chunk of the last covered month is replaced as it fills up.
+
+    Bars are missing for weekends, overnight gaps and holidays, so a lookup is only answered when the last bar is
+    no more than max_staleness before it.
+    """
+
+    path = 'data/forex/'
+    start = '2017-11-01 00:00:00'
+    download_interval = timedelta(hours=6)
+    max_staleness = np.timedelta64(7, 'D')
+
+    # Chunks from before this layout are rebuilt
+    chunk_format = 'bars'
+
+    # These datasets appear to be updated weekly
+    download_urls = {
+        'EURGBP': 'https://tools.fxdd.com/tools/M1Data/EURGBP.zip',
+        'GBPUSD': 'https://tools.fxdd.com/tools/M1Data/GBPUSD.zip'
+    }
+
+    def __init__(self, path=None, max_staleness=None):
+        self.path = path or ForexCache.path
+        self.max_staleness = max_staleness if max_staleness is not None else ForexCache.max_staleness
+        self.lock = threading.RLock()
+        self.chunks = {}
+        self.manifest = None
+
+    def load_manifest(self):
+        if self.manifest is None:
+            if os.path.isfile(f'{self.path}manifest.json'):
+                with open(f'{self.path}manifest.json') as j:
+                    self.manifest = {k: v for k, v in json.load(j).items()
+                                     if v.get('format') == ForexCache.chunk_format}
+            else:
+                self.manifest = {}
+
+        return self.manifest
+
+    def save_manifest(self):
+        with open(f'{self.path}manifest.json.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, indent=4)
+        os.replace(f'{self.path}manifest.json.tmp', f'{self.path}manifest.json')
+
+    def covered_until(self, pair):
+        covered = self.load_manifest().get(pair, {}).get('covered')
+
+        return datetime.strptime(covered, '%Y-%m-%d %H:%M:%S') if covered else None
+
+    def close(self, pair, dt):
+        """
+        Return the close of pair as of dt ('%Y-%m-%d %H:%M:%S'), or None when there is no recent enough bar
+        """
+
+        close = self.closes(pair, [dt])[0]
+
+        return None if np.isnan(close) else float(close)
+
+    def closes(self, pair, dts):
+        """
+        Return an array of the closes of pair as of each of dts, NaN where FXDD have no data yet or the last bar
+        before it is older than max_staleness
+        """
+
+        minutes = np.asarray(dts, dtype='datetime64[s]').astype('datetime64[m]')
+        result = np.full(len(minutes), np.nan)
+
+        valid = minutes >= np.datetime64(ForexCache.start, 'm')
+        if not valid.any():
+            return result
+
+        with self.lock:
+            covered = self.covered_until(pair)
+            if covered is None or minutes[valid].max() > np.datetime64(covered, 'm'):
+                self.refresh(pair)
+                covered = self.covered_until(pair)
+
+                if covered is None:
+                    return result
+
+            valid &= minutes <= np.datetime64(covered, 'm')
+            if not valid.any():
+                return result
+
+            # The month before the earliest lookup too, for bars carried over the turn of a month
+            months = np.arange(minutes[valid].min().astype('datetime64[M]') - 1,
+                               minutes[valid].max().astype('datetime64[M]') + 1)
+            chunks = [self.load_chunk(pair, str(month)) for month in months]
+
+        times = np.concatenate([i[0] for i in chunks])
+        close = np.concatenate([i[1] for i in chunks])
+
+        # Index of the last bar at or before each lookup
+        idx = np.searchsorted(times, minutes, side='right') - 1
+        found = valid & (idx >= 0)
+        found[found] = minutes[found] - times[idx[found]] <= self.max_staleness
+
+        result[found] = close[idx[found]]
+
+        return result
+
+    def load_chunk(self, pair, month):
+        """
+        Return the bar times (datetime64[m]) and closes of a month, empty if the month has no chunk
+        """
+
+        if (pair, month) in self.chunks:
+            metrics.cache('forex_chunks', hits=1)
+            return self.chunks[(pair, month)]
+
+        entry = self.load_manifest()[pair]
+        if month not in entry['chunks']:
+            return np.array([], dtype='datetime64[m]'), np.array([])
+
+        metrics.cache('forex_chunks', misses=1)
+
+        path = f'{self.path}{pair}/{month}.npz'
+        if not os.path.isfile(path) or ForexCache.file_digest(path) != entry['chunks'][month]:
+            # Missing or corrupt chunk, rebuild the pair from a fresh download
+            self.manifest[pair] = ForexCache.new_entry()
+            self.refresh(pair)
+
+            if month not in self.manifest[pair]['chunks']:
+                return np.array([], dtype='datetime64[m]'), np.array([])
+
+        with np.load(path) as npz:
+            self.chunks[(pair, month)] = (npz['time'].astype('datetime64[m]'), npz['close'])
+        metrics.file_read(path)
+
+        return self.chunks[(pair, month)]
+
+    @staticmethod
+    def new_entry():
+        return {'format': ForexCache.chunk_format, 'covered': None, 'checked': None, 'download_sha256': None,
+                'chunks': {}}
+
+    def refresh(self, pair):
+        """
+        Download the pair and write chunks from the last covered month onwards
+        """
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        manifest = self.load_manifest()
+        entry = manifest.setdefault(pair, ForexCache.new_entry())
+
+        now = datetime.utcnow()
+        checked = entry['checked'] and datetime.strptime(entry['checked'], '%Y-%m-%d %H:%M:%S')
+        if checked and now - checked < ForexCache.download_interval:
+            return
+
+        content = ForexCache.download(ForexCache.download_urls[pair])
+        entry['checked'] = now.strftime('%Y-%m-%d %H:%M:%S')
+
+        download_sha256 = hashlib.sha256(content).hexdigest()
+        if download_sha256 == entry['download_sha256'] and entry['covered']:
+            # Nothing new since the last download
+            self.save_manifest()
+            return
+
+        if not os.path.exists(f'{self.path}{pair}'):
+            os.makedirs(f'{self.path}{pair}')
+
+        start = np.datetime64(ForexCache.start, 'm')
+
+        # Only the last covered month onwards can have changed
+        first_month = start.astype('datetime64[M]')
+        if entry['covered']:
+            first_month = max(first_month, np.datetime64(entry['covered']).astype('datetime64[M]'))
+
+        # Read from a week earlier so the first minutes of the month can carry forward a close from before a weekend
+        times, close = self.read_download(pair, content, first_month.astype('datetime64[m]') - np.timedelta64(7, 'D'))
+        end = times[-1]
+
+        for month in np.arange(first_month, end.astype('datetime64[M]') + 1):
+            lo, hi = np.searchsorted(times, [max(month.astype('datetime64[m]'), start),
+                                             (month + 1).astype('datetime64[m]')])
+
+            path = f'{self.path}{pair}/{month}.npz'
+            np.savez(path, time=times[lo:hi].astype(np.int64), close=close[lo:hi])
+            metrics.file_written(path)
+
+            entry['chunks'][str(month)] = ForexCache.file_digest(path)
+            self.chunks.pop((pair, str(month)), None)
+
+        entry['covered'] = str(end.astype('datetime64[s]')).replace('T', ' ')
+        entry['download_sha256'] = download_sha256
+        self.save_manifest()
+
+    def read_download(self, pair, content, start):
+        """
+        Return the minute stamps and closes from start onwards in a downloaded zip
+        """
+
+        with ZipFile(BytesIO(content)) as z:
+            z.extract(f'{pair}.hst', self.path)
+
+        try:
+            times, close = read_hst(f'{self.path}{pair}.hst', start=start)
+        finally:
+            os.remove(f'{self.path}{pair}.hst')
+
+        return times.astype('datetime64[m]'), close
+
+    @staticmethod
+    def download(url):
+        """
+        Download a zip, checking it arrived whole and is a readable archive
+        """
+
+        r = requests.get(url)
+        r.raise_for_status()
+
+        # Content-Length is the encoded size when the response was compressed in transit
+        expected_size = r.headers.get('Content-Length')
+        if expected_size is not None and 'Content-Encoding' not in r.headers and int(expected_size) != len(r.content):
+            raise IOError(f'Incomplete forex download from {url}: {len(r.content)} of {expected_size} bytes')
+
+        with ZipFile(BytesIO(r.content)) as z:
+            if z.testzip() is not None:
+                raise IOError(f'Corrupt forex download from {url}')
+
+        return r.content
+
+    @staticmethod
+    def file_digest(path):
+        with open(path, 'rb') as f:
+            return {'size': os.path.getsize(path), 'sha256': hashlib.sha256(f.read()).hexdigest()}
+
+
+class DailyRateCache:
+    """
+    Daily GBP rates for lookups the minute forex data does not cover yet, persisted to data/forex/daily_rates.json
+    keyed by date and base currency.
+
+    A missing day is fetched together with the days around it in one range request, and days without a published
+    rate (weekends, holidays) take the rate of the last business day before them once a later day has been
+    published. A day after the last published one, e.g. today before its rate is out, is given the last rate for
+    provisional_ttl without keeping it, so it is looked up again later. Days that could not be fetched are
+    remembered for negative_ttl, with the reason, so every row of a recent week does not retry the API.
+    """
+
+    path = 'data/forex/daily_rates.json'
+    range_days = 7
+    # Days fetched after the one looked up, enough for a published day to follow a long weekend
+    days_after = 4
+    negative_ttl = timedelta(minutes=30)
+    provisional_ttl = timedelta(minutes=30)
+    # Whether exchangeratesapi.io serves ranges to the access key, see fetch
+    timeseries = True
+
+    def __init__(self, path=None):
+        self.path = path or DailyRateCache.path
+        self.lock = threading.RLock()
+        self.rates = None
+        self.failures = {}
+        self.provisional = {}
+        self.flights = SingleFlight('daily_rates')
+
+    def load(self):
+        if self.rates is None:
+            if os.path.isfile(self.path):
+                with open(self.path) as j:
+                    self.rates = json.load(j)
+                metrics.file_read(self.path)
+            else:
+                self.rates = {}
+
+        return self.rates
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.rates, f, indent=4, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
+        metrics.file_written(self.path)
+
+    def rate(self, date, base):
+        """
+        Return GBP per unit of base on date ('%Y-%m-%d'), or None if no rate could be found
+        """
+
+        key = f'{date} {base}'
+
+        with self.lock:
+            rates = self.load()
+            if key in rates:
+                metrics.cache('daily_rates', hits=1)
+                return rates[key]
+
+            provisional = self.provisional.get(key)
+            if provisional and datetime.utcnow() - provisional[0] < DailyRateCache.provisional_ttl:
+                metrics.cache('daily_rates_provisional', hits=1)
+                return provisional[1]
+
+            failure = self.failures.get(key)
+            if failure and datetime.utcnow() - failure[0] < DailyRateCache.negative_ttl:
+                metrics.cache('daily_rates_negative', hits=1)
+                return None
+
+            metrics.cache('daily_rates', misses=1)
+
+        # The range is fetched outside the lock so lookups of other days are not held up, and concurrent lookups
+        # of the same day share one request
+        return self.flights.do(key, lambda: self.fetch_and_keep(date, base))
+
+    def fetch_and_keep(self, date, base):
+        key = f'{date} {base}'
+        day = datetime.strptime(date, '%Y-%m-%d')
+        start = day - timedelta(days=DailyRateCache.range_days - 1)
+        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        end = max(day, min(day + timedelta(days=DailyRateCache.days_after), today))
+
+        try:
+            fetched = DailyRateCache.fetch(start, end, base)
+        except (requests.RequestException, ValueError, KeyError) as e:
+            fetched, reason = {}, str(e)
+        else:
+            reason = 'No rate published yet'
+
+        with self.lock:
+            rates = self.load()
+
+            # Fill weekends and holidays in the range with the last published rate before them, only up to the last
+            # published day as a later day may just not be published yet
+            published = sorted(fetched)
+            last = None
+            day = start
+            while published and day.strftime('%Y-%m-%d') <= published[-1]:
+                if day.strftime('%Y-%m-%d') in fetched:
+                    last = fetched[day.strftime('%Y-%m-%d')]
+                if last is not None:
+                    rates[f"{day.strftime('%Y-%m-%d')} {base}"] = last
+                day += timedelta(days=1)
+
+            if fetched:
+                self.save()
+
+            if key in rates:
+                return rates[key]
+
+            if published and date > published[-1]:
+                self.provisional[key] = (datetime.utcnow(), fetched[published[-1]])
+                return fetched[published[-1]]
+
+            self.failures[key] = (datetime.utcnow(), reason)
+            return None
+
+    @staticmethod
+    def fetch(start, end, base):
+        """
+        Return {date: GBP per unit of base} for the business days from start to end in one request, through
+        exchangeratesapi.io when RATES_API_ACCESS_KEY is set and ratesapi.io otherwise.
+
+        exchangeratesapi.io only serves ranges (timeseries) on its paid plans. When the range is refused, as on the
+        free plan, each business day is fetched on its own instead, and so are later ranges for the rest of the run.
+        """
+
+        access_key = os.environ.get('RATES_API_ACCESS_KEY')
+        if not access_key:
+            r = requests.get('https://api.ratesapi.io/api/history', params={
+                'start_at': start.strftime('%Y-%m-%d'), 'end_at': end.strftime('%Y-%m-%d'), 'base': 'USD',
+                'symbols': f'{base},GBP'})
+            r.raise_for_status()
+            response = r.json()
+
+            return {k: DailyRateCache.cross(v, response.get('base'), base) for k, v in response['rates'].items()}
+
+        params = {'symbols': f'{base},GBP', 'access_key': access_key}
+
+        if DailyRateCache.timeseries:
+            r = requests.get('http://api.exchangeratesapi.io/v1/timeseries', params={
+                'start_date': start.strftime('%Y-%m-%d'), 'end_date': end.strftime('%Y-%m-%d'), **params})
+            response = r.json()
+
+            if 'rates' in response:
+                return {k: DailyRateCache.cross(v, response.get('base'), base) for k, v in response['rates'].items()}
+
+            # The plan restriction comes back as an error body, with an error status on some plans
+            if response.get('error', {}).get('type') != 'function_access_restricted':
+                r.raise_for_status()
+                raise KeyError(f"No rates in response: {response.get('error')}")
+
+            DailyRateCache.timeseries = False
+
+        rates = {}
+        response = {}
+        day = start
+        while day <= end:
+            if day.weekday() < 5:
+                r = requests.get(f"http://api.exchangeratesapi.io/v1/{day.strftime('%Y-%m-%d')}", params=params)
+                r.raise_for_status()
+                response = r.json()
+
+                # Days not published yet have no rates, the days before them are still kept
+                if 'rates' not in response:
+                    break
+                rates[response.get('date', day.strftime('%Y-%m-%d'))] = DailyRateCache.cross(
+                    response['rates'], response.get('base'), base)
+            day += timedelta(days=1)
+
+        if not rates:
+            raise KeyError(f"No rates in response: {response.get('error')}")
+
+        return rates
+
+    @staticmethod
+    def cross(day_rates, quoted, base):
+        """
+        Return GBP per unit of base from one day's rates quoted against another currency
+        """
+
+        return day_rates['GBP'] / (1.0 if base == quoted else day_rates[base])
+
+
+# Shared by every conversion so chunks and daily rates are only read once per run
+forex_cache = ForexCache()
+daily_rates = DailyRateCache()
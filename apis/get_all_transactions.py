@@ -1,42 +1,86 @@
 import os
+import argparse
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from apis.exchanges.binance import Binance
 from apis.exchanges.coinbase import Coinbase
 from apis.exchanges.coinbase_pro import CoinbasePro
 
 from apis.wallets.exodus import Exodus
+from apis.rate_limiter import RateLimiter
+from apis.statements import Statements
+from apis.landing import landing_zone
+from apis.prices import price_failures
+from metrics import metrics
 
 
 class GetAllTransactions:
-    def __init__(self):
+    # Source name: (display name, connector, method returning its transactions dataframe)
+    exchanges = {
+        'binance': ('Binance', Binance, 'get_binance_transactions'),
+        'coinbase': ('Coinbase', Coinbase, 'get_coinbase_transactions'),
+        'coinbase_pro': ('Coinbase Pro', CoinbasePro, 'get_coinbase_pro_transactions')
+    }
+    wallets = {
+        'exodus': ('Exodus', Exodus, 'get_exodus_transactions')
+    }
+
+    # Requests per second each source may make when sources are ingested concurrently
+    rate_limits = {
+        'binance': 10,
+        'coinbase': 5,
+        'coinbase_pro': 5,
+        'exodus': 5
+    }
+
+    def __init__(self, concurrent=False, statements_only=False):
+        self.concurrent = concurrent
+        self.statements_only = statements_only
+        self.statements = Statements()
         self.source_transactions_save_path = 'data/source_transactions/'
         self.asset_transactions_save_path = 'data/asset_transactions/'
         self.forex_downloads = 'data/forex/'
 
     def get_all_transactions(self):
-        # Delete forex data to ensure up to date data is downloaded
-        for file in os.listdir(self.forex_downloads):
-            os.remove('data/forex/'+file)
-
         if not os.path.exists(self.source_transactions_save_path):
             os.makedirs(self.source_transactions_save_path)
 
         if not os.path.exists(f'{self.asset_transactions_save_path}'):
             os.makedirs(f'{self.asset_transactions_save_path}')
 
-        # Create transaction CSVs from exchanges
-        self.create_exchange_transactions()
+        # Keep every raw response in the landing zone so the CSVs can be rebuilt without the APIs
+        with landing_zone.hooked():
+            if self.concurrent:
+                # Create transaction CSVs from every exchange and wallet at once
+                self.create_source_transactions_concurrently()
+            else:
+                # Create transaction CSVs from exchanges
+                self.create_exchange_transactions()
+
+                # Create transaction CSVs from wallets
+                self.create_wallet_transactions()
+
+        with metrics.stage('merge_transactions') as stage:
+            self.merge_transactions(stage)
 
-        # Create transaction CSVs from wallets
-        self.create_wallet_transactions()
+        print('All done!')
+
+        return True
 
+    def merge_transactions(self, stage):
         transaction_dfs = []
 
         for i in os.listdir(self.source_transactions_save_path):
             transaction_dfs.append(pd.read_csv(self.source_transactions_save_path+i))
+            metrics.file_read(self.source_transactions_save_path+i)
 
         all_transactions = pd.concat(transaction_dfs)
+        stage['rows_in'] = len(all_transactions)
+
+        # Source transactions written before price resolutions were recorded have none
+        if 'price_resolution' not in all_transactions.columns:
+            all_transactions['price_resolution'] = None
 
         # Remove duplicate deposit_crypto transactions
         deposit_external = all_transactions.loc[(all_transactions['action'] == 'deposit_crypto') & (all_transactions['type'] == 'external')]
@@ -65,7 +109,8 @@ class GetAllTransactions:
                               'initial_asset_currency_y', 'initial_asset_location_x', 'initial_asset_address_y',
                               'price_y', 'final_asset_quantity_y', 'final_asset_currency_y', 'final_asset_gbp_y',
                               'final_asset_location_y', 'final_asset_address_y', 'fee_type_y',	'fee_quantity_y',
-                              'fee_currency_y',	 'fee_gbp_y', 'source_transaction_id_y', 'source_trade_id_y'], axis=1)
+                              'fee_currency_y',	 'fee_gbp_y', 'price_resolution_y', 'source_transaction_id_y',
+                              'source_trade_id_y'], axis=1)
 
             d_rename_map = {i: '_'.join(i.split('_')[:-1]) for i in d.columns if '_' in i}
 
@@ -75,7 +120,8 @@ class GetAllTransactions:
                               'initial_asset_currency_x', 'initial_asset_location_x', 'initial_asset_address_x',
                               'price_x', 'final_asset_quantity_x', 'final_asset_currency_x', 'final_asset_gbp_x',
                               'final_asset_location_y', 'final_asset_address_x', 'fee_type_x', 'fee_quantity_x',
-                              'fee_currency_x', 'fee_gbp_x', 'source_transaction_id_x', 'source_trade_id_x'], axis=1)
+                              'fee_currency_x', 'fee_gbp_x', 'price_resolution_x', 'source_transaction_id_x',
+                              'source_trade_id_x'], axis=1)
 
             w_rename_map = {i: '_'.join(i.split('_')[:-1]) for i in w.columns if '_' in i}
 
@@ -93,50 +139,118 @@ class GetAllTransactions:
                      'initial_asset_currency', 'initial_asset_location', 'initial_asset_address', 'price',
                      'final_asset_quantity', 'final_asset_currency', 'final_asset_gbp', 'final_asset_location',
                      'final_asset_address', 'fee_type', 'fee_quantity', 'fee_currency', 'fee_gbp',
-                     'source_transaction_id', 'source_trade_id']]
+                     'price_resolution', 'source_transaction_id', 'source_trade_id']]
 
             # Overwrite the dataframe in the dict
             asset_transaction_dfs[asset] = df
 
         for asset, transactions in asset_transaction_dfs.items():
             transactions.to_csv(f'{self.asset_transactions_save_path}{asset}.csv', index=False)
+            metrics.file_written(f'{self.asset_transactions_save_path}{asset}.csv')
 
-        print('All done!')
-
-        return True
+        stage['rows_out'] = sum(len(i) for i in asset_transaction_dfs.values())
 
     def create_exchange_transactions(self):
-        # Get Binance transactions
-        print('Getting Binance transactions...')
-        binance = Binance()
-        binance_transactions = binance.get_binance_transactions()
-        binance_transactions.to_csv(f'{self.source_transactions_save_path}binance.csv', index=False)
-        print('Got Binance transactions!\n')
-
-        # Get Coinbase transactions
-        print('Getting Coinbase transactions...')
-        coinbase = Coinbase()
-        coinbase_transactions = coinbase.get_coinbase_transactions()
-        coinbase_transactions.to_csv(f'{self.source_transactions_save_path}coinbase.csv', index=False)
-        print('Got Coinbase transactions!\n')
-
-        # Get Coinbase Pro transactions
-        print('Getting Coinbase Pro transactions...')
-        coinbase_pro = CoinbasePro()
-        coinbase_pro_transactions = coinbase_pro.get_coinbase_pro_transactions()
-        coinbase_pro_transactions.to_csv(f'{self.source_transactions_save_path}coinbase_pro.csv', index=False)
-        print('Got Coinbase Pro transactions!\n')
-        pass
+        for source in self.exchanges:
+            self.create_source_transactions(source)
 
     def create_wallet_transactions(self):
-        # Get Exodus transactions
-        print('Getting Exodus transactions...')
-        exodus = Exodus()
-        exodus_transactions = exodus.get_exodus_transactions()
-        exodus_transactions.to_csv(f'{self.source_transactions_save_path}exodus.csv', index=False)
-        print('Got Exodus transactions!\n')
+        for source in self.wallets:
+            self.create_source_transactions(source)
+
+    def create_source_transactions(self, source):
+        """
+        Get one source's transactions and write them to its CSV in data/source_transactions/. Transactions in the
+        source's downloaded statements are added to those from its API, or with statements_only used without
+        calling the API.
+        """
+
+        name, connector, method = {**self.exchanges, **self.wallets}[source]
+
+        print(f'Getting {name} transactions...')
+        with metrics.stage(source) as stage, landing_zone.source(source):
+            if self.statements_only and self.statements.exist(source):
+                transactions = self.statements.transactions(source)
+            else:
+                transactions = getattr(connector(), method)()
+                if self.statements.exist(source):
+                    transactions = self.statements.merge(source, transactions)
+            transactions.to_csv(f'{self.source_transactions_save_path}{source}.csv', index=False)
+            stage['rows_out'] = len(transactions)
+        metrics.file_written(f'{self.source_transactions_save_path}{source}.csv')
+
+        # Failed price lookups are only written every few seconds while valuing the transactions
+        price_failures.flush()
+        print(f'Got {name} transactions!\n')
+
+    def renormalize(self, sources=None):
+        """
+        Rebuild the CSVs in data/source_transactions/ of sources (by default every source in the landing zone) from
+        their kept API responses, with no requests, then merge them again.
+
+        A source is only rebuilt if every request its connector makes has a kept response. Connectors fetching
+        incrementally start their requests from their previous CSV's last transaction, so a rebuild from scratch
+        makes requests earlier runs may never have made. If any is missing the previous CSV is restored and this
+        raises, rather than replacing it with one missing those transactions.
+        """
+
+        for path in [self.source_transactions_save_path, self.asset_transactions_save_path]:
+            os.makedirs(path, exist_ok=True)
+
+        sources = sources or landing_zone.sources()
+        with landing_zone.replay(sources) as misses:
+            for source in sources:
+                # Connectors that fetch incrementally would otherwise only add to their previous CSV
+                path = f'{self.source_transactions_save_path}{source}.csv'
+                if os.path.isfile(path):
+                    os.replace(path, path + '.old')
+
+                missed = len(misses)
+                try:
+                    self.create_source_transactions(source)
+                    if len(misses) > missed:
+                        raise RuntimeError(f'{len(misses) - missed} {source} requests had no kept response, e.g. '
+                                           f'{misses[missed]}, keeping the previous {source} transactions')
+                except BaseException:
+                    if os.path.isfile(path + '.old'):
+                        os.replace(path + '.old', path)
+                    raise
+
+                if os.path.isfile(path + '.old'):
+                    os.remove(path + '.old')
+
+        with metrics.stage('merge_transactions') as stage:
+            self.merge_transactions(stage)
+
+    def create_source_transactions_concurrently(self):
+        """
+        Run every source in its own thread with its own rate limiter. Each source's CSV is written as soon as it
+        finishes, and this returns once all of them have, so the time taken is roughly that of the slowest source.
+        """
+
+        def create(source):
+            with RateLimiter(self.rate_limits[source]).applied():
+                self.create_source_transactions(source)
+
+        sources = list(self.exchanges) + list(self.wallets)
+
+        with RateLimiter.hooked():
+            with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+                futures = {executor.submit(create, source): source for source in sources}
+
+                for future in as_completed(futures):
+                    # Raise the first source error here rather than losing it in its thread
+                    future.result()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Get every source\'s transactions and merge them by asset')
+    parser.add_argument('--renormalize', nargs='*', metavar='SOURCE',
+                        help='Rebuild the source CSVs from the landing zone, all sources by default')
+    args = parser.parse_args()
+
     x = GetAllTransactions()
-    x.get_all_transactions()
+    if args.renormalize is not None:
+        x.renormalize(args.renormalize)
+    else:
+        x.get_all_transactions()
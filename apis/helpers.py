@@ -1,298 +1,252 @@
 import os
+import math
 import requests
-from datetime import datetime, timedelta
-import mt4_hst
-from io import BytesIO
+import multiprocessing
+import numpy as np
 import pandas as pd
-from zipfile import ZipFile
+from concurrent.futures import ProcessPoolExecutor
 
-from apis.authentication import CoinbaseProAuth
+from apis.candles import RESOLUTIONS
+from apis.prices import price_router, price_failures, fiat_gbp_rate
+from apis.single_flight import SingleFlight
 
+# Actions whose final asset is valued in GBP
+EXCHANGE_ACTIONS = ['exchange_fiat_for_crypto', 'exchange_crypto_for_fiat', 'exchange_crypto_for_crypto']
 
-class Transaction:
-    def __init__(self):
-        self.transaction = {
-            'asset': None,  # Which crypto
-            'action': None,  # exchange_fiat_for_crypto, exchange_crypto_for_crypto, exchange_crypto_for_fiat, etc...
-            'type': None,  # How Coinbase categorise the action
-            'disposal': None,  # Bool - is the action considered a disposal by HMRC
-            'datetime': None,  # Datetime of the action
-            'initial_asset_quantity': None,  # Quantity of the initial asset in the action
-            'initial_asset_currency': None,  # What asset does the action begin with
-            'initial_asset_location': None,  # Where is the initial asset? wallet, exchange?
-            'initial_asset_address': None,  # Wallet address or exchange wallet id
-            'price': None,  # The exchange price if action is exchanging
-            'final_asset_quantity': None,  # Quantity of the final asset in the action
-            'final_asset_currency': None,  # What asset does the action end with
-            'final_asset_gbp': None,  # The final GBP value at the time of the action
-            'final_asset_location': None,  # Where is the final asset? wallet, exchange?
-            'final_asset_address': None,  # Wallet address or exchange wallet id
-            'fee_type': None,  # Exchange fee or transfer fee
-            'fee_quantity': None,  # How much is the fee in the issued fee currency
-            'fee_currency': None,  # The fee currency
-            'fee_gbp': None,  # GBP value of the fee at the time of the action
-            'source_transaction_id': None,  # Transaction id from the exchange/wallet where transaction occurred
-            'source_trade_id': None  # Additional id field from the exchange/wallet to help match exchanges
-        }
+# Providers tried in turn for a rate, CoinAPI last since its free tier only allows 100 requests a day
+PRICE_PROVIDERS = ['binance', 'coinbase_pro', 'coin_api']
 
+# Concurrent CoinAPI lookups of the same asset and minute share one request
+coin_api_flights = SingleFlight('coin_api')
 
-class CoinbaseConvertToGBP:
-    def __init__(self, asset, dt, quantity):
-        self.asset = asset
-        self.dt = dt
-        self.quantity = float(quantity)
-        self.api_key = os.environ.get('COINBASE_PRO_API_KEY')
-        self.api_secret = os.environ.get('COINBASE_PRO_API_SECRET')
-        self.passphrase = os.environ.get('COINBASE_PRO_API_PASSPHRASE')
-        self.base_url = 'https://api.pro.coinbase.com/'
-        self.forex_downloads = 'data/forex/'
+# Fewer raw records than this are normalised in the calling process, a pool costs more to start than it saves
+PARALLEL_NORMALIZE_MIN = 2000
 
-    def convert_to_gbp(self):
-        if not os.path.exists(f'{self.forex_downloads}'):
-            os.makedirs(f'{self.forex_downloads}')
-
-        if self.asset == 'GBP':
-            pass
-        # elif self.asset == 'EUR':
-        #     return round(self.quantity * self.get_historical_fiat_gbp_price(base='EUR'), 2)
-        elif self.asset == 'BTC':
-            quantity_usd = self.quantity * self.get_historical_btc_usd_price()
-            return quantity_usd * self.get_historical_fiat_gbp_price()
-        elif self.asset in ['EUR', 'USD']:
-            return self.quantity * self.get_historical_fiat_gbp_price(base=self.asset)
-        else:
-            quantity_btc = round(self.quantity * self.get_historical_crypto_btc_price(), 8)
-            # Must first convert to USD because most exchanges only have recent GBP prices but will have historical USD
-            quantity_usd = quantity_btc * self.get_historical_btc_usd_price()
-            return quantity_usd * self.get_historical_fiat_gbp_price()
 
-    def get_historical_crypto_btc_price(self):
-        start = self.dt
-        end = (datetime.strptime(self.dt, '%Y-%m-%d %H:%M:00') + timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:00')
+def normalize_chunk(normalize, records):
+    """
+    Return the dataframes of normalize(*record) for each of records concatenated, or None if it gave none
+    """
 
-        path = self.base_url + f'products/{self.asset}-BTC/candles'
-        params = {
-            'start': start,
-            'end': end,
-            'granularity': 60
-        }
-        auth = CoinbaseProAuth(self.api_key, self.api_secret, self.passphrase)
-        r = requests.get(path, auth=auth, params=params).json()
+    frames = [i for i in (normalize(*record) for record in records) if i is not None]
 
-        return r[0][4]
+    return pd.concat(frames) if frames else None
 
-    def get_historical_btc_usd_price(self):
-        path = self.base_url + f'products/BTC-USD/candles'
-        params = {
-            'start': f'{self.dt}',
-            'end': f'{self.dt}',
-            'granularity': 60
-        }
-        auth = CoinbaseProAuth(self.api_key, self.api_secret, self.passphrase)
-        r = requests.get(path, auth=auth, params=params).json()
 
-        return r[0][4]
+def normalize_records(normalize, records, processes=None):
+    """
+    Return the dataframes of normalize(*record) for each of records concatenated in the order of records, or None if
+    it gave none.
 
-    def get_historical_fiat_gbp_price(self, base='USD'):
-        if base == 'USDT':
-            base = 'USD'
+    Large record lists are split into chunks normalised across a pool of processes, each chunk's rows coming back as
+    one dataframe. normalize must be picklable, a module level function or a static method.
 
-        # These datasets appear to be updated weekly
-        download_urls = {
-            'EUR': (0, 'https://tools.fxdd.com/tools/M1Data/EURGBP.zip'),
-            'USD': (1, 'https://tools.fxdd.com/tools/M1Data/GBPUSD.zip')
-        }
+    The pool's processes are started from a fresh server process rather than forked from this one, as this runs in
+    the ingestion threads next to the rate cache flusher and the request hooks, and a child forked while another
+    thread holds a lock would never see it released.
+    """
 
-        if download_urls.get(base)[0]:
-            file = 'GBP' + base
-        else:
-            file = base + 'GBP'
+    records = list(records)
+    processes = processes or os.cpu_count() or 1
+    if len(records) < PARALLEL_NORMALIZE_MIN or processes == 1:
+        return normalize_chunk(normalize, records)
 
-        # Check whether or not the csv already exists
-        if file + '.csv' in os.listdir(self.forex_downloads):
-            df = pd.read_csv(self.forex_downloads + file + '.csv')
-        else:
-            # Check whether the hst download already exists
-            if file + '.hst' not in os.listdir(self.forex_downloads):
-                r = requests.get(download_urls.get(base)[1])
-                z = ZipFile(BytesIO(r.content))
-                z.extractall(self.forex_downloads)
+    # A few chunks per process so an uneven chunk does not leave the others idle
+    size = math.ceil(len(records) / (processes * 4))
+    chunks = [records[i:i + size] for i in range(0, len(records), size)]
 
-            df = mt4_hst.read_hst(self.forex_downloads + file + '.hst')
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context(method)) as executor:
+        frames = [i for i in executor.map(normalize_chunk, [normalize] * len(chunks), chunks) if i is not None]
 
-            # Get latest date in the dataframe
-            if datetime.strptime(self.dt, '%Y-%m-%d %H:%M:%S') > df.tail(2)['time'].tolist()[0]:
-                r = requests.get(download_urls.get(base)[1])
-                z = ZipFile(BytesIO(r.content))
-                z.extractall(self.forex_downloads)
+    return pd.concat(frames) if frames else None
 
-            df = mt4_hst.read_hst(self.forex_downloads + file + '.hst')
 
-            # Drop columns we don't need
-            df.drop(['open', 'high', 'low', 'volume'], axis=1, inplace=True)
+def convert_to_gbp_batch(assets, dts, quantities, exchanges):
+    """
+    Return an array of the GBP values of quantities of assets at dts, routed over markets on the given exchanges.
+    NaN where no route has prices for the time.
 
-            start_idx = df.loc[df['time'] == '2017-11-01 00:00:00'].index.values[0]
+    The batch counterpart of BinanceConvertToGBP/CoinbaseConvertToGBP: rows are grouped by asset and each route's
+    candles fetched a window at a time for all of the group's times, rather than row by row.
+    """
 
-            df = df.iloc[start_idx:]
+    return price_router.convert_batch(assets, dts, quantities, exchanges)
 
-            df['time'] = pd.to_datetime(df['time'])
-            df.set_index('time', inplace=True)
-            idx = pd.date_range(df.index.min(), df.index.max(), freq='1Min')
-            df = df.reindex(idx)
-            df.fillna(method='ffill', inplace=True)
-            df.reset_index(inplace=True)
 
-            df.to_csv(self.forex_downloads + file + '.csv', index=False)
+def gbp_rate(asset, dt, providers=None):
+    """
+    Return GBP per unit of asset at dt ('%Y-%m-%d %H:%M:00') and the candle resolution it was priced at, trying
+    each of providers (by default PRICE_PROVIDERS) in turn and raising IndexError if none has a price. Lookups known
+    to fail are skipped without a request, see PriceFailures.
+    """
 
+    errors = []
+    for provider in providers or PRICE_PROVIDERS:
         try:
-            if download_urls.get(base)[0]:
-                return 1 / df.loc[df['index'] == self.dt]['close'].tolist()[0]
-            else:
-                return df.loc[df['index'] == self.dt]['close'].tolist()[0]
-        except IndexError:  # Most recent exchange rates have not yet been added to the data source
-            url = f'https://api.ratesapi.io/api/{self.dt.split(" ")[0]}?base={base}&symbols={base},GBP'
-            r = requests.get(url)
-            if r.status_code == 200:
-                return r.json()['rates']['GBP']
-            else:
-                url = f'https://api.ratesapi.io/api/{self.dt.split(" ")[0]}?base=USD&symbols={base},GBP'
-                r = requests.get(url)
-                if r.status_code == 200:
-                    return r.json()['rates']['GBP'] / r.json()['rates'][base]
+            if provider == 'coin_api':
+                # CoinAPI is asked for the 1 minute period
+                return CoinAPIConvertToGBP(asset, dt, 1).convert_to_gbp(), '1m'
 
+            rates, resolutions = price_router.rates(asset, [dt], [provider])
+            if np.isnan(rates[0]):
+                raise IndexError(f'No route with prices for {asset} at {dt} on {provider}')
 
-class BinanceConvertToGBP:
-    def __init__(self, asset, dt, quantity):
-        self.asset = asset
-        self.dt = dt
-        self.quantity = float(quantity)
-        self.base_url = 'https://api.binance.com'
-        self.forex_downloads = 'data/forex/'
-        self.rates_api_access_key = os.environ.get('RATES_API_ACCESS_KEY')
+            return float(rates[0]), resolutions[0]
+        except IndexError as e:
+            errors.append(str(e))
 
-    def convert_to_gbp(self):
-        if not os.path.exists(f'{self.forex_downloads}'):
-            os.makedirs(f'{self.forex_downloads}')
+    raise IndexError(f'No price for {asset} at {dt}: {errors}')
 
-        if self.asset == 'GBP':
-            pass
-        elif self.asset == 'BTC':
-            quantity_usd = self.quantity * self.get_historical_btc_usd_price()
-            quantity_gbp = quantity_usd * self.get_historical_fiat_gbp_price()
-            return quantity_gbp
-        elif self.asset in ['EUR', 'USD', 'USDT']:
-            quantity_gbp = self.quantity * self.get_historical_fiat_gbp_price(base=self.asset)
-            return quantity_gbp
-        else:
-            quantity_btc = round(self.quantity * self.get_historical_crypto_btc_price(), 8)
-            # Must first convert to USD because most exchanges only have recent GBP prices but will have historical USD
-            quantity_usd = quantity_btc * self.get_historical_btc_usd_price()
-            quantity_gbp = quantity_usd * self.get_historical_fiat_gbp_price()
-            return quantity_gbp
 
-    def get_historical_crypto_btc_price(self):
-        path = '/api/v3/klines'
+def convert_to_gbp(asset, dt, quantity, providers=None):
+    """
+    Return the GBP value of quantity of asset at dt ('%Y-%m-%d %H:%M:00'), see gbp_rate
+    """
 
-        start_timestamp = int(datetime.timestamp(datetime.strptime(self.dt, '%Y-%m-%d %H:%M:00')))
-        end_timestamp = int(datetime.timestamp((datetime.strptime(self.dt, '%Y-%m-%d %H:%M:00')) + timedelta(minutes=1000)))
+    return float(quantity) * gbp_rate(asset, dt, providers)[0]
 
-        params = {
-            'symbol': f'{self.asset}BTC',
-            'interval': '1m',
-            'startTime': start_timestamp*1000,
-            'endTime': end_timestamp*1000,
-            'limit': 1000
-        }
 
-        r = requests.get(self.base_url + path, params=params).json()
+def coarsest(first, second):
+    """
+    Return the coarser of two candle resolutions, '' counting as finest
+    """
 
-        return float(r[0][4])
+    return max(first, second, key=lambda i: RESOLUTIONS.get(i, 0))
 
-    def get_historical_btc_usd_price(self):
-        path = '/api/v3/klines'
 
-        start_timestamp = int(datetime.timestamp(datetime.strptime(self.dt, '%Y-%m-%d %H:%M:00')))
-        end_timestamp = int(
-            datetime.timestamp((datetime.strptime(self.dt, '%Y-%m-%d %H:%M:00')) + timedelta(minutes=1000)))
+def convert_columns_to_gbp(df, rate_cache, exchanges):
+    """
+    Return the final_asset_gbp, fee_gbp and price_resolution columns for a connector's transactions, with the count
+    of rates converted and the count read from rate_cache.
 
-        params = {
-            'symbol': 'BTCUSDT',
-            'interval': '1m',
-            'startTime': start_timestamp * 1000,
-            'endTime': end_timestamp * 1000,
-            'limit': 1000
-        }
+    final_asset_gbp is only set for exchange actions without one and fee_gbp where there is a fee currency, GBP
+    amounts are carried over as they are. Rates missing from rate_cache are converted in one batch over exchanges
+    and added to it, any the exchanges have no prices for through the other providers, raising IndexError if none
+    has a price. price_resolution is the coarsest candle resolution a row's values were priced at, '' when none
+    were priced from candles.
+    """
 
-        r = requests.get(self.base_url + path, params=params).json()
+    minutes = pd.to_datetime(df['datetime']).dt.strftime('%Y-%m-%d %H:%M:00').to_numpy()
 
-        return float(r[0][4])
+    final_currency = df['final_asset_currency'].to_numpy()
+    fee_currency = df['fee_currency'].to_numpy()
+    final_quantity = df['final_asset_quantity'].to_numpy(dtype=np.float64)
+    fee_quantity = df['fee_quantity'].to_numpy(dtype=np.float64)
 
-    def get_historical_fiat_gbp_price(self, base='USD'):
-        if base == 'USDT':
-            base = 'USD'
+    # Values the source already gave in GBP are kept
+    given_gbp = df['final_asset_gbp'].notna().to_numpy()
+    exchange_rows = df['action'].isin(EXCHANGE_ACTIONS).to_numpy() & ~given_gbp
+    fee_rows = df['fee_currency'].notna().to_numpy()
 
-        # These datasets appear to be updated weekly
-        download_urls = {
-            'EUR': (0, 'https://tools.fxdd.com/tools/M1Data/EURGBP.zip'),
-            'USD': (1, 'https://tools.fxdd.com/tools/M1Data/GBPUSD.zip')
-        }
+    final_rows = exchange_rows & (final_currency != 'GBP')
+    fee_rows_converted = fee_rows & (fee_currency != 'GBP') & (fee_quantity != 0.0)
 
-        if download_urls.get(base)[0]:
-            file = 'GBP' + base
-        else:
-            file = base + 'GBP'
+    # Every (asset, minute) needing a rate, deduplicated so each is converted once
+    needed = pd.DataFrame({
+        'asset': np.concatenate([final_currency[final_rows], fee_currency[fee_rows_converted]]),
+        'datetime': np.concatenate([minutes[final_rows], minutes[fee_rows_converted]])
+    }).drop_duplicates()
 
-        # Check whether or not the csv already exists
-        if file + '.csv' in os.listdir(self.forex_downloads):
-            df = pd.read_csv(self.forex_downloads + file + '.csv')
-        else:
-            # Check whether the hst download already exists
-            if file + '.hst' not in os.listdir(self.forex_downloads):
-                r = requests.get(download_urls.get(base)[1])
-                z = ZipFile(BytesIO(r.content))
-                z.extractall(self.forex_downloads)
+    def cached_rates(assets, dts):
+        rates = np.full(len(assets), np.nan)
+        resolutions = np.full(len(assets), '', dtype=object)
+        for asset in pd.unique(assets):
+            rows = assets == asset
+            rates[rows], resolutions[rows] = rate_cache.lookup(asset, dts[rows])
+        return rates, resolutions
 
-            df = mt4_hst.read_hst(self.forex_downloads + file + '.hst')
+    needed_rates = cached_rates(needed['asset'].to_numpy(), needed['datetime'].to_numpy())[0]
+    cached = ~np.isnan(needed_rates) & (needed_rates != 0)
+    uncached = needed[~cached]
 
-            # Get latest date in the dataframe
-            if datetime.strptime(self.dt, '%Y-%m-%d %H:%M:%S') > df.tail(2)['time'].tolist()[0]:
-                r = requests.get(download_urls.get(base)[1])
-                z = ZipFile(BytesIO(r.content))
-                z.extractall(self.forex_downloads)
+    if len(uncached):
+        rates, resolutions = convert_to_gbp_batch(uncached['asset'].to_numpy(), uncached['datetime'].to_numpy(),
+                                                  np.ones(len(uncached)), exchanges)
 
-            df = mt4_hst.read_hst(self.forex_downloads + file + '.hst')
+        # Fall back to the other providers for the rates the connector's exchanges have no prices for
+        fallback = [i for i in PRICE_PROVIDERS if i not in exchanges]
+        for i in np.flatnonzero(np.isnan(rates)):
+            rates[i], resolutions[i] = gbp_rate(uncached['asset'].iloc[i], uncached['datetime'].iloc[i], fallback)
 
-            # Drop columns we don't need
-            df.drop(['open', 'high', 'low', 'volume'], axis=1, inplace=True)
+        for asset, datetime, rate, resolution in zip(uncached['asset'], uncached['datetime'], rates, resolutions):
+            rate_cache.set(asset, datetime, float(rate), resolution)
 
-            start_idx = df.loc[df['time'] == '2017-11-01 00:00:00'].index.values[0]
+    def rates_for(rows, currency):
+        return cached_rates(currency[rows], minutes[rows])
 
-            df = df.iloc[start_idx:]
+    final_asset_gbp = np.where(given_gbp, df['final_asset_gbp'].to_numpy(dtype=object), None)
+    final_asset_gbp[exchange_rows] = final_quantity[exchange_rows]
+    fee_gbp = np.full(len(df), None, dtype=object)
+    fee_gbp[fee_rows] = fee_quantity[fee_rows]
 
-            df['time'] = pd.to_datetime(df['time'])
-            df.set_index('time', inplace=True)
-            idx = pd.date_range(df.index.min(), df.index.max(), freq='1Min')
-            df = df.reindex(idx)
-            df.fillna(method='ffill', inplace=True)
-            df.reset_index(inplace=True)
+    final_resolution = np.full(len(df), '', dtype=object)
+    fee_resolution = np.full(len(df), '', dtype=object)
 
-            df.to_csv(self.forex_downloads + file + '.csv', index=False)
+    rates, final_resolution[final_rows] = rates_for(final_rows, final_currency)
+    final_asset_gbp[final_rows] = rates * final_quantity[final_rows]
+    rates, fee_resolution[fee_rows_converted] = rates_for(fee_rows_converted, fee_currency)
+    fee_gbp[fee_rows_converted] = rates * fee_quantity[fee_rows_converted]
 
-        try:
-            if download_urls.get(base)[0]:
-                return 1 / df.loc[df['index'] == self.dt]['close'].tolist()[0]
-            else:
-                return df.loc[df['index'] == self.dt]['close'].tolist()[0]
-        except IndexError:  # Most recent exchange rates have not yet been added to the data source
-            url = f'http://api.exchangeratesapi.io/v1/{self.dt.split(" ")[0]}?symbols={base},GBP&access_key={self.rates_api_access_key}'
-            r = requests.get(url)
-            if r.status_code == 200:
-                return r.json()['rates']['GBP']
-            else:
-                url = f'http://api.exchangeratesapi.io/v1/{self.dt.split(" ")[0]}?symbols={base},GBP&access_key={self.rates_api_access_key}'
-                r = requests.get(url)
-                if r.status_code == 200:
-                    return r.json()['rates']['GBP']
+    price_resolution = [coarsest(i, j) for i, j in zip(final_resolution, fee_resolution)]
+
+    return list(final_asset_gbp), list(fee_gbp), price_resolution, len(uncached), int(cached.sum())
+
+
+class Transaction:
+    def __init__(self):
+        self.transaction = {
+            'asset': None,  # Which crypto
+            'action': None,  # exchange_fiat_for_crypto, exchange_crypto_for_crypto, exchange_crypto_for_fiat, etc...
+            'type': None,  # How Coinbase categorise the action
+            'disposal': None,  # Bool - is the action considered a disposal by HMRC
+            'datetime': None,  # Datetime of the action
+            'initial_asset_quantity': None,  # Quantity of the initial asset in the action
+            'initial_asset_currency': None,  # What asset does the action begin with
+            'initial_asset_location': None,  # Where is the initial asset? wallet, exchange?
+            'initial_asset_address': None,  # Wallet address or exchange wallet id
+            'price': None,  # The exchange price if action is exchanging
+            'final_asset_quantity': None,  # Quantity of the final asset in the action
+            'final_asset_currency': None,  # What asset does the action end with
+            'final_asset_gbp': None,  # The final GBP value at the time of the action
+            'final_asset_location': None,  # Where is the final asset? wallet, exchange?
+            'final_asset_address': None,  # Wallet address or exchange wallet id
+            'fee_type': None,  # Exchange fee or transfer fee
+            'fee_quantity': None,  # How much is the fee in the issued fee currency
+            'fee_currency': None,  # The fee currency
+            'fee_gbp': None,  # GBP value of the fee at the time of the action
+            'price_resolution': None,  # Candle resolution the GBP values were priced from: 1m, 1h or 1d
+            'source_transaction_id': None,  # Transaction id from the exchange/wallet where transaction occurred
+            'source_trade_id': None  # Additional id field from the exchange/wallet to help match exchanges
+        }
+
+
+class CoinbaseConvertToGBP:
+    def __init__(self, asset, dt, quantity):
+        self.asset = asset
+        self.dt = dt
+        self.quantity = float(quantity)
+
+    def convert_to_gbp(self):
+        if self.asset == 'GBP':
+            pass
+        else:
+            # Route over the Coinbase Pro markets, e.g. directly to GBP where a GBP market exists
+            return price_router.convert(self.asset, self.dt, self.quantity, exchanges=['coinbase_pro'])
+
+
+class BinanceConvertToGBP:
+    def __init__(self, asset, dt, quantity):
+        self.asset = asset
+        self.dt = dt
+        self.quantity = float(quantity)
+
+    def convert_to_gbp(self):
+        if self.asset == 'GBP':
+            pass
+        else:
+            # Route over the Binance markets, raises IndexError when no route has candles for the time
+            return price_router.convert(self.asset, self.dt, self.quantity, exchanges=['binance'])
 
 
 class CoinAPIConvertToGBP:
@@ -302,18 +256,17 @@ class CoinAPIConvertToGBP:
         self.quantity = float(quantity)
         self.coin_api_key = os.environ.get('COIN_API_KEY')
         self.base_url = 'https://rest.coinapi.io'
-        self.forex_downloads = 'data/forex/'
 
     def convert_to_gbp(self):
-        if not os.path.exists(f'{self.forex_downloads}'):
-            os.makedirs(f'{self.forex_downloads}')
-
         quantity_usd = self.quantity * self.get_historical_btc_usd_price()
         quantity_gbp = quantity_usd * self.get_historical_fiat_gbp_price()
 
         return quantity_gbp
 
     def get_historical_btc_usd_price(self):
+        return coin_api_flights.do((self.asset, self.dt), self.fetch_historical_usd_price)
+
+    def fetch_historical_usd_price(self):
         headers = {
             'X-CoinAPI-Key': self.coin_api_key
         }
@@ -328,79 +281,33 @@ class CoinAPIConvertToGBP:
             'time_start': self.dt.replace(' ', 'T')
         }
 
-        r = requests.get(self.base_url + path, headers=headers, params=params).json()
-
-        return r[0]['price_close']
+        key = f'coin_api {symbol_id} {self.dt}'
+        failure = price_failures.get(key)
+        if failure:
+            raise IndexError(f'{key}: {failure["reason"]}')
 
-    def get_historical_fiat_gbp_price(self, base='USD'):
-        if base == 'USDT':
-            base = 'USD'
-
-        # These datasets appear to be updated weekly
-        download_urls = {
-            'EUR': (0, 'https://tools.fxdd.com/tools/M1Data/EURGBP.zip'),
-            'USD': (1, 'https://tools.fxdd.com/tools/M1Data/GBPUSD.zip')
-        }
-
-        if download_urls.get(base)[0]:
-            file = 'GBP' + base
-        else:
-            file = base + 'GBP'
-
-        # Check whether or not the csv already exists
-        if file + '.csv' in os.listdir(self.forex_downloads):
-            df = pd.read_csv(self.forex_downloads + file + '.csv')
-        else:
-            # Check whether the hst download already exists
-            if file + '.hst' not in os.listdir(self.forex_downloads):
-                r = requests.get(download_urls.get(base)[1])
-                z = ZipFile(BytesIO(r.content))
-                z.extractall(self.forex_downloads)
-
-            df = mt4_hst.read_hst(self.forex_downloads + file + '.hst')
-
-            # Get latest date in the dataframe
-            if datetime.strptime(self.dt, '%Y-%m-%d %H:%M:%S') > df.tail(2)['time'].tolist()[0]:
-                r = requests.get(download_urls.get(base)[1])
-                z = ZipFile(BytesIO(r.content))
-                z.extractall(self.forex_downloads)
-
-            df = mt4_hst.read_hst(self.forex_downloads + file + '.hst')
-
-            # Drop columns we don't need
-            df.drop(['open', 'high', 'low', 'volume'], axis=1, inplace=True)
-
-            start_idx = df.loc[df['time'] == '2017-11-01 00:00:00'].index.values[0]
+        minute = np.datetime64(self.dt.replace(' ', 'T'), 'm')
+        try:
+            r = requests.get(self.base_url + path, headers=headers, params=params).json()
+        except (requests.RequestException, ValueError) as e:
+            price_failures.add(key, str(e), price_failures.ttl(minute, error=True))
+            raise IndexError(f'{key}: {e}')
 
-            df = df.iloc[start_idx:]
+        if not isinstance(r, list):
+            # Error response, e.g. an unknown symbol or the daily request limit
+            price_failures.add(key, str(r.get('error', r)), price_failures.ttl(minute, error=True))
+            raise IndexError(f'{key}: {r.get("error", r)}')
 
-            df['time'] = pd.to_datetime(df['time'])
-            df.set_index('time', inplace=True)
-            idx = pd.date_range(df.index.min(), df.index.max(), freq='1Min')
-            df = df.reindex(idx)
-            df.fillna(method='ffill', inplace=True)
-            df.reset_index(inplace=True)
+        if not r:
+            price_failures.add(key, 'No candles', price_failures.ttl(minute))
+            raise IndexError(f'{key}: No candles')
 
-            df.to_csv(self.forex_downloads + file + '.csv', index=False)
+        return r[0]['price_close']
 
-        try:
-            if download_urls.get(base)[0]:
-                return 1 / df.loc[df['index'] == self.dt]['close'].tolist()[0]
-            else:
-                return df.loc[df['index'] == self.dt]['close'].tolist()[0]
-        except IndexError:  # Most recent exchange rates have not yet been added to the data source
-            url = f'https://api.ratesapi.io/api/{self.dt.split(" ")[0]}?base={base}&symbols={base},GBP'
-            r = requests.get(url)
-            if r.status_code == 200:
-                return r.json()['rates']['GBP']
-            else:
-                url = f'https://api.ratesapi.io/api/{self.dt.split(" ")[0]}?base=USD&symbols={base},GBP'
-                r = requests.get(url)
-                if r.status_code == 200:
-                    return r.json()['rates']['GBP'] / r.json()['rates'][base]
+    def get_historical_fiat_gbp_price(self, base='USD'):
+        return fiat_gbp_rate(base, self.dt)
 
 
 if __name__ == '__main__':
     x = BinanceConvertToGBP('USD', '2021-07-20 19:45:00', 49.7)
-    # x.convert_to_gbp()
-    x.get_historical_fiat_gbp_price()
+    print(x.convert_to_gbp())
@@ -0,0 +1,125 @@
+import os
+import re
+import json
+import zipfile
+import argparse
+import numpy as np
+import pandas as pd
+
+from apis.candles import RESOLUTIONS, candle_store
+from metrics import metrics
+
+# Archive names as Binance publishes them, e.g. BTCGBP-1m-2021-03.zip (monthly) or BTCGBP-1m-2021-03-14.zip (daily)
+ARCHIVE_NAME = re.compile(r'^(?P<symbol>[A-Z0-9]+)-(?P<resolution>\w+)-(?P<period>\d{4}-\d{2}(-\d{2})?)\.zip$')
+
+
+def archive_range(period):
+    """
+    Return the first minute of the month ('%Y-%m') or day ('%Y-%m-%d') an archive holds and the first minute after it
+    """
+
+    if len(period) == 7:
+        start = np.datetime64(period, 'M')
+        return start.astype('datetime64[m]'), (start + 1).astype('datetime64[m]')
+
+    start = np.datetime64(period, 'D')
+    return start.astype('datetime64[m]'), (start + 1).astype('datetime64[m]')
+
+
+def open_times(values):
+    """
+    Return kline open times as datetime64[m]. Archives give them in milliseconds, the newer ones in microseconds.
+    """
+
+    values = values.astype(np.int64)
+    unit = 'datetime64[us]' if len(values) and values[0] > 10 ** 14 else 'datetime64[ms]'
+
+    return values.astype(unit).astype('datetime64[m]')
+
+
+class KlineArchives:
+    """
+    Imports the public Binance kline archives (data.binance.vision, spot/monthly/klines or spot/daily/klines) from a
+    local directory into the candle store, so history is priced from disk with no candle requests.
+
+    Each zip holds one CSV of klines, open time first and close fifth. It is read a chunk of rows at a time straight
+    from the zip and each chunk's candles added to the store along with the range they cover, so an interrupted
+    import resumes where it stopped. Archives the store already covers are skipped.
+    """
+
+    provider = 'binance'
+    chunk_rows = 50000
+
+    def __init__(self, store=None):
+        self.store = store or candle_store
+
+    def import_directory(self, path):
+        """
+        Import every archive under path, returning counts of the archives imported, skipped and not recognised, and
+        of the candles added
+        """
+
+        counts = {'imported': 0, 'skipped': 0, 'unrecognised': 0, 'candles': 0}
+        for root, _, files in os.walk(path):
+            for name in sorted(files):
+                match = ARCHIVE_NAME.match(name)
+                if not match or match['resolution'] not in RESOLUTIONS:
+                    counts['unrecognised'] += name.endswith('.zip')
+                    continue
+
+                start, end = archive_range(match['period'])
+                if self.store.covered(KlineArchives.provider, match['symbol'], match['resolution'], [start], [end])[0]:
+                    counts['skipped'] += 1
+                    continue
+
+                counts['candles'] += self.import_archive(os.path.join(root, name), match['symbol'],
+                                                         match['resolution'], start, end)
+                counts['imported'] += 1
+
+        return counts
+
+    def import_archive(self, path, symbol, resolution, start, end):
+        """
+        Stream one archive's klines into the store, returning the number of candles added
+        """
+
+        key = (KlineArchives.provider, symbol, resolution)
+        added = 0
+
+        with zipfile.ZipFile(path) as archive:
+            for member in archive.namelist():
+                with archive.open(member) as f:
+                    # Only the open time and close are read, the header some archives have is dropped as unparsable
+                    chunks = pd.read_csv(f, header=None, usecols=[0, 4], names=['open_time', 'close'],
+                                         chunksize=KlineArchives.chunk_rows)
+
+                    for chunk in chunks:
+                        open_time = pd.to_numeric(chunk['open_time'], errors='coerce')
+                        rows = open_time.notna()
+                        if not rows.any():
+                            continue
+
+                        times = open_times(open_time[rows].to_numpy())
+                        closes = pd.to_numeric(chunk['close'][rows]).to_numpy(dtype=np.float64)
+
+                        chunk_end = times.max() + np.timedelta64(RESOLUTIONS[resolution], 'm')
+                        self.store.add(*key, start, chunk_end, times, closes)
+
+                        start = chunk_end
+                        added += len(times)
+
+        # Minutes after the last kline, e.g. a market delisted mid month, have no candles but are covered
+        if start < end:
+            self.store.add(*key, start, end, [], [])
+
+        metrics.file_read(path)
+
+        return added
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import downloaded Binance kline archives into the candle store')
+    parser.add_argument('path', help='Directory of <SYMBOL>-<resolution>-<period>.zip archives, searched recursively')
+    args = parser.parse_args()
+
+    print(json.dumps(KlineArchives().import_directory(args.path)))
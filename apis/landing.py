@@ -0,0 +1,206 @@
+import os
+import gzip
+import json
+import threading
+import requests
+from contextlib import contextmanager
+from datetime import datetime as dt
+
+from apis.cassette import request_key
+from metrics import metrics, endpoint_name
+
+
+class LandingZone:
+    """
+    Append-only store of the raw API responses each source's transactions were normalised from, so normalisation
+    can be rerun from disk after a fix without fetching anything again.
+
+    Responses are kept as gzip JSON lines under data/landing/<source>/<endpoint>.jsonl.gz, one file per endpoint
+    (e.g. api.coinbase.com_v2_accounts_id_transactions) with each response's request key, status, time and body.
+    Requests are recorded while hooked() is active for the threads inside source(), and appended to the files when
+    the source is done, so every run adds to what earlier runs kept. Only the source's own endpoints are kept, and
+    only JSON responses. Pricing requests made on the same threads (candles, tickers, forex downloads) are not.
+
+    replay() answers the sources' own endpoints from the store instead of the network, with the latest response
+    kept for each request. Requests it has no response for are answered with a 404 and an empty JSON list, as
+    CassetteServer does. Every other request goes to the network as usual.
+    """
+
+    path = 'data/landing/'
+    local = threading.local()
+
+    # Endpoints (see endpoint_name) each source's connector calls, those ending in / cover every endpoint under them
+    endpoints = {
+        'binance': ['api.binance.com/api/v3/exchangeInfo', 'api.binance.com/api/v3/myTrades',
+                    'api.binance.com/sapi/v1/capital/deposit/hisrec',
+                    'api.binance.com/sapi/v1/capital/withdraw/history', 'api.binance.com/sapi/v1/asset/dribblet',
+                    'api.binance.com/sapi/v1/asset/assetDividend'],
+        'coinbase': ['api.coinbase.com/v2/'],
+        'coinbase_pro': ['api.pro.coinbase.com/products', 'api.pro.coinbase.com/accounts',
+                         'api.pro.coinbase.com/fills', 'api.pro.coinbase.com/transfers']
+    }
+
+    def __init__(self, path=None):
+        self.path = path or LandingZone.path
+
+    @staticmethod
+    def kept(sources, url):
+        """
+        Return whether url is one of the endpoints of sources' connectors
+        """
+
+        name = endpoint_name(url)
+
+        return any(name == i or (i.endswith('/') and name.startswith(i))
+                   for source in sources for i in LandingZone.endpoints.get(source, []))
+
+    @staticmethod
+    def file_name(url):
+        return endpoint_name(url).replace('{id}', 'id').replace('/', '_') + '.jsonl.gz'
+
+    def sources(self):
+        if not os.path.isdir(self.path):
+            return []
+
+        return sorted(i for i in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, i)))
+
+    @contextmanager
+    def source(self, source):
+        """
+        Record the current thread's requests as source's until the block ends, then append them to the store
+        """
+
+        LandingZone.local.source = source
+        LandingZone.local.responses = {}
+        try:
+            yield
+        finally:
+            responses = LandingZone.local.responses
+            LandingZone.local.source = None
+            LandingZone.local.responses = None
+            self.append(source, responses)
+
+    @staticmethod
+    @contextmanager
+    def hooked():
+        """
+        Keep the responses to requests made inside source() until the block ends
+        """
+
+        original_send = requests.Session.send
+
+        def send(session, request, **kwargs):
+            response = original_send(session, request, **kwargs)
+
+            responses = getattr(LandingZone.local, 'responses', None)
+            if responses is not None and LandingZone.kept([LandingZone.local.source], request.url):
+                entry = LandingZone.entry(request, response)
+                if entry is not None:
+                    responses.setdefault(LandingZone.file_name(request.url), []).append(entry)
+
+            return response
+
+        requests.Session.send = send
+        try:
+            yield
+        finally:
+            requests.Session.send = original_send
+
+    @staticmethod
+    def entry(request, response):
+        """
+        Return what is kept of a response, or None if its body is not JSON
+        """
+
+        try:
+            body = response.json()
+        except ValueError:
+            return None
+
+        return {
+            'key': request_key(request.method, request.url),
+            'status': response.status_code,
+            'fetched': dt.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+            'json': body
+        }
+
+    def append(self, source, responses):
+        if not responses:
+            return
+
+        directory = os.path.join(self.path, source)
+        os.makedirs(directory, exist_ok=True)
+
+        # Each append adds a gzip member, readers see the members of a file as one stream
+        for name, entries in responses.items():
+            path = os.path.join(directory, name)
+            with gzip.open(path, 'at', encoding='utf-8') as f:
+                for entry in entries:
+                    f.write(json.dumps(entry) + '\n')
+            metrics.file_written(path)
+
+    def load(self, sources):
+        """
+        Return the latest response kept for each request key of sources
+        """
+
+        latest = {}
+        for source in sources:
+            directory = os.path.join(self.path, source)
+            if not os.path.isdir(directory):
+                continue
+
+            for name in sorted(os.listdir(directory)):
+                path = os.path.join(directory, name)
+                with gzip.open(path, 'rt', encoding='utf-8') as f:
+                    for line in f:
+                        entry = json.loads(line)
+                        latest[entry['key']] = entry
+                metrics.file_read(path)
+
+        return latest
+
+    @contextmanager
+    def replay(self, sources):
+        """
+        Answer requests to sources' endpoints from their kept responses until the block ends, yielding the list of
+        request keys that had none
+        """
+
+        latest = self.load(sources)
+        misses = []
+        original_send = requests.Session.send
+
+        def send(session, request, **kwargs):
+            if not LandingZone.kept(sources, request.url):
+                return original_send(session, request, **kwargs)
+
+            key = request_key(request.method, request.url)
+            entry = latest.get(key)
+            if entry is None:
+                misses.append(key)
+
+            response = requests.Response()
+            response.status_code = 404 if entry is None else entry['status']
+            response.headers['Content-Type'] = 'application/json'
+            if entry is None:
+                response._content = b'[]'
+            elif 'json' in entry:
+                response._content = json.dumps(entry['json']).encode('utf-8')
+            else:
+                response._content = entry['text'].encode('utf-8')
+            response.encoding = 'utf-8'
+            response.url = request.url
+            response.request = request
+
+            return response
+
+        requests.Session.send = send
+        try:
+            yield misses
+        finally:
+            requests.Session.send = original_send
+
+
+# Shared by every source's ingestion so each run's responses are kept together
+landing_zone = LandingZone()
@@ -0,0 +1,64 @@
+import numpy as np
+
+# MT4 history (.hst) files are a 148 byte header followed by fixed size bar records
+HEADER_DTYPE = np.dtype([
+    ('version', '<i4'),
+    ('copyright', 'S64'),
+    ('symbol', 'S12'),
+    ('period', '<i4'),
+    ('digits', '<i4'),
+    ('timesign', '<i4'),
+    ('last_sync', '<i4'),
+    ('unused', '<i4', 13)
+])
+
+RECORD_DTYPES = {
+    400: np.dtype([('time', '<u4'), ('open', '<f8'), ('low', '<f8'), ('high', '<f8'), ('close', '<f8'),
+                   ('volume', '<f8')]),
+    401: np.dtype([('time', '<i8'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'), ('close', '<f8'),
+                   ('tick_volume', '<i8'), ('spread', '<i4'), ('real_volume', '<i8')])
+}
+
+
+def read_hst_header(path):
+    header = np.fromfile(path, dtype=HEADER_DTYPE, count=1)[0]
+
+    return {
+        'version': int(header['version']),
+        'symbol': header['symbol'].split(b'\x00')[0].decode('ascii'),
+        'period': int(header['period']),
+        'digits': int(header['digits'])
+    }
+
+
+def read_hst(path, start=None):
+    """
+    Return the bar times (datetime64[s]) and closes of a .hst file from the first bar at or after start.
+
+    The records are memory mapped and the first bar found by binary search on the time field, so only the pages
+    from start onwards are read and only the time and close fields of those bars are copied out.
+    """
+
+    version = read_hst_header(path)['version']
+    if version not in RECORD_DTYPES:
+        raise ValueError(f'Unsupported .hst version {version} in {path}')
+
+    records = np.memmap(path, dtype=RECORD_DTYPES[version], mode='r', offset=HEADER_DTYPE.itemsize)
+
+    first = 0
+    if start is not None:
+        # Searched with a value of the field's own type, anything else has NumPy copy the whole time column to
+        # compare, and clamped into its range (v400 times are unsigned 32 bit)
+        time = records['time']
+        limits = np.iinfo(time.dtype)
+        value = min(max(int(np.datetime64(start, 's').astype(np.int64)), limits.min), limits.max)
+        first = int(np.searchsorted(time, time.dtype.type(value), side='left'))
+        del time
+
+    times = np.array(records['time'][first:], dtype=np.int64).astype('datetime64[s]')
+    close = np.array(records['close'][first:], dtype=np.float64)
+
+    # Release the mapping so the file can be removed straight away
+    del records
+
+    return times, close
@@ -0,0 +1,655 @@
+import os
+import json
+import time
+import argparse
+import threading
+import requests
+import numpy as np
+import pandas as pd
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+
+from apis.authentication import CoinbaseProAuth
+from apis.candles import RESOLUTIONS, candle_store
+from apis.forex import forex_cache, daily_rates
+from apis.single_flight import SingleFlight
+from metrics import metrics
+
+# A market, liquidity being the number of trades in the last 24 hours where the exchange reports it
+Market = namedtuple('Market', ['exchange', 'symbol', 'base', 'quote', 'liquidity'])
+
+# Liquidity of a market no longer trading, below that of any trading market
+DELISTED = -1
+
+# Fiat currencies a route can end in, GBP directly and the others through the forex data
+FIAT = ['GBP', 'USD', 'EUR']
+
+# Stablecoins priced as the fiat currency they track
+FIAT_EQUIVALENTS = {
+    'USDT': 'USD',
+    'USDC': 'USD',
+    'BUSD': 'USD'
+}
+
+
+def fiat_gbp_rate(base, dt):
+    """
+    Return GBP per unit of a fiat currency (or stablecoin) at dt ('%Y-%m-%d %H:%M:%S')
+    """
+
+    base = FIAT_EQUIVALENTS.get(base, base)
+    if base == 'GBP':
+        return 1.0
+
+    # FXDD quote USD as GBPUSD and EUR as EURGBP
+    pair = 'GBP' + base if base == 'USD' else base + 'GBP'
+
+    close = forex_cache.close(pair, dt)
+    if close is not None:
+        return 1 / close if pair.startswith('GBP') else close
+
+    # Most recent exchange rates have not yet been added to the data source
+    return daily_rates.rate(dt.split(' ')[0], base)
+
+
+def fiat_gbp_rates(base, dts):
+    """
+    Return an array of GBP per unit of a fiat currency (or stablecoin) at each of dts, looking up the daily rate
+    once per date for times the minute data does not cover
+    """
+
+    base = FIAT_EQUIVALENTS.get(base, base)
+    minutes = np.asarray(dts, dtype='datetime64[s]').astype('datetime64[m]')
+    if base == 'GBP':
+        return np.ones(len(minutes))
+
+    pair = 'GBP' + base if base == 'USD' else base + 'GBP'
+
+    closes = forex_cache.closes(pair, minutes)
+    result = 1 / closes if pair.startswith('GBP') else closes
+
+    missing = np.isnan(result)
+    if missing.any():
+        days = minutes[missing].astype('datetime64[D]')
+        for day in np.unique(days):
+            rate = daily_rates.rate(str(day), base)
+            result[np.flatnonzero(missing)[days == day]] = np.nan if rate is None else rate
+
+    return result
+
+
+class PriceFailures:
+    """
+    Price lookups that failed or came back empty, persisted to data/price_failures.json with the reason and when
+    they expire so later runs skip them and go straight to the next provider.
+
+    Entries are keyed by provider, market and time, e.g. 'binance ETHGBP 2019-05-01T10:00'. Empty results for times
+    more than a day old expire after empty_ttl since they will not fill in later, more recent ones after
+    recent_ttl, and errors (invalid symbols, HTTP errors) after error_ttl.
+
+    Failures are written to the file at most every save_interval seconds as they are added, and flush() writes any
+    still unsaved, so a run with many failed windows rewrites the file a bounded number of times.
+    """
+
+    path = 'data/price_failures.json'
+    empty_ttl = timedelta(days=30)
+    recent_ttl = timedelta(hours=1)
+    error_ttl = timedelta(hours=6)
+    save_interval = 5
+
+    def __init__(self, path=None):
+        self.path = path or PriceFailures.path
+        self.failures = None
+        self.unsaved = False
+        self.saved = time.monotonic()
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.failures is None:
+            self.failures = {}
+            if os.path.isfile(self.path):
+                with open(self.path) as j:
+                    self.failures = json.load(j)
+                metrics.file_read(self.path)
+
+        return self.failures
+
+    def get(self, key):
+        """
+        Return the failure recorded for key as {'reason', 'expires', ...}, or None if there is none in date
+        """
+
+        with self.lock:
+            failure = self.load().get(key)
+            if failure and datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S') < failure['expires']:
+                metrics.cache('price_failures', hits=1)
+                return failure
+
+        metrics.cache('price_failures', misses=1)
+        return None
+
+    def add(self, key, reason, ttl, **details):
+        with self.lock:
+            failures = self.load()
+            now = datetime.utcnow()
+
+            # Drop expired entries so the file does not only grow
+            for k in [k for k, v in failures.items() if v['expires'] <= now.strftime('%Y-%m-%d %H:%M:%S')]:
+                del failures[k]
+
+            failures[key] = {'reason': reason, 'expires': (now + ttl).strftime('%Y-%m-%d %H:%M:%S'), **details}
+            self.unsaved = True
+
+            if time.monotonic() - self.saved >= PriceFailures.save_interval:
+                self.save()
+
+    def flush(self):
+        """
+        Write the failures added since the last save
+        """
+
+        with self.lock:
+            if self.unsaved:
+                self.save()
+
+    def save(self):
+        """
+        Write every failure to the file. Called with the lock held.
+        """
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.failures, f, indent=4, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
+        metrics.file_written(self.path)
+
+        self.unsaved = False
+        self.saved = time.monotonic()
+
+    def ttl(self, end, error=False):
+        """
+        Return how long to remember a failed lookup of times before end (datetime64)
+        """
+
+        if error:
+            return PriceFailures.error_ttl
+
+        recent = np.datetime64(datetime.utcnow() - timedelta(days=1), 'm')
+
+        return PriceFailures.recent_ttl if end > recent else PriceFailures.empty_ttl
+
+
+class PairGraph:
+    """
+    Graph of the markets on Binance (exchangeInfo) and Coinbase Pro (products), with assets as nodes.
+
+    The market list is saved to data/pair_graph.json and refetched once it is older than max_age. Routes from an
+    asset to fiat are found by breadth first search, the shortest first, then those ending in GBP rather than a
+    forex leg, then those whose least liquid market is most liquid.
+
+    Markets no longer trading (delisted or halted) are kept, as their candles still price the time they traded,
+    with a liquidity of DELISTED so a route through them is only taken after the others.
+    """
+
+    save_path = 'data/pair_graph.json'
+    max_age = timedelta(days=1)
+    max_legs = 3
+    max_routes = 5
+
+    def __init__(self, markets):
+        self.markets = markets
+        self.edges = defaultdict(list)
+        self.routes = {}
+        self.lock = threading.Lock()
+
+        for market in markets:
+            self.edges[market.base].append((market.quote, market, False))
+            self.edges[market.quote].append((market.base, market, True))
+
+    @staticmethod
+    def load(path=None):
+        path = path or PairGraph.save_path
+
+        if os.path.isfile(path):
+            with open(path) as j:
+                saved = json.load(j)
+
+            if datetime.utcnow() - datetime.strptime(saved['fetched'], '%Y-%m-%d %H:%M:%S') < PairGraph.max_age:
+                return PairGraph([Market(*i) for i in saved['markets']])
+
+        markets = PairGraph.binance_markets() + PairGraph.coinbase_pro_markets()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'fetched': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+                       'markets': [list(i) for i in markets]}, f)
+
+        return PairGraph(markets)
+
+    @staticmethod
+    def binance_markets():
+        base_url = 'https://api.binance.com'
+
+        symbols = requests.get(base_url + '/api/v3/exchangeInfo').json()['symbols']
+        trades = {i['symbol']: i['count'] for i in requests.get(base_url + '/api/v3/ticker/24hr').json()}
+
+        return [Market('binance', i['symbol'], i['baseAsset'], i['quoteAsset'],
+                       trades.get(i['symbol'], 0) if i['status'] == 'TRADING' else DELISTED) for i in symbols]
+
+    @staticmethod
+    def coinbase_pro_markets():
+        products = requests.get('https://api.pro.coinbase.com/products').json()
+
+        return [Market('coinbase_pro', i['id'], i['base_currency'], i['quote_currency'],
+                       0 if i.get('status') == 'online' and not i.get('trading_disabled') else DELISTED)
+                for i in products]
+
+    def route(self, asset, exchanges):
+        """
+        Return the best routes from asset to fiat using markets on the given exchanges, as a list of
+        {'legs': [(market, invert), ...], 'fiat': currency}, best first
+        """
+
+        key = (asset, tuple(sorted(exchanges)))
+
+        with self.lock:
+            if key not in self.routes:
+                self.routes[key] = self.find_routes(asset, exchanges)
+
+            return self.routes[key]
+
+    def find_routes(self, asset, exchanges):
+        if asset in FIAT or asset in FIAT_EQUIVALENTS:
+            return [{'legs': [], 'fiat': asset}]
+
+        found = []
+        paths = [(asset, [])]
+        for _ in range(PairGraph.max_legs):
+            next_paths = []
+            for node, legs in paths:
+                visited = {asset} | {i[0].quote if not i[1] else i[0].base for i in legs}
+
+                for neighbour, market, invert in self.edges[node]:
+                    if market.exchange not in exchanges or neighbour in visited:
+                        continue
+
+                    if neighbour in FIAT or neighbour in FIAT_EQUIVALENTS:
+                        found.append({'legs': legs + [(market, invert)], 'fiat': neighbour})
+                    else:
+                        next_paths.append((neighbour, legs + [(market, invert)]))
+
+            # Only keep looking past the shortest routes until there are enough alternatives
+            if len(found) >= PairGraph.max_routes:
+                break
+            paths = next_paths
+
+        found.sort(key=lambda i: (any(leg[0].liquidity == DELISTED for leg in i['legs']), len(i['legs']),
+                                  FIAT_EQUIVALENTS.get(i['fiat'], i['fiat']) != 'GBP',
+                                  -min(leg[0].liquidity for leg in i['legs'])))
+
+        return found[:PairGraph.max_routes]
+
+
+class MarketPrices:
+    """
+    Closes for markets at 1m, 1h and 1d resolution from the candle store, fetching a window of candles at a time for
+    the minutes it does not cover, so each market and minute is only requested once however many rows, routes and
+    runs need it.
+
+    At 1m the price at a minute is the close of the first candle opening at or after it, within max_gap minutes. At
+    coarser resolutions it is the close of the candle the minute falls in. Concurrent lookups of the same window
+    share one request. Windows that came back empty or failed are recorded in failures and not requested again
+    until they expire.
+    """
+
+    candle_limit = {'binance': 1000, 'coinbase_pro': 300}
+    max_gap = 60
+
+    def __init__(self, store=None, failures=None):
+        self.store = store or candle_store
+        self.failures = failures or price_failures
+        self.empty = defaultdict(list)
+        self.lock = threading.Lock()
+        self.flights = SingleFlight('market_prices')
+
+    def close(self, market, minute, resolution='1m'):
+        """
+        Return the close of market at minute (datetime64[m]), raising IndexError when there is no candle for it
+        """
+
+        close = self.closes(market, [minute], resolution)[0]
+        if np.isnan(close):
+            raise IndexError(f'No {market.exchange} {market.symbol} {resolution} candle at '
+                             f'{np.datetime64(minute, "m")}')
+
+        return float(close)
+
+    @staticmethod
+    def needed(minutes, resolution):
+        """
+        Return the range of candles each of minutes needs, from the first to the end of the last
+        """
+
+        if resolution == '1m':
+            return minutes, minutes + np.timedelta64(MarketPrices.max_gap + 1, 'm')
+
+        length = RESOLUTIONS[resolution]
+        starts = (minutes.astype(np.int64) // length * length).astype('datetime64[m]')
+
+        return starts, starts + np.timedelta64(length, 'm')
+
+    def closes(self, market, minutes, resolution='1m', fetch=True):
+        """
+        Return an array of the closes of market at each of minutes, NaN where there is no candle. With fetch the
+        windows the store cannot price are fetched in time order, so a sorted batch needs one request per window,
+        otherwise only the store is used.
+        """
+
+        minutes = np.asarray(minutes, dtype='datetime64[m]')
+        result = self.stored_closes(market, minutes, resolution)
+
+        missing = np.isnan(result)
+        if fetch and len(minutes):
+            metrics.cache('market_prices', hits=len(np.unique(minutes[~missing])))
+            if missing.any():
+                self.fetch_missing(market, np.unique(minutes[missing]), resolution)
+                result[missing] = self.stored_closes(market, minutes[missing], resolution)
+
+        return result
+
+    def stored_closes(self, market, minutes, resolution):
+        """
+        Return an array of the closes of market at each of minutes the store holds, NaN where it has no candle or
+        the range up to the candle is not covered, so a candle beyond a gap that was never fetched is not used
+        """
+
+        result = np.full(len(minutes), np.nan)
+        if not len(minutes):
+            return result
+
+        key = (market.exchange, market.symbol, resolution)
+        starts, ends = MarketPrices.needed(minutes, resolution)
+        times, closes = self.store.series(*key, starts.min(), ends.max())
+
+        idx = np.searchsorted(times, starts, side='left')
+        found = idx < len(times)
+        if resolution == '1m':
+            # First candle at or after each minute, within the gap
+            found[found] = times[idx[found]] - minutes[found] <= np.timedelta64(MarketPrices.max_gap, 'm')
+        else:
+            # The candle each minute falls in
+            found[found] = times[idx[found]] == starts[found]
+
+        length = np.timedelta64(RESOLUTIONS[resolution], 'm')
+        found[found] = self.store.covered(*key, starts[found], times[idx[found]] + length)
+
+        result[found] = closes[idx[found]]
+
+        return result
+
+    def fetch_missing(self, market, minutes, resolution):
+        """
+        Fetch the windows needed for the sorted unique minutes the store cannot price and does not cover
+        """
+
+        key = (market.exchange, market.symbol, resolution)
+        starts, ends = MarketPrices.needed(minutes, resolution)
+        covered = self.store.covered(*key, starts, ends)
+
+        hits = int(covered.sum())
+        for start, end in zip(starts[~covered], ends[~covered]):
+            # Windows fetched for earlier minutes, in this thread or another, may cover it by now
+            if self.store.covered(*key, [start], [end])[0] or self.known_empty(key, start, end):
+                hits += 1
+                continue
+
+            self.flights.do(key + (start,), lambda: self.fetch_window(market, resolution, start))
+
+        metrics.cache('market_prices', hits=hits, misses=len(minutes) - hits)
+
+    def known_empty(self, key, start, end):
+        with self.lock:
+            return any(s <= start and end <= e for s, e in self.empty[key])
+
+    def fetch_window(self, market, resolution, start):
+        """
+        Fetch the candles of market from start, as many as one request returns, into the store
+        """
+
+        key = (market.exchange, market.symbol, resolution)
+        length = np.timedelta64(MarketPrices.candle_limit[market.exchange] * RESOLUTIONS[resolution], 'm')
+        end = start + length
+
+        failure_key = f'{market.exchange} {market.symbol} {resolution} {start}'
+        if self.failures.get(failure_key):
+            with self.lock:
+                self.empty[key].append((start, end))
+            return
+
+        try:
+            if market.exchange == 'binance':
+                times, closes = MarketPrices.binance_candles(market.symbol, start, end, resolution)
+            else:
+                times, closes = MarketPrices.coinbase_pro_candles(market.symbol, start, end, resolution)
+        except (requests.RequestException, ValueError) as e:
+            self.failures.add(failure_key, str(e), self.failures.ttl(end, error=True), end=str(end))
+            with self.lock:
+                self.empty[key].append((start, end))
+            return
+
+        if not len(times):
+            self.failures.add(failure_key, 'No candles', self.failures.ttl(end), end=str(end))
+            with self.lock:
+                self.empty[key].append((start, end))
+            return
+
+        # Candles still to come are not covered yet
+        now = np.datetime64(datetime.utcnow(), 'm')
+        self.store.add(*key, start, min(end, now - np.timedelta64(RESOLUTIONS[resolution], 'm')), times, closes)
+
+    def backfill(self, market, start, end, resolution='1h'):
+        """
+        Fetch every window of market from start to end the store does not cover yet, at a coarse resolution so
+        years of history take a few requests
+        """
+
+        key = (market.exchange, market.symbol, resolution)
+        length = np.timedelta64(MarketPrices.candle_limit[market.exchange] * RESOLUTIONS[resolution], 'm')
+
+        minute = MarketPrices.needed(np.array([start], dtype='datetime64[m]'), resolution)[0][0]
+        end = np.datetime64(end, 'm')
+        requests_made = 0
+        while minute < end:
+            if not self.store.covered(*key, [minute], [minute + np.timedelta64(RESOLUTIONS[resolution], 'm')])[0]:
+                self.fetch_window(market, resolution, minute)
+                requests_made += 1
+            minute += length
+
+        return requests_made
+
+    @staticmethod
+    def binance_candles(symbol, start, end, resolution='1m'):
+        params = {
+            'symbol': symbol,
+            'interval': resolution,
+            'startTime': int(start.astype('datetime64[ms]').astype(np.int64)),
+            'endTime': int(end.astype('datetime64[ms]').astype(np.int64)) - 1,
+            'limit': 1000
+        }
+        r = requests.get('https://api.binance.com/api/v3/klines', params=params).json()
+
+        if isinstance(r, dict):
+            # Error response, e.g. an invalid symbol
+            raise ValueError(f'Binance {symbol} klines: {r.get("msg", r)}')
+
+        times = np.array([i[0] for i in r], dtype='datetime64[ms]').astype('datetime64[m]')
+
+        return times, np.array([float(i[4]) for i in r])
+
+    @staticmethod
+    def coinbase_pro_candles(symbol, start, end, resolution='1m'):
+        params = {
+            'start': str(start.astype('datetime64[s]')),
+            'end': str((end - np.timedelta64(1, 'm')).astype('datetime64[s]')),
+            'granularity': RESOLUTIONS[resolution] * 60
+        }
+
+        auth = None
+        if os.environ.get('COINBASE_PRO_API_KEY'):
+            auth = CoinbaseProAuth(os.environ.get('COINBASE_PRO_API_KEY'), os.environ.get('COINBASE_PRO_API_SECRET'),
+                                   os.environ.get('COINBASE_PRO_API_PASSPHRASE'))
+
+        r = requests.get(f'https://api.pro.coinbase.com/products/{symbol}/candles', auth=auth, params=params).json()
+
+        if isinstance(r, dict):
+            raise ValueError(f'Coinbase Pro {symbol} candles: {r.get("message", r)}')
+
+        # Candles are [time, low, high, open, close, volume], newest first
+        times = np.array([i[0] for i in r], dtype='datetime64[s]').astype('datetime64[m]')
+
+        return times, np.array([float(i[4]) for i in r])
+
+
+class PriceRouter:
+    """
+    Converts crypto to GBP along the best available route on the given exchanges, falling back to the next route
+    when a market has no candle for the time (e.g. before it was listed).
+
+    Candles are used at the finest resolution up to tolerance, first from what the candle store already holds (e.g.
+    after a coarse backfill or an archive import) and then fetching from fetch_resolution up. Each rate comes with
+    the resolution it was priced at.
+    """
+
+    tolerance = '1h'
+    fetch_resolution = '1m'
+
+    def __init__(self, graph=None, prices=None, tolerance=None):
+        self.graph = graph
+        self.prices = prices or MarketPrices()
+        self.tolerance = tolerance or PriceRouter.tolerance
+        self.lock = threading.Lock()
+
+    def pair_graph(self):
+        with self.lock:
+            if self.graph is None:
+                self.graph = PairGraph.load()
+
+            return self.graph
+
+    def passes(self):
+        """
+        Return the (resolution, fetch) passes made for rates, finest first and the store before fetching
+        """
+
+        resolutions = [i for i in RESOLUTIONS if RESOLUTIONS[i] <= RESOLUTIONS[self.tolerance]]
+
+        return [(i, False) for i in resolutions] + \
+            [(i, True) for i in resolutions if RESOLUTIONS[i] >= RESOLUTIONS[PriceRouter.fetch_resolution]]
+
+    def rate(self, asset, dt, exchanges):
+        """
+        Return GBP per unit of asset at dt ('%Y-%m-%d %H:%M:%S'), raising IndexError if no route has prices for it
+        """
+
+        rate = self.rates(asset, [dt], exchanges)[0][0]
+        if np.isnan(rate):
+            raise IndexError(f'No route with prices for {asset} at {dt} on {", ".join(exchanges)}')
+
+        return float(rate)
+
+    def convert(self, asset, dt, quantity, exchanges):
+        return float(quantity) * self.rate(asset, dt, exchanges)
+
+    def rates(self, asset, dts, exchanges):
+        """
+        Return an array of GBP per unit of asset at each of dts, NaN where no route has prices, and an array of the
+        candle resolution each was priced at ('' for fiat, which has no candles).
+
+        In each pass every route is tried in turn for the times the routes before it could not price.
+        """
+
+        minutes = np.asarray(dts, dtype='datetime64[s]').astype('datetime64[m]')
+        result = np.full(len(minutes), np.nan)
+        resolution = np.full(len(minutes), '', dtype=object)
+
+        routes = self.pair_graph().route(asset, exchanges)
+        for candles, fetch in self.passes():
+            for route in routes:
+                pending = np.isnan(result)
+                if not pending.any():
+                    return result, resolution
+
+                rate = np.ones(pending.sum())
+                for market, invert in route['legs']:
+                    closes = self.prices.closes(market, minutes[pending], candles, fetch=fetch)
+                    rate *= 1 / closes if invert else closes
+
+                priced = ~np.isnan(rate)
+                rate[priced] *= fiat_gbp_rates(route['fiat'], minutes[pending][priced])
+
+                result[pending] = rate
+                resolution[pending & ~np.isnan(result)] = candles if route['legs'] else ''
+
+        return result, resolution
+
+    def convert_batch(self, assets, dts, quantities, exchanges):
+        """
+        Return an array of GBP values of quantities of assets at dts, NaN where no route has prices, and an array
+        of the candle resolution each was priced at.
+
+        Rows are grouped by asset so each asset's route and its candle windows are worked out once for all of its
+        rows.
+        """
+
+        assets = np.asarray(assets, dtype=object)
+        dts = np.asarray(dts, dtype='datetime64[s]')
+        quantities = np.asarray(quantities, dtype=np.float64)
+
+        rates = np.full(len(assets), np.nan)
+        resolutions = np.full(len(assets), '', dtype=object)
+        for asset in pd.unique(assets):
+            rows = assets == asset
+            rates[rows], resolutions[rows] = self.rates(asset, dts[rows], exchanges)
+
+        return quantities * rates, resolutions
+
+    def backfill(self, assets, start, end, exchanges, resolution='1h'):
+        """
+        Fetch the candles along each asset's best route from start to end at a coarse resolution, so a long history
+        is priced from the store in a few hundred requests rather than one per transaction. Returns the number of
+        requests made.
+        """
+
+        requests_made = 0
+        for asset in assets:
+            routes = self.pair_graph().route(asset, exchanges)
+            for market, _ in (routes[0]['legs'] if routes else []):
+                requests_made += self.prices.backfill(market, start, end, resolution)
+
+        return requests_made
+
+
+# Shared by every conversion so markets, routes and candles are only fetched once per run, and known failures skipped
+price_failures = PriceFailures()
+price_router = PriceRouter()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Backfill coarse candles for pricing a long transaction history')
+    parser.add_argument('assets', nargs='+')
+    parser.add_argument('--start', default='2017-11-01')
+    parser.add_argument('--end', default=datetime.utcnow().strftime('%Y-%m-%d'))
+    parser.add_argument('--exchanges', nargs='+', default=['binance'])
+    parser.add_argument('--resolution', choices=list(RESOLUTIONS), default='1h')
+    args = parser.parse_args()
+
+    made = price_router.backfill(args.assets, np.datetime64(args.start, 'm'), np.datetime64(args.end, 'm'),
+                                 args.exchanges, args.resolution)
+    price_failures.flush()
+    print(f'{made} requests')
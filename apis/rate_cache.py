@@ -0,0 +1,457 @@
+import os
+import json
+import shutil
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+from apis.helpers import EXCHANGE_ACTIONS
+from metrics import metrics
+
+
+def minute_numbers(minutes):
+    """
+    Return minutes since the epoch (int64) for an array of '%Y-%m-%d %H:%M:00' strings
+    """
+
+    return np.asarray(minutes, dtype='datetime64[m]').astype(np.int64)
+
+
+def minute_strings(numbers):
+    return [str(i).replace('T', ' ') + ':00' for i in np.asarray(numbers, dtype=np.int64).astype('datetime64[m]')]
+
+
+def latest_by_minute(minutes, rates, resolutions):
+    """
+    Return minutes, rates and resolutions sorted by minute, keeping the last rate given for each minute
+    """
+
+    order = np.argsort(minutes, kind='stable')
+    minutes, rates, resolutions = minutes[order], rates[order], resolutions[order]
+
+    last = np.append(minutes[1:] != minutes[:-1], True)
+
+    return minutes[last], rates[last], resolutions[last]
+
+
+def empty_partition():
+    return np.array([], dtype=np.int64), np.array([], dtype=np.float64), np.array([], dtype='<U2')
+
+
+def referenced_rates(path='data/source_transactions/'):
+    """
+    Return {asset: minutes} of the rates the saved source transactions were valued with, their final assets for
+    exchange actions and their fee currencies
+    """
+
+    referenced = {}
+    for i in sorted(os.listdir(path)):
+        if not i.endswith('.csv'):
+            continue
+
+        df = pd.read_csv(path + i, usecols=['datetime', 'action', 'final_asset_currency', 'fee_currency'])
+        minutes = pd.to_datetime(df['datetime']).dt.floor('min').to_numpy().astype('datetime64[m]').astype(np.int64)
+
+        for rows, column in [(df['action'].isin(EXCHANGE_ACTIONS), 'final_asset_currency'),
+                             (df['fee_currency'].notna(), 'fee_currency')]:
+            rows = rows.to_numpy()
+            for asset, asset_minutes in pd.Series(minutes[rows]).groupby(df[column].to_numpy()[rows]):
+                referenced[asset] = np.union1d(referenced.get(asset, []), asset_minutes.to_numpy())
+
+    return {k: v.astype(np.int64) for k, v in referenced.items()}
+
+
+class RateCache:
+    """
+    GBP rates by asset and minute ('%Y-%m-%d %H:%M:00'), cached in two tiers.
+
+    On disk rates are partitioned by asset and month, data/cached_gbp_rates/<asset>/<YYYY-MM>.npz, each partition
+    holding its minutes sorted with their rates, and the candle resolution each rate was priced at, so a minute or
+    a range of them is found by binary search.
+    index.json lists every partition with its first and last minute and count, so only the partitions a run
+    touches are opened. Older caches, the single data/cached_gbp_rates.json and the per asset JSON files, are
+    compacted into partitions the first time the cache is used.
+
+    In memory partitions are kept in least recently used order and evicted once they hold more than max_entries
+    rates in total, so memory stays flat however many years of rates are saved. Hits, misses and evictions are
+    counted under 'gbp_rates_lru'.
+
+    Writes are queued and merged into their partitions by a background thread every flush_interval seconds, or as
+    soon as flush_batch writes are queued. flush() writes everything still queued.
+
+    The directory is resolved against the working directory when the cache is used, and the index and partitions
+    read from another directory dropped, so a process that changes directory (e.g. a benchmark run per workspace)
+    reads and writes the cache of the one it is in.
+
+    python -m apis.rate_cache --prune compacts the partitions, dropping the rates no saved source transaction
+    refers to any more.
+    """
+
+    path = 'data/cached_gbp_rates/'
+    legacy_path = 'data/cached_gbp_rates.json'
+    max_entries = 250000
+    flush_interval = 5
+    flush_batch = 1000
+
+    def __init__(self, path=None, max_entries=None):
+        self.relative_path = path or RateCache.path
+        self.path = os.path.abspath(self.relative_path)
+        self.max_entries = max_entries or RateCache.max_entries
+        self.partitions = OrderedDict()
+        self.size = 0
+        self.index = None
+        self.pending = {}
+        self.pending_count = 0
+        self.flushing = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.index_lock = threading.RLock()
+        self.wake = threading.Event()
+        self.flusher = None
+
+    def follow_directory(self):
+        """
+        Resolve the cache directory against the working directory, dropping what was read from the previous one if
+        it changed. Called with the lock held.
+        """
+
+        path = os.path.abspath(self.relative_path)
+        if path == self.path:
+            return
+
+        with self.index_lock:
+            self.path = path
+            self.index = None
+
+        self.partitions.clear()
+        self.size = 0
+
+    def reset(self):
+        """
+        Write everything queued and drop everything held in memory, so the next use reads the cache afresh
+        """
+
+        self.flush()
+
+        with self.lock:
+            with self.index_lock:
+                self.index = None
+            self.partitions.clear()
+            self.size = 0
+
+    def get(self, asset, minute):
+        """
+        Return the cached GBP rate of asset at minute, or None
+        """
+
+        rate = self.lookup(asset, [minute])[0][0]
+
+        return None if np.isnan(rate) else float(rate)
+
+    def lookup(self, asset, minutes):
+        """
+        Return an array of the cached GBP rates of asset at each of minutes, NaN where there is none, and an array
+        of the resolutions they were priced at
+        """
+
+        numbers = minute_numbers(minutes)
+        months = numbers.astype('datetime64[m]').astype('datetime64[M]')
+        result = np.full(len(numbers), np.nan)
+        resolution = np.full(len(numbers), '', dtype=object)
+
+        with self.lock:
+            self.follow_directory()
+
+            for month in np.unique(months):
+                rows = months == month
+                partition_minutes, partition_rates, partition_resolutions = self.partition(asset, str(month))
+
+                idx = np.searchsorted(partition_minutes, numbers[rows])
+                found = idx < len(partition_minutes)
+                found[found] = partition_minutes[idx[found]] == numbers[rows][found]
+
+                rows = np.flatnonzero(rows)[found]
+                result[rows] = partition_rates[idx[found]]
+                resolution[rows] = partition_resolutions[idx[found]]
+
+            # Writes not yet on disk
+            for queued in [self.flushing, self.pending]:
+                if asset in queued:
+                    for i, minute in enumerate(minutes):
+                        if minute in queued[asset]:
+                            result[i], resolution[i] = queued[asset][minute]
+
+        return result, resolution
+
+    def set(self, asset, minute, rate, resolution=''):
+        with self.lock:
+            self.pending.setdefault(asset, {})[minute] = (rate, resolution)
+            self.pending_count += 1
+
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self.flush_periodically, name='rate-cache-flush', daemon=True)
+                self.flusher.start()
+
+            if self.pending_count >= RateCache.flush_batch:
+                self.wake.set()
+
+    def partition(self, asset, month):
+        """
+        Return the in-memory minutes, rates and resolutions of asset in month ('%Y-%m'), reading them from disk if
+        they are not held. Called with the lock held.
+        """
+
+        key = (asset, month)
+        if key in self.partitions:
+            self.partitions.move_to_end(key)
+            metrics.cache('gbp_rates_lru', hits=1)
+            return self.partitions[key]
+
+        metrics.cache('gbp_rates_lru', misses=1)
+
+        partition = self.read_partition(asset, month)
+        self.keep(key, partition)
+
+        return partition
+
+    def keep(self, key, partition):
+        """
+        Hold a partition in memory, evicting the least recently used others beyond max_entries. Called with the
+        lock held.
+        """
+
+        if key in self.partitions:
+            self.size -= len(self.partitions[key][0])
+
+        self.partitions[key] = partition
+        self.partitions.move_to_end(key)
+        self.size += len(partition[0])
+
+        evictions = 0
+        while self.size > self.max_entries and len(self.partitions) > 1:
+            _, evicted = self.partitions.popitem(last=False)
+            self.size -= len(evicted[0])
+            evictions += 1
+
+        if evictions:
+            metrics.cache('gbp_rates_lru', evictions=evictions)
+
+    def load_index(self):
+        with self.index_lock:
+            if self.index is None:
+                path = os.path.join(self.path, 'index.json')
+                if os.path.isfile(path):
+                    with open(path) as j:
+                        self.index = json.load(j)
+                    metrics.file_read(path)
+                else:
+                    self.compact_locked(migrate=True)
+
+            return self.index
+
+    def partition_path(self, asset, month, directory=None):
+        return os.path.join(directory or self.path, asset, f'{month}.npz')
+
+    def read_partition(self, asset, month):
+        if month not in self.load_index().get(asset, {}):
+            return empty_partition()
+
+        path = self.partition_path(asset, month)
+        if not os.path.isfile(path):
+            # Removed since the index was read, its rates are fetched again as though never cached
+            return empty_partition()
+
+        with np.load(path) as npz:
+            # Partitions written before resolutions were recorded have none
+            resolutions = npz['resolution'] if 'resolution' in npz.files else np.full(len(npz['minute']), '', '<U2')
+            partition = npz['minute'], npz['rate'], resolutions
+        metrics.file_read(path)
+
+        return partition
+
+    def write_partition(self, asset, month, minutes, rates, resolutions, directory=None):
+        """
+        Write a partition and return its index entry
+        """
+
+        path = self.partition_path(asset, month, directory)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Written through a file object, np.savez adds .npz to names without it
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, minute=minutes, rate=rates, resolution=np.asarray(resolutions, dtype='<U2'))
+        os.replace(path + '.tmp', path)
+        metrics.file_written(path)
+
+        first, last = minute_strings([minutes[0], minutes[-1]])
+
+        return {'first': first, 'last': last, 'count': len(minutes)}
+
+    def save_index(self, index, directory=None):
+        path = os.path.join(directory or self.path, 'index.json')
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(index, f, indent=4, sort_keys=True)
+        os.replace(path + '.tmp', path)
+        metrics.file_written(path)
+
+    def flush(self):
+        """
+        Merge every queued write into its partition on disk, only rewriting the months written to
+        """
+
+        with self.flush_lock:
+            with self.lock:
+                self.follow_directory()
+                pending = self.flushing = self.pending
+                self.pending, self.pending_count = {}, 0
+
+            if not pending:
+                return
+
+            merged_partitions = {}
+            with self.index_lock:
+                index = self.load_index()
+
+                for asset, rates in pending.items():
+                    numbers = minute_numbers(list(rates.keys()))
+                    values = np.array([i[0] for i in rates.values()], dtype=np.float64)
+                    resolutions = np.array([i[1] for i in rates.values()], dtype='<U2')
+                    months = numbers.astype('datetime64[m]').astype('datetime64[M]')
+
+                    for month in np.unique(months):
+                        rows = months == month
+                        saved = self.read_partition(asset, str(month))
+
+                        merged = latest_by_minute(np.concatenate([saved[0], numbers[rows]]),
+                                                  np.concatenate([saved[1], values[rows]]),
+                                                  np.concatenate([saved[2], resolutions[rows]]))
+                        index.setdefault(asset, {})[str(month)] = self.write_partition(asset, str(month), *merged)
+                        merged_partitions[(asset, str(month))] = merged
+
+                self.save_index(index)
+
+            # The lock is never taken inside the index lock, lookups take them the other way round
+            with self.lock:
+                for key, merged in merged_partitions.items():
+                    if key in self.partitions:
+                        self.keep(key, merged)
+                self.flushing = {}
+
+    def flush_periodically(self):
+        while True:
+            self.wake.wait(RateCache.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+    def compact(self, referenced=None):
+        """
+        Rewrite every partition with duplicate minutes dropped and, given referenced ({asset: minutes} as from
+        referenced_rates), only the rates it contains. Returns counts of what was kept and dropped.
+        """
+
+        self.flush()
+
+        with self.flush_lock:
+            with self.index_lock:
+                self.load_index()
+                counts = self.compact_locked(referenced=referenced)
+
+            with self.lock:
+                self.partitions.clear()
+                self.size = 0
+
+        return counts
+
+    def compact_locked(self, referenced=None, migrate=False):
+        """
+        Compact into a new directory and swap it in. With migrate the older caches are read instead of the
+        partitions. Called with the index lock held.
+        """
+
+        collected = {}
+
+        def collect(asset, minutes, rates, resolutions):
+            collected.setdefault(asset, []).append((minutes, rates, resolutions))
+
+        if migrate:
+            sources = []
+            if self.relative_path == RateCache.path and os.path.isfile(RateCache.legacy_path):
+                with open(RateCache.legacy_path) as j:
+                    sources.append(json.load(j))
+                metrics.file_read(RateCache.legacy_path)
+
+            # One JSON file per asset, the layout before partitioning by month
+            if os.path.isdir(self.path):
+                for i in sorted(os.listdir(self.path)):
+                    if i.endswith('.json'):
+                        with open(os.path.join(self.path, i)) as j:
+                            sources.append({i[:-len('.json')]: json.load(j)})
+                        metrics.file_read(os.path.join(self.path, i))
+
+            for source in sources:
+                for asset, rates in source.items():
+                    rates = {k: v for k, v in rates.items() if v}
+                    collect(asset, minute_numbers(list(rates.keys())),
+                            np.array(list(rates.values()), dtype=np.float64), np.full(len(rates), '', '<U2'))
+        else:
+            for asset, months in self.index.items():
+                for month in months:
+                    collect(asset, *self.read_partition(asset, month))
+
+        directory = os.path.normpath(self.path)
+        if os.path.isdir(directory + '.tmp'):
+            shutil.rmtree(directory + '.tmp')
+        os.makedirs(directory + '.tmp')
+
+        index = {}
+        counts = {'rates': 0, 'partitions': 0, 'duplicates': 0, 'unreferenced': 0}
+        for asset, parts in collected.items():
+            minutes = np.concatenate([i[0] for i in parts])
+            rates = np.concatenate([i[1] for i in parts])
+            resolutions = np.concatenate([i[2] for i in parts])
+
+            minutes_kept, rates_kept, resolutions_kept = latest_by_minute(minutes, rates, resolutions)
+            counts['duplicates'] += len(minutes) - len(minutes_kept)
+
+            if referenced is not None:
+                keep = np.isin(minutes_kept, referenced.get(asset, []))
+                counts['unreferenced'] += int((~keep).sum())
+                minutes_kept, rates_kept = minutes_kept[keep], rates_kept[keep]
+                resolutions_kept = resolutions_kept[keep]
+
+            months = minutes_kept.astype('datetime64[m]').astype('datetime64[M]')
+            for month in np.unique(months):
+                rows = months == month
+                index.setdefault(asset, {})[str(month)] = self.write_partition(
+                    asset, str(month), minutes_kept[rows], rates_kept[rows], resolutions_kept[rows],
+                    directory=directory + '.tmp')
+                counts['partitions'] += 1
+
+            counts['rates'] += len(minutes_kept)
+
+        self.save_index(index, directory=directory + '.tmp')
+
+        # Swap the compacted partitions in, the old ones are only removed once the new are in place
+        if os.path.isdir(directory):
+            os.replace(directory, directory + '.old')
+        os.replace(directory + '.tmp', directory)
+        shutil.rmtree(directory + '.old', ignore_errors=True)
+
+        self.index = index
+
+        return counts
+
+
+# Shared by every connector so a partition is only read once per run while it stays in memory
+rate_cache = RateCache()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compact the cached GBP rates into per asset, per month partitions')
+    parser.add_argument('--prune', action='store_true',
+                        help='Drop rates no transaction in data/source_transactions/ refers to')
+    args = parser.parse_args()
+
+    print(json.dumps(rate_cache.compact(referenced_rates() if args.prune else None)))
@@ -0,0 +1,90 @@
+import time
+import threading
+import requests
+from contextlib import contextmanager
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the HTTP requests made by one source.
+
+    The connectors call requests.get directly, so a limiter is applied to the thread a source runs in and a
+    requests.Session.send hook takes a token from the current thread's limiter before every request. Responses with a
+    429 are retried after their Retry-After delay.
+
+    with RateLimiter.hooked():
+        with RateLimiter(10).applied():
+            Binance().get_binance_transactions()
+    """
+
+    local = threading.local()
+    max_retries = 5
+
+    def __init__(self, requests_per_second, burst=1):
+        self.interval = 1 / requests_per_second
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.waited = 0.0
+
+    def acquire(self):
+        """
+        Take a token, sleeping until one is available. Tokens can go negative, which reserves future tokens so
+        concurrent callers queue up in order.
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) / self.interval)
+            self.updated = now
+
+            self.tokens -= 1
+            wait = -self.tokens * self.interval if self.tokens < 0 else 0
+            self.waited += wait
+
+        if wait:
+            time.sleep(wait)
+
+    @contextmanager
+    def applied(self):
+        """
+        Limit every request made by the current thread until the block ends
+        """
+
+        previous = getattr(RateLimiter.local, 'limiter', None)
+        RateLimiter.local.limiter = self
+        try:
+            yield self
+        finally:
+            RateLimiter.local.limiter = previous
+
+    @staticmethod
+    @contextmanager
+    def hooked():
+        """
+        Route requests through the current thread's limiter until the block ends
+        """
+
+        original_send = requests.Session.send
+
+        def send(session, request, **kwargs):
+            limiter = getattr(RateLimiter.local, 'limiter', None)
+            if limiter is None:
+                return original_send(session, request, **kwargs)
+
+            for _ in range(RateLimiter.max_retries):
+                limiter.acquire()
+                response = original_send(session, request, **kwargs)
+                if response.status_code != 429:
+                    return response
+
+                time.sleep(float(response.headers.get('Retry-After', 1)))
+
+            return response
+
+        requests.Session.send = send
+        try:
+            yield
+        finally:
+            requests.Session.send = original_send
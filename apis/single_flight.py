@@ -0,0 +1,56 @@
+import threading
+
+from metrics import metrics
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into one. The first caller for a key runs the call while later
+    callers wait for it and receive its result, or have its exception raised, so fanned out lookups of the same
+    candles or rates only reach the API once.
+
+    flights = SingleFlight('market_prices')
+    window = flights.do(('binance', 'BTCGBP', minute), lambda: fetch_window(market, minute))
+
+    Only calls in flight at the same time are shared, results are cached by the caller.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, function):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Flight()
+
+        if not leader:
+            metrics.cache(f'{self.name}_coalesced', hits=1)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+
+            return call.result
+
+        metrics.cache(f'{self.name}_coalesced', misses=1)
+        try:
+            call.result = function()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+        return call.result
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
@@ -0,0 +1,409 @@
+import os
+import numpy as np
+import pandas as pd
+
+from apis.helpers import Transaction, convert_columns_to_gbp
+from apis.rate_cache import rate_cache
+from metrics import metrics
+
+FIAT = ['GBP', 'EUR', 'USD']
+
+NUMERIC = ['initial_asset_quantity', 'price', 'final_asset_quantity', 'final_asset_gbp', 'fee_quantity']
+
+# An amount with its asset as the Binance trade history gives them, e.g. 1,250.50GBP
+AMOUNT_ASSET = r'^\s*(?P<quantity>[\d,.]+)\s*(?P<asset>[A-Z0-9]+)\s*$'
+
+# Coinbase Convert notes, e.g. Converted 0.1 ETH to 0.005 BTC
+CONVERTED = r'^Converted (?P<from_quantity>[\d,.]+) (?P<from_asset>\w+) to (?P<to_quantity>[\d,.]+) (?P<to_asset>\w+)'
+
+
+def transaction_frame(length, **columns):
+    """
+    Return a dataframe of length rows in the Transaction schema, columns given as scalars or arrays
+    """
+
+    # Series are taken by position, as rows are selected from chunks with their own index
+    columns = {k: v.to_numpy() if isinstance(v, pd.Series) else v for k, v in columns.items()}
+
+    return pd.DataFrame({k: columns.get(k) for k in Transaction().transaction}, index=range(length))
+
+
+def numbers(column):
+    """
+    Return a column of amounts as numbers, without thousands separators or currency symbols (1,250.50, £12.30)
+    """
+
+    return pd.to_numeric(column.astype(str).str.replace(r'[^0-9.eE\-]', '', regex=True), errors='coerce')
+
+
+def binance_trades(chunk):
+    """
+    Binance trade history export: Date(UTC), Pair, Side, Price, Executed, Amount, Fee. Each trade is two rows as
+    Binance.create_trades_dataframes makes them, one for the base asset and one for the quote asset.
+    """
+
+    executed = chunk['Executed'].str.extract(AMOUNT_ASSET)
+    amount = chunk['Amount'].str.extract(AMOUNT_ASSET)
+    fee = chunk['Fee'].str.extract(AMOUNT_ASSET)
+
+    base, quote = executed['asset'], amount['asset']
+    buy = (chunk['Side'].str.upper() == 'BUY').to_numpy()
+    fiat = quote.isin(FIAT).to_numpy()
+
+    # Buys go from the quote asset to the base asset, sells the other way, on both rows
+    common = dict(
+        type=None,
+        datetime=pd.to_datetime(chunk['Date(UTC)']).dt.strftime('%Y-%m-%d %H:%M:%S'),
+        initial_asset_quantity=np.where(buy, numbers(amount['quantity']), numbers(executed['quantity'])),
+        initial_asset_currency=np.where(buy, quote, base),
+        initial_asset_location='Binance',
+        price=numbers(chunk['Price']),
+        final_asset_quantity=np.where(buy, numbers(executed['quantity']), numbers(amount['quantity'])),
+        final_asset_currency=np.where(buy, base, quote),
+        final_asset_location='Binance',
+        fee_type='exchange',
+        fee_quantity=numbers(fee['quantity']),
+        fee_currency=fee['asset']
+    )
+
+    def action(side_buy):
+        return np.where(fiat, np.where(side_buy, 'exchange_fiat_for_crypto', 'exchange_crypto_for_fiat'),
+                        'exchange_crypto_for_crypto')
+
+    base_rows = transaction_frame(len(chunk), asset=base, action=action(buy), disposal=~buy, **common)
+    quote_rows = transaction_frame(len(chunk), asset=quote, action=action(~buy), disposal=buy, **common)
+
+    return pd.concat([base_rows, quote_rows])
+
+
+def coinbase_transactions(chunk):
+    """
+    Coinbase transaction history report: [ID], Timestamp, Transaction Type, Asset, Quantity Transacted, Spot Price
+    Currency, Spot Price at Transaction, Subtotal, Total (inclusive of fees...), Fees..., Notes. Types are mapped as
+    the connector maps the API's buys, sells, sends and trades, other types are left out.
+    """
+
+    # Column names have changed between versions of the report, e.g. 'Fees' and 'Fees and/or Spread'
+    column = {i.split(' (')[0].split(' and/or')[0]: i for i in chunk.columns}
+    kind = chunk[column['Transaction Type']].str.replace('Advanced Trade ', '', regex=False)
+
+    asset = chunk[column['Asset']]
+    quantity = numbers(chunk[column['Quantity Transacted']]).abs()
+    fiat = chunk[column['Spot Price Currency']]
+    subtotal = numbers(chunk[column['Subtotal']]).abs()
+    total = numbers(chunk[column['Total']]).abs()
+    fees = numbers(chunk[column['Fees']]).abs() if 'Fees' in column else pd.Series(np.nan, index=chunk.index)
+    gbp = subtotal.where(fiat == 'GBP')
+
+    common = dict(
+        datetime=pd.to_datetime(chunk[column['Timestamp']].str.replace(' UTC', '', regex=False), utc=True)
+        .dt.strftime('%Y-%m-%d %H:%M:%S'),
+        source_transaction_id=chunk[column['ID']] if 'ID' in column else None
+    )
+
+    frames = []
+
+    rows = kind.isin(['Buy', 'Sell']).to_numpy()
+    if rows.any():
+        # As Coinbase.create_buys_dataframe and create_sells_dataframe
+        sell = (kind[rows] == 'Sell').to_numpy()
+        frames.append(transaction_frame(
+            rows.sum(), asset=asset[rows], type=np.where(sell, 'sell', 'buy'),
+            action=np.where(sell, 'exchange_crypto_for_fiat', 'exchange_fiat_for_crypto'), disposal=sell,
+            datetime=common['datetime'][rows], initial_asset_quantity=total[rows], initial_asset_currency=fiat[rows],
+            initial_asset_location='Coinbase', price=numbers(chunk[column['Spot Price at Transaction']])[rows],
+            final_asset_quantity=quantity[rows], final_asset_currency=asset[rows], final_asset_gbp=gbp[rows],
+            final_asset_location='Coinbase', fee_type='exchange', fee_quantity=fees[rows], fee_currency=fiat[rows],
+            source_transaction_id=subset(common['source_transaction_id'], rows)))
+
+    rows = (kind == 'Send').to_numpy()
+    if rows.any():
+        frames.append(transaction_frame(
+            rows.sum(), asset=asset[rows], type='send', action='withdraw_crypto', disposal=False,
+            datetime=common['datetime'][rows], initial_asset_quantity=quantity[rows],
+            initial_asset_currency=asset[rows], initial_asset_location='Coinbase', fee_type='transfer',
+            source_transaction_id=subset(common['source_transaction_id'], rows)))
+
+    for types, action in [(['Receive'], 'deposit_crypto'),
+                          (['Coinbase Earn', 'Learning Reward', 'Rewards Income'], 'gifted_crypto')]:
+        rows = kind.isin(types).to_numpy()
+        if rows.any():
+            frames.append(transaction_frame(
+                rows.sum(), asset=asset[rows], type='send', action=action, disposal=False,
+                datetime=common['datetime'][rows], final_asset_quantity=quantity[rows],
+                final_asset_currency=asset[rows], final_asset_gbp=gbp[rows], final_asset_location='Coinbase',
+                source_transaction_id=subset(common['source_transaction_id'], rows)))
+
+    rows = (kind == 'Convert').to_numpy()
+    if rows.any():
+        # A sell of the asset converted from and a buy of the one converted to, as the connector pairs trades
+        converted = chunk[column['Notes']][rows].str.extract(CONVERTED)
+        for side, disposal in [('from', True), ('to', False)]:
+            frames.append(transaction_frame(
+                rows.sum(), asset=converted[f'{side}_asset'], type='trade', action='exchange_crypto_for_crypto',
+                disposal=disposal, datetime=common['datetime'][rows],
+                initial_asset_quantity=numbers(converted['from_quantity']),
+                initial_asset_currency=converted['from_asset'], initial_asset_location='Coinbase',
+                final_asset_quantity=numbers(converted['to_quantity']), final_asset_currency=converted['to_asset'],
+                final_asset_gbp=gbp[rows], final_asset_location='Coinbase', fee_type='exchange',
+                source_transaction_id=subset(common['source_transaction_id'], rows)))
+
+    return pd.concat(frames) if frames else transaction_frame(0)
+
+
+def coinbase_pro_fills(chunk):
+    """
+    Coinbase Pro fills report: portfolio, trade id, product, side, created at, size, size unit, price, fee, total,
+    price/fee/total unit. Fills are mapped as CoinbasePro.create_fills_dataframe maps them, one row against fiat and
+    a row for each asset between cryptos.
+    """
+
+    product = chunk['product'].str.split('-', expand=True)
+    base, quote = product[0], product[1]
+    buy = (chunk['side'].str.upper() == 'BUY').to_numpy()
+    fiat = quote.isin(['GBP', 'EUR']).to_numpy()
+
+    size = numbers(chunk['size'])
+    price = numbers(chunk['price'])
+
+    common = dict(
+        datetime=pd.to_datetime(chunk['created at'], utc=True).dt.strftime('%Y-%m-%d %H:%M:%S'),
+        initial_asset_quantity=np.where(buy, price * size, size),
+        initial_asset_currency=np.where(buy, quote, base),
+        initial_asset_location='Coinbase Pro',
+        price=price,
+        final_asset_quantity=np.where(buy, size, price * size),
+        final_asset_currency=np.where(buy, base, quote),
+        final_asset_location='Coinbase Pro',
+        fee_type='exchange',
+        source_trade_id=chunk['trade id']
+    )
+
+    # The row the fee is charged on: the fiat fill itself, or the disposal between cryptos
+    fee_rows = transaction_frame(
+        len(chunk), asset=np.where(buy & ~fiat, quote, base),
+        action=np.where(fiat, np.where(buy, 'exchange_fiat_for_crypto', 'exchange_crypto_for_fiat'),
+                        'exchange_crypto_for_crypto'),
+        disposal=np.where(fiat, ~buy, True), fee_quantity=numbers(chunk['fee']), fee_currency=quote, **common)
+
+    # The acquisition between cryptos
+    crypto = ~fiat
+    acquisitions = transaction_frame(
+        crypto.sum(), asset=np.where(buy, base, quote)[crypto], action='exchange_crypto_for_crypto', disposal=False,
+        **{k: v[crypto] if isinstance(v, (pd.Series, np.ndarray)) else v for k, v in common.items()})
+
+    return pd.concat([fee_rows, acquisitions])
+
+
+def coinbase_pro_account(chunk):
+    """
+    Coinbase Pro account report: portfolio, type, time, amount, balance, amount/balance unit, transfer id, trade id,
+    order id. Only deposits and withdrawals are taken, matches and fees are in the fills report.
+    """
+
+    unit = chunk['amount/balance unit']
+    amount = numbers(chunk['amount']).abs()
+    fiat = unit.isin(['GBP', 'EUR']).to_numpy()
+    datetime = pd.to_datetime(chunk['time'], utc=True).dt.strftime('%Y-%m-%d %H:%M:%S')
+
+    frames = []
+    for kind, action, initial_location, final_location in [('deposit', 'deposit', None, 'Coinbase Pro'),
+                                                           ('withdrawal', 'withdraw', 'Coinbase Pro', None)]:
+        rows = (chunk['type'] == kind).to_numpy()
+        if rows.any():
+            frames.append(transaction_frame(
+                rows.sum(), asset=unit[rows], action=np.where(fiat[rows], f'{action}_fiat', f'{action}_crypto'),
+                disposal=False, datetime=datetime[rows], initial_asset_quantity=amount[rows],
+                initial_asset_currency=unit[rows], initial_asset_location=initial_location,
+                final_asset_quantity=amount[rows], final_asset_currency=unit[rows],
+                final_asset_location=final_location, fee_type='transfer' if kind == 'withdrawal' else 'exchange',
+                source_transaction_id=chunk['transfer id'][rows]))
+
+    return pd.concat(frames) if frames else transaction_frame(0)
+
+
+def subset(values, rows):
+    return values if values is None else values[rows]
+
+
+def id_strings(column):
+    """
+    Return ids as strings, so ids read back from a CSV as floats (123.0) match those given as ints or strings
+    """
+
+    return column.astype(str).str.replace(r'\.0$', '', regex=True).where(column.notna())
+
+
+def row_keys(df):
+    """
+    Return the key each transaction is matched on when it has no ids: its time, asset, action and quantities
+    """
+
+    datetime = pd.to_datetime(df['datetime']).dt.strftime('%Y-%m-%d %H:%M:%S')
+    quantities = [pd.to_numeric(df[i], errors='coerce').round(8).astype(str)
+                  for i in ['initial_asset_quantity', 'final_asset_quantity']]
+
+    return ('row ' + datetime + ' ' + df['asset'].astype(str) + ' ' + df['action'].astype(str) + ' ' +
+            quantities[0] + ' ' + quantities[1]).to_numpy()
+
+
+def transaction_keys(df):
+    """
+    Return the key each transaction is matched on between statements and the API: its source transaction id, else
+    its trade id with its asset and time, else its row key
+    """
+
+    datetime = pd.to_datetime(df['datetime']).dt.strftime('%Y-%m-%d %H:%M:%S')
+    ids = id_strings(df['source_transaction_id'])
+    trade_ids = id_strings(df['source_trade_id'])
+    rows = pd.Series(row_keys(df), index=df.index)
+
+    keys = ('id ' + ids).where(ids.notna(), ('trade ' + trade_ids + ' ' + df['asset'].astype(str) + ' ' + datetime)
+                                            .where(trade_ids.notna(), rows))
+
+    return keys.to_numpy()
+
+
+def given_by(df, api_transactions):
+    """
+    Return which transactions of df api_transactions already has. Those with ids are matched on them, those
+    without (e.g. the Binance trade history has none, where the API gives trade ids) on their row keys against the
+    row keys of every API transaction.
+    """
+
+    keys = transaction_keys(df)
+    given = np.isin(keys, transaction_keys(api_transactions))
+
+    without_ids = np.char.startswith(keys.astype(str), 'row ')
+    if without_ids.any():
+        given |= without_ids & np.isin(row_keys(df), row_keys(api_transactions))
+
+    return given
+
+
+class Statements:
+    """
+    Imports the transaction history CSVs the exchanges offer for download, from data/statements/<source>/, as a
+    fast alternative to paging through their APIs.
+
+    Each file is recognised by its columns and read a chunk of rows at a time, each chunk normalised into the
+    Transaction schema with column operations. Rows the API has already given, or another statement, are dropped
+    by their source ids, or by their time, asset, action and quantities where the statement has none (see
+    given_by), and the GBP values of the rest are converted as the connectors convert theirs.
+    """
+
+    path = 'data/statements/'
+    chunk_rows = 20000
+
+    # Statement kind: (source, columns identifying it, normaliser)
+    kinds = {
+        'binance_trades': ('binance', ['Date(UTC)', 'Pair', 'Side', 'Executed', 'Amount', 'Fee'], binance_trades),
+        'coinbase_transactions': ('coinbase', ['Timestamp', 'Transaction Type', 'Asset', 'Quantity Transacted'],
+                                  coinbase_transactions),
+        'coinbase_pro_fills': ('coinbase_pro', ['trade id', 'product', 'side', 'created at', 'size', 'price', 'fee'],
+                               coinbase_pro_fills),
+        'coinbase_pro_account': ('coinbase_pro', ['type', 'time', 'amount', 'amount/balance unit', 'transfer id'],
+                                 coinbase_pro_account)
+    }
+
+    # Markets each source's statements are priced over
+    exchanges = {'binance': ['binance'], 'coinbase': ['coinbase_pro'], 'coinbase_pro': ['coinbase_pro']}
+
+    def __init__(self, path=None):
+        self.path = path or Statements.path
+
+    def files(self, source):
+        directory = os.path.join(self.path, source)
+        if not os.path.isdir(directory):
+            return []
+
+        return sorted(os.path.join(directory, i) for i in os.listdir(directory) if i.lower().endswith('.csv'))
+
+    def exist(self, source):
+        return bool(self.files(source))
+
+    @staticmethod
+    def recognise(path):
+        """
+        Return the kind of statement at path and the number of lines before its header, Coinbase reports start
+        with a few lines of notes. (None, 0) if it is not recognised.
+        """
+
+        with open(path, encoding='utf-8-sig') as f:
+            for skip, line in enumerate(f):
+                columns = [i.strip().strip('"') for i in line.split(',')]
+                for kind, (_, required, _) in Statements.kinds.items():
+                    if all(i in columns for i in required):
+                        return kind, skip
+
+                if skip > 20:
+                    break
+
+        return None, 0
+
+    def read(self, source):
+        """
+        Return the transactions in source's statements in the Transaction schema, without duplicates and without
+        GBP values
+        """
+
+        frames = []
+        for path in self.files(source):
+            kind, skip = Statements.recognise(path)
+            if kind is None or Statements.kinds[kind][0] != source:
+                print(f'Skipping unrecognised statement {path}')
+                continue
+
+            normalise = Statements.kinds[kind][2]
+            for chunk in pd.read_csv(path, skiprows=skip, dtype=str, chunksize=Statements.chunk_rows,
+                                     encoding='utf-8-sig'):
+                frames.append(normalise(chunk.rename(columns=str.strip)))
+            metrics.file_read(path)
+
+        if not frames:
+            return transaction_frame(0)
+
+        df = pd.concat(frames, ignore_index=True)
+        df[NUMERIC] = df[NUMERIC].apply(pd.to_numeric)
+
+        # Statements downloaded over overlapping periods hold some transactions twice
+        keys = pd.Series(transaction_keys(df)) + ' ' + df['asset'].astype(str)
+
+        return df[~keys.duplicated().to_numpy()]
+
+    def transactions(self, source, api_transactions=None):
+        """
+        Return source's statement transactions not in api_transactions, with their GBP values
+        """
+
+        df = self.read(source)
+
+        if api_transactions is not None and len(api_transactions) and len(df):
+            df = df[~given_by(df, api_transactions)]
+
+        if not len(df):
+            return df
+
+        df = df.assign(datetime=pd.to_datetime(df['datetime'])).sort_values(by='datetime')
+
+        final_asset_gbp, fee_gbp, price_resolution, count_api, count_cache = convert_columns_to_gbp(
+            df, rate_cache, Statements.exchanges[source])
+        metrics.cache('gbp_rates', hits=count_cache, misses=count_api)
+        rate_cache.flush()
+
+        return df.assign(final_asset_gbp=final_asset_gbp, fee_gbp=fee_gbp, price_resolution=price_resolution)
+
+    def merge(self, source, api_transactions):
+        """
+        Return api_transactions with source's statement transactions the API did not give added
+        """
+
+        df = self.transactions(source, api_transactions)
+        print(f'{len(df)} {source} transactions from statements')
+
+        if not len(df):
+            return api_transactions
+
+        api_transactions = api_transactions.assign(datetime=pd.to_datetime(api_transactions['datetime']))
+
+        return pd.concat([api_transactions, df], ignore_index=True).sort_values(by='datetime')
@@ -1,14 +1,18 @@
 import os
-import json
 import pandas as pd
 from datetime import datetime as dt
 
-from apis.helpers import Transaction, BinanceConvertToGBP, CoinAPIConvertToGBP
+from apis.helpers import Transaction, convert_columns_to_gbp
+from apis.rate_cache import rate_cache
+from metrics import metrics
 
 
 class Exodus:
     def __init__(self):
-        self.path = os.path.join(os.environ["HOMEDRIVE"], os.environ["HOMEPATH"], "Desktop\\exodus-exports\\")
+        if os.environ.get('EXODUS_EXPORTS_PATH'):
+            self.path = os.environ.get('EXODUS_EXPORTS_PATH')
+        else:
+            self.path = os.path.join(os.environ["HOMEDRIVE"], os.environ["HOMEPATH"], "Desktop\\exodus-exports\\")
 
     def get_exodus_transactions(self):
         df = self.get_csv()
@@ -21,123 +25,21 @@ class Exodus:
 
         df_transactions.sort_values(by='datetime', inplace=True)
 
-        # Check whether cached_rates_gbp.json exists
-        if not os.path.isfile('data/cached_gbp_rates.json'):
-            with open('data/cached_gbp_rates.json', 'w') as f:
-                json.dump({}, f)
-
-        # Read cached crypto/gbp rates
-        with open('data/cached_gbp_rates.json') as j:
-            cached_rates = json.load(j)
-
-        # Loop through and get GBP values where missing
-        final_asset_gbp = []
-        fee_gbp = []
-        count_api = 0
-        count_cache = 0
-        for row in df_transactions.itertuples():
-            # Calculate GBP value for all disposals
-            if row.action in ['exchange_fiat_for_crypto', 'exchange_crypto_for_fiat', 'exchange_crypto_for_crypto']:
-                if pd.isna(row.final_asset_gbp):
-                    if not pd.isna(row.final_asset_gbp):
-                        final_asset_gbp.append(None)
-                    elif row.final_asset_currency == 'GBP':
-                        final_asset_gbp.append(row.final_asset_quantity)
-                    else:
-                        asset = row.final_asset_currency
-                        datetime = dt.strptime(str(row.datetime), '%Y-%m-%d %H:%M:%S').strftime('%Y-%m-%d %H:%M:00')
-                        quantity = row.final_asset_quantity
-                        # Check whether we have already cached the GBP rate for the asset and datetime in question
-                        if asset in cached_rates.keys():
-                            if not cached_rates[asset].get(datetime):
-                                try:
-                                    c = BinanceConvertToGBP(asset, datetime, quantity)
-                                    gbp_value = c.convert_to_gbp()
-                                except IndexError:
-                                    c = CoinAPIConvertToGBP(asset, datetime, quantity)
-                                    gbp_value = c.convert_to_gbp()
-                                final_asset_gbp.append(gbp_value)
-                                if float(quantity):
-                                    rate_gbp = gbp_value / float(quantity)
-                                    cached_rates[asset] = {}
-                                    cached_rates[asset][datetime] = rate_gbp
-                                count_api += 1
-                            else:
-                                rate_gbp = cached_rates[asset].get(datetime)
-                                quantity_gbp = rate_gbp * float(quantity)
-                                final_asset_gbp.append(quantity_gbp)
-                                count_cache += 1
-                        else:
-                            try:
-                                c = BinanceConvertToGBP(asset, datetime, quantity)
-                                gbp_value = c.convert_to_gbp()
-                            except IndexError:
-                                c = CoinAPIConvertToGBP(asset, datetime, quantity)
-                                gbp_value = c.convert_to_gbp()
-                            final_asset_gbp.append(gbp_value)
-                            if float(quantity):
-                                rate_gbp = gbp_value / float(quantity)
-                                cached_rates[asset] = {}
-                                cached_rates[asset][datetime] = rate_gbp
-                            count_api += 1
-                else:
-                    final_asset_gbp.append(row.final_asset_gbp)
-            else:
-                final_asset_gbp.append(row.final_asset_gbp)
-
-            # Calculate all fees in GBP
-            if not pd.isna(row.fee_currency):
-                if any([row.fee_currency == 'GBP', row.fee_quantity == 0.0]):
-                    fee_gbp.append(row.fee_quantity)
-                else:
-                    asset = row.fee_currency
-                    datetime = dt.strptime(str(row.datetime), '%Y-%m-%d %H:%M:%S').strftime('%Y-%m-%d %H:%M:00')
-                    quantity = row.fee_quantity
-
-                    # Check whether we have already cached the GBP rate for the asset and datetime in question
-                    if asset in cached_rates.keys():
-                        if not cached_rates[asset].get(datetime):
-                            try:
-                                c = BinanceConvertToGBP(asset, datetime, quantity)
-                                gbp_value = c.convert_to_gbp()
-                            except IndexError:
-                                c = CoinAPIConvertToGBP(asset, datetime, quantity)
-                                gbp_value = c.convert_to_gbp()
-                            fee_gbp.append(gbp_value)
-                            if float(quantity):
-                                rate_gbp = gbp_value / float(quantity)
-                                cached_rates[asset][datetime] = rate_gbp
-                            count_api += 1
-                        else:
-                            rate_gbp = cached_rates[asset].get(datetime)
-                            quantity_gbp = rate_gbp * float(quantity)
-                            fee_gbp.append(quantity_gbp)
-                            count_cache += 1
-                    else:
-                        try:
-                            c = BinanceConvertToGBP(asset, datetime, quantity)
-                            gbp_value = c.convert_to_gbp()
-                        except IndexError:
-                            c = CoinAPIConvertToGBP(asset, datetime, quantity)
-                            gbp_value = c.convert_to_gbp()
-                        fee_gbp.append(gbp_value)
-                        if float(quantity):
-                            rate_gbp = gbp_value / float(quantity)
-                            cached_rates[asset] = {}
-                            cached_rates[asset][datetime] = rate_gbp
-                        count_api += 1
-            else:
-                fee_gbp.append(None)
+        # GBP conversions
+        # Convert every rate missing from the cache in one batch over the Binance markets, keeping GBP values given
+        final_asset_gbp, fee_gbp, price_resolution, count_api, count_cache = convert_columns_to_gbp(
+            df_transactions, rate_cache, ['binance'])
 
         print(f'Count API:\t {count_api}')
         print(f'Count cache:\t {count_cache}')
+        metrics.cache('gbp_rates', hits=count_cache, misses=count_api)
 
-        # Save cached_rates back to json file for quicker conversions on next run
-        with open('data/cached_gbp_rates.json', 'w', encoding='utf-8') as f:
-            json.dump(cached_rates, f, ensure_ascii=False, indent=4)
+        # Write the rates still queued for quicker conversions on next run
+        rate_cache.flush()
 
         df_transactions['final_asset_gbp'] = final_asset_gbp
         df_transactions['fee_gbp'] = fee_gbp
+        df_transactions['price_resolution'] = price_resolution
 
         return df_transactions
 
@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+from apis.candles import candle_store
+from apis.cassette import CassetteRecorder, CassetteReplay
+from apis.forex import forex_cache, daily_rates
+from apis.get_all_transactions import GetAllTransactions
+from apis.prices import price_failures, price_router
+from apis.rate_cache import rate_cache
+from metrics import metrics
+
+CASSETTE_PATH = 'benchmarks/cassettes/get_all_transactions.jsonl.gz'
+
+# Files the connectors read from data/ before making any requests
+DATA_FILES = ['binance_pairs.json']
+
+# Credentials only need to exist for requests to be signed, the replay server ignores them
+DUMMY_CREDENTIALS = {
+    'BINANCE_API_KEY': 'replay',
+    'BINANCE_API_SECRET': 'replay',
+    'COINBASE_API_KEY': 'replay',
+    'COINBASE_API_SECRET': 'replay',
+    'COINBASE_PRO_API_KEY': 'replay',
+    'COINBASE_PRO_API_SECRET': 'cmVwbGF5',
+    'COINBASE_PRO_API_PASSPHRASE': 'replay',
+    'RATES_API_ACCESS_KEY': 'replay'
+}
+
+
+def record(cassette):
+    """
+    Run GetAllTransactions against the live APIs in the current directory and record every HTTP exchange
+    """
+
+    directory = os.path.dirname(cassette)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    with CassetteRecorder(cassette) as recorder:
+        GetAllTransactions().get_all_transactions()
+
+    print(f'Recorded {len(recorder.entries)} requests to {cassette}')
+
+
+def create_workspace(fixtures):
+    """
+    Return a fresh directory with the data/ layout GetAllTransactions expects, copying the files it reads from
+    fixtures, and point Exodus at the exodus-exports folder in fixtures
+    """
+
+    workspace = tempfile.mkdtemp(prefix='cryptotaxuk_ingestion_')
+    os.makedirs(f'{workspace}/data/forex')
+
+    for i in DATA_FILES:
+        if os.path.isfile(f'{fixtures}/{i}'):
+            shutil.copy(f'{fixtures}/{i}', f'{workspace}/data/{i}')
+
+    os.environ['EXODUS_EXPORTS_PATH'] = os.path.abspath(f'{fixtures}/exodus-exports') + os.sep
+
+    return workspace
+
+
+def reset_caches():
+    """
+    Drop what the process wide caches hold, so each workspace is priced from its own empty data/ as a fresh
+    process would be
+    """
+
+    rate_cache.reset()
+
+    # The others only hold what they read or fetched, reinitialising them leaves them as when first imported
+    for cache in [candle_store, forex_cache, daily_rates, price_failures, price_router]:
+        cache.__init__()
+
+
+def benchmark_replay(cassette, fixtures, latency=0.0, rate_limit=None, concurrent=False):
+    """
+    Time a full GetAllTransactions run served from a cassette in a throwaway workspace
+    """
+
+    for k, v in DUMMY_CREDENTIALS.items():
+        os.environ.setdefault(k, v)
+
+    cassette = os.path.abspath(cassette)
+    fixtures = os.path.abspath(fixtures)
+    workspace = create_workspace(fixtures)
+    cwd = os.getcwd()
+
+    try:
+        os.chdir(workspace)
+        reset_caches()
+        metrics.reset()
+        with CassetteReplay(cassette, latency=latency, rate_limit=rate_limit) as replay:
+            metrics.install_http_hook()
+            start = time.perf_counter()
+            GetAllTransactions(concurrent=concurrent).get_all_transactions()
+            seconds = time.perf_counter() - start
+            metrics.remove_http_hook()
+
+        server = replay.server
+        return {
+            'latency': latency,
+            'rate_limit': rate_limit,
+            'concurrent': concurrent,
+            'seconds': round(seconds, 3),
+            'requests': sum(server.served.values()),
+            'misses': len(server.misses),
+            'stages': {k: v['seconds'] for k, v in metrics.report()['stages'].items()}
+        }
+    finally:
+        # Rates and failures still queued belong to this workspace
+        rate_cache.flush()
+        price_failures.flush()
+        os.chdir(cwd)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark GetAllTransactions offline from recorded API responses')
+    parser.add_argument('--cassette', default=CASSETTE_PATH)
+    parser.add_argument('--fixtures', default='data', help='Directory with binance_pairs.json and exodus-exports/')
+    parser.add_argument('--latency', type=float, nargs='+', default=[0.0])
+    parser.add_argument('--rate-limit', type=int, default=None, help='Requests per second per host before a 429')
+    parser.add_argument('--concurrent', action='store_true', help='Ingest every source at once')
+    parser.add_argument('--record', action='store_true', help='Record a new cassette from the live APIs')
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.cassette)
+    else:
+        for latency in args.latency:
+            print(json.dumps(benchmark_replay(args.cassette, args.fixtures, latency=latency,
+                                              rate_limit=args.rate_limit, concurrent=args.concurrent)))
@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import argparse
+import platform
+import tempfile
+import pandas as pd
+
+from benchmarks.synthetic_portfolio import write_transactions
+from calculations.tax import TaxCalculations
+
+SIZES = [1000, 10000, 100000, 1000000, 10000000]
+# Committed results the comparison reads by default, made with --save-baseline at the default seed
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline_tax.json')
+
+
+def time_stage(timings, stage, f, *args, **kwargs):
+    start = time.perf_counter()
+    result = f(*args, **kwargs)
+    timings[stage] = round(time.perf_counter() - start, 6)
+
+    return result
+
+
+def benchmark_size(rows, directory, same_day_rate=0.1, thirty_day_rate=0.1, seed=0):
+    """
+    Time each stage of the tax calculations for one synthetic asset history
+    """
+
+    path = f'{directory}/BTC_{rows}_{same_day_rate}_{thirty_day_rate}_{seed}.csv'
+    if not os.path.isfile(path):
+        write_transactions(path, rows, same_day_rate=same_day_rate, thirty_day_rate=thirty_day_rate, seed=seed)
+
+    timings = {}
+
+    df = time_stage(timings, 'read_csv', pd.read_csv, path)
+    daily = time_stage(timings, 'tagging', TaxCalculations.prepare_transactions, df)
+
+    same_day_quantity, same_day_allowable_cost = time_stage(
+        timings, 'same_day_matching', TaxCalculations.same_day_matching,
+        daily['acquisition_quantity'], daily['acquisition_cost'], daily['disposal_quantity'])
+
+    quantity_in = daily['acquisition_quantity'] - same_day_quantity
+    cost_in = daily['acquisition_cost'] - same_day_allowable_cost
+    disposal_remaining = daily['disposal_quantity'] - same_day_quantity
+
+    thirty_day_rule, _ = time_stage(
+        timings, 'thirty_day_rule_matching', TaxCalculations.thirty_day_rule_matching,
+        daily['day'].astype('int64'), quantity_in, cost_in, disposal_remaining)
+    thirty_day_rule_quantity, _, matched_quantity, matched_cost = thirty_day_rule
+
+    time_stage(timings, 'section_104_pool', TaxCalculations.section_104_pool_calculations,
+               quantity_in - matched_quantity, cost_in - matched_cost, disposal_remaining - thirty_day_rule_quantity)
+
+    time_stage(timings, 'match_disposals', TaxCalculations.match_disposals, **daily)
+
+    return {'rows': rows, 'days': len(daily['day']), 'timings': timings}
+
+
+def compare(results, baseline):
+    """
+    Print each stage's time against the baseline for the same row count
+    """
+
+    baseline = {i['rows']: i['timings'] for i in baseline['results']}
+    for result in results:
+        if result['rows'] not in baseline:
+            continue
+
+        for stage, seconds in result['timings'].items():
+            previous = baseline[result['rows']].get(stage)
+            if previous:
+                print(f"{result['rows']:>10} {stage:<26} {seconds:>10.4f}s {seconds / previous:>7.2f}x baseline")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the tax calculations on synthetic transaction histories')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--same-day-rate', type=float, default=0.1)
+    parser.add_argument('--thirty-day-rate', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic histories, fixed for comparisons')
+    parser.add_argument('--data-dir', default=None, help='Where to keep generated CSVs between runs')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='cryptotaxuk_bench_')
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+
+    results = []
+    for size in args.sizes:
+        result = benchmark_size(size, data_dir, same_day_rate=args.same_day_rate,
+                                thirty_day_rate=args.thirty_day_rate, seed=args.seed)
+        print(json.dumps(result))
+        results.append(result)
+
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as j:
+            baseline = json.load(j)
+
+        # Timings are only comparable over the same synthetic histories
+        settings = ['same_day_rate', 'thirty_day_rate', 'seed']
+        if all(baseline.get(i, 0) == getattr(args, i) for i in settings):
+            compare(results, baseline)
+        else:
+            print(f'Not comparing with {args.baseline}, made with ' +
+                  ', '.join(f'{i} {baseline.get(i, 0)}' for i in settings))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(),
+                       'same_day_rate': args.same_day_rate, 'thirty_day_rate': args.thirty_day_rate,
+                       'seed': args.seed, 'results': results}, f, indent=4)
@@ -0,0 +1,117 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+from apis.helpers import Transaction
+
+# Same column order as the transaction CSVs written by GetAllTransactions
+COLUMNS = list(Transaction().transaction.keys())
+
+
+def generate_transactions(rows, asset='BTC', start='2017-11-01', days=1826, same_day_rate=0.1, thirty_day_rate=0.1,
+                          disposal_rate=0.4, first_id=0, seed=0):
+    """
+    Return a dataframe of synthetic trades for one asset in the Transaction schema.
+
+    Trades are spread over the given number of days. same_day_rate is the share of rows moved onto the same day as
+    the row before with the opposite action, and thirty_day_rate the share of acquisitions moved to within 30 days
+    after the previous disposal, so both matching rules get exercised at a known rate.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    start = np.datetime64(start, 's')
+    seconds = np.sort(rng.integers(0, days * 86400, rows))
+    disposal = rng.random(rows) < disposal_rate
+
+    # Same day clusters, move the row onto the day of the row before it with the opposite action
+    same_day = np.flatnonzero(rng.random(rows) < same_day_rate)
+    same_day = same_day[same_day > 0]
+    seconds[same_day] = seconds[same_day - 1] // 86400 * 86400 + rng.integers(0, 86400, len(same_day))
+    disposal[same_day] = ~disposal[same_day - 1]
+
+    # 30 day clusters, move acquisitions to 1-30 days after the most recent disposal
+    previous_disposal = np.maximum.accumulate(np.where(disposal, np.arange(rows), -1))
+    thirty_day = np.flatnonzero((rng.random(rows) < thirty_day_rate) & ~disposal & (previous_disposal >= 0))
+    seconds[thirty_day] = seconds[previous_disposal[thirty_day]] // 86400 * 86400 \
+        + rng.integers(1, 31, len(thirty_day)) * 86400 + rng.integers(0, 86400, len(thirty_day))
+
+    order = np.argsort(seconds, kind='stable')
+    seconds = seconds[order]
+    disposal = disposal[order]
+
+    # Daily GBP price following a random walk, and trade sizes that keep disposals smaller than acquisitions
+    price = 5000 * np.exp(np.cumsum(rng.normal(0, 0.03, days + 31)))[seconds // 86400]
+    quantity = np.round(rng.lognormal(-3, 1, rows) * np.where(disposal, 0.6, 1.0), 8)
+    gbp = np.round(quantity * price, 2)
+
+    df = pd.DataFrame({
+        'asset': asset,
+        'action': np.where(disposal, 'exchange_crypto_for_fiat', 'exchange_fiat_for_crypto'),
+        'type': None,
+        'disposal': disposal,
+        'datetime': start + seconds.astype('timedelta64[s]'),
+        'initial_asset_quantity': np.where(disposal, quantity, gbp),
+        'initial_asset_currency': np.where(disposal, asset, 'GBP'),
+        'initial_asset_location': 'Synthetic',
+        'initial_asset_address': None,
+        'price': np.round(price, 2),
+        'final_asset_quantity': np.where(disposal, gbp, quantity),
+        'final_asset_currency': np.where(disposal, 'GBP', asset),
+        'final_asset_gbp': gbp,
+        'final_asset_location': 'Synthetic',
+        'final_asset_address': None,
+        'fee_type': 'exchange',
+        'fee_quantity': np.round(gbp * 0.001, 2),
+        'fee_currency': 'GBP',
+        'fee_gbp': np.round(gbp * 0.001, 2),
+        'source_transaction_id': np.arange(first_id, first_id + rows),
+        'source_trade_id': None,
+        # Trades are against GBP, so no value was priced from candles
+        'price_resolution': ''
+    })
+
+    return df[COLUMNS]
+
+
+def write_transactions(path, rows, asset='BTC', chunk_size=1000000, days=1826, seed=0, **kwargs):
+    """
+    Write a synthetic transaction CSV in chunks so large row counts never have to be held in memory at once.
+
+    Each chunk covers its own consecutive slice of the date range.
+    """
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    chunks = max(1, -(-rows // chunk_size))
+    chunk_days = max(1, days // chunks)
+    written = 0
+    for i in range(chunks):
+        chunk_rows = min(chunk_size, rows - written)
+        start = np.datetime64('2017-11-01') + np.timedelta64(i * chunk_days, 'D')
+
+        df = generate_transactions(chunk_rows, asset=asset, start=str(start), days=chunk_days, first_id=written,
+                                   seed=seed + i, **kwargs)
+        df.to_csv(path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+
+        written += chunk_rows
+
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic asset transaction CSV')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--asset', default='BTC')
+    parser.add_argument('--days', type=int, default=1826)
+    parser.add_argument('--same-day-rate', type=float, default=0.1)
+    parser.add_argument('--thirty-day-rate', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='data/asset_transactions/')
+    args = parser.parse_args()
+
+    write_transactions(f'{args.output}{args.asset}.csv', args.rows, asset=args.asset, days=args.days,
+                       same_day_rate=args.same_day_rate, thirty_day_rate=args.thirty_day_rate, seed=args.seed)
@@ -0,0 +1,71 @@
+import numpy as np
+
+# Quantities are carried as integer base units of 1e-8 (satoshis for BTC) and GBP values as integer pence.
+# Conversion to and from floats should only happen when reading or writing data.
+QUANTITY_SCALE = 10 ** 8
+GBP_SCALE = 100
+
+INT64_MAX = np.iinfo(np.int64).max
+
+
+def to_fixed_point(values, scale):
+    """
+    Convert float values (scalar, list, array or Series) to int64 scaled units, treating missing values as zero
+    """
+
+    values = np.nan_to_num(np.asarray(values, dtype=np.float64))
+
+    return np.rint(values * scale).astype(np.int64)
+
+
+def from_fixed_point(values, scale):
+    """
+    Convert int64 scaled units back to floats for output
+    """
+
+    return np.asarray(values, dtype=np.int64) / scale
+
+
+def to_base_units(values):
+    return to_fixed_point(values, QUANTITY_SCALE)
+
+
+def from_base_units(values):
+    return from_fixed_point(values, QUANTITY_SCALE)
+
+
+def to_pence(values):
+    return to_fixed_point(values, GBP_SCALE)
+
+
+def from_pence(values):
+    return from_fixed_point(values, GBP_SCALE)
+
+
+def scale_divide(numerator, multiplier, divisor):
+    """
+    Return numerator * multiplier / divisor rounded half up, computed exactly with integers.
+
+    Accepts python ints or int64 arrays. Arrays stay in int64 when the intermediate product cannot overflow,
+    otherwise they are evaluated with python ints so the result is still exact. Divisors must be non-zero.
+    """
+
+    if all(isinstance(i, (int, np.integer)) for i in (numerator, multiplier, divisor)):
+        numerator, multiplier, divisor = int(numerator), int(multiplier), int(divisor)
+        return (2 * numerator * multiplier + divisor) // (2 * divisor)
+
+    numerator, multiplier, divisor = np.broadcast_arrays(np.asarray(numerator, dtype=np.int64),
+                                                         np.asarray(multiplier, dtype=np.int64),
+                                                         np.asarray(divisor, dtype=np.int64))
+
+    if numerator.size == 0:
+        return np.zeros(numerator.shape, dtype=np.int64)
+
+    bound = 2 * int(np.abs(numerator).max()) * int(np.abs(multiplier).max()) + int(np.abs(divisor).max())
+
+    if bound <= INT64_MAX:
+        return (2 * numerator * multiplier + divisor) // (2 * divisor)
+
+    numerator, multiplier, divisor = numerator.astype(object), multiplier.astype(object), divisor.astype(object)
+
+    return ((2 * numerator * multiplier + divisor) // (2 * divisor)).astype(np.int64)
@@ -0,0 +1,111 @@
+import os
+import numpy as np
+import pandas as pd
+
+from calculations.fixed_point import from_base_units, from_pence
+
+
+class PoolTimeline:
+    """
+    Sorted array-backed history of an asset's Section 104 pool, with one entry for each day the pool changed.
+
+    Pool states are end of day values because the tax calculations work on whole days (same day rule), so a query
+    for any timestamp returns the pool after every transaction on that date.
+    """
+
+    save_path = 'data/asset_pools/'
+
+    def __init__(self, asset, day, quantity, allowable_cost):
+        self.asset = asset
+        self.day = np.asarray(day, dtype='datetime64[D]')
+        self.quantity = np.asarray(quantity, dtype=np.int64)
+        self.allowable_cost = np.asarray(allowable_cost, dtype=np.int64)
+
+    @staticmethod
+    def from_result(asset, result):
+        """
+        Build a timeline from the int64 output of TaxCalculations.match_disposals, keeping only days the pool changed
+        """
+
+        quantity = result['section_104_pool']
+        allowable_cost = result['section_104_allowable_cost']
+
+        changed = np.ones(len(quantity), dtype=bool)
+        changed[1:] = (quantity[1:] != quantity[:-1]) | (allowable_cost[1:] != allowable_cost[:-1])
+
+        return PoolTimeline(asset, result['day'][changed], quantity[changed], allowable_cost[changed])
+
+    @staticmethod
+    def load(asset, path=None):
+        path = path or PoolTimeline.save_path
+
+        with np.load(f'{path}{asset}.npz') as npz:
+            return PoolTimeline(asset, npz['day'], npz['quantity'], npz['allowable_cost'])
+
+    @staticmethod
+    def load_all(path=None):
+        """
+        Return a dict of timelines for every asset that has one saved
+        """
+
+        path = path or PoolTimeline.save_path
+
+        return {i.split('.')[0]: PoolTimeline.load(i.split('.')[0], path)
+                for i in sorted(os.listdir(path)) if i.endswith('.npz')}
+
+    def save(self, path=None):
+        path = path or PoolTimeline.save_path
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        np.savez(f'{path}{self.asset}.npz', day=self.day, quantity=self.quantity, allowable_cost=self.allowable_cost)
+
+    def pools_at(self, timestamps):
+        """
+        Return a dataframe of pool quantity, allowable cost and average cost per unit (GBP) at each timestamp.
+
+        Timestamps before the first acquisition get an empty pool.
+        """
+
+        days = np.asarray(timestamps, dtype='datetime64[s]').astype('datetime64[D]')
+
+        # Index of the last pool change on or before each day
+        idx = np.searchsorted(self.day, days, side='right') - 1
+        found = idx >= 0
+
+        quantity = np.where(found, self.quantity[np.maximum(idx, 0)], 0)
+        allowable_cost = np.where(found, self.allowable_cost[np.maximum(idx, 0)], 0)
+
+        average_cost = np.zeros(len(quantity))
+        held = quantity > 0
+        average_cost[held] = from_pence(allowable_cost[held]) / from_base_units(quantity[held])
+
+        return pd.DataFrame({
+            'asset': self.asset,
+            'timestamp': timestamps,
+            'section_104_pool': from_base_units(quantity),
+            'section_104_allowable_cost': from_pence(allowable_cost),
+            'average_cost': average_cost
+        })
+
+    def pool_at(self, timestamp):
+        """
+        Return the pool at a single timestamp as a dict
+        """
+
+        return self.pools_at([timestamp]).iloc[0].to_dict()
+
+    @staticmethod
+    def holdings_at(timestamp, timelines=None):
+        """
+        Return the pool of every asset at a timestamp, for valuation reports
+        """
+
+        timelines = timelines if timelines is not None else PoolTimeline.load_all()
+
+        if not timelines:
+            return pd.DataFrame(columns=['asset', 'timestamp', 'section_104_pool', 'section_104_allowable_cost',
+                                         'average_cost'])
+
+        return pd.concat([i.pools_at([timestamp]) for i in timelines.values()], ignore_index=True)
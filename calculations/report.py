@@ -0,0 +1,151 @@
+import os
+import numpy as np
+import pandas as pd
+
+from calculations.fixed_point import from_pence
+
+
+class TaxReport:
+    """
+    Capital gains totals built on cumulative arrays of disposals.
+
+    Each asset keeps its disposal days in order with running totals of proceeds, allowable costs, gains and losses,
+    so the totals for any tax year or date range are the difference of two entries once the range ends have been
+    found by binary search.
+    """
+
+    checkpoints_path = 'data/tax_checkpoints/'
+    totals_columns = ['disposals', 'disposal_proceeds', 'allowable_costs', 'gains', 'losses']
+
+    def __init__(self, results):
+        """
+        results is a dict of asset to the int64 output of TaxCalculations.match_disposals
+        """
+
+        self.assets = {}
+        for asset, result in results.items():
+            self.assets[asset] = TaxReport.cumulative_totals(result)
+
+        # Every asset's disposals merged into one timeline for the all asset totals
+        if results:
+            merged = {k: np.concatenate([v[k] for v in results.values()])
+                      for k in ['day', 'disposal_quantity', 'disposal_proceeds', 'same_day_allowable_cost',
+                                'thirty_day_rule_allowable_cost', 'section_104_allowable_cost_used',
+                                'same_day_profit_or_loss', 'thirty_day_rule_profit_or_loss',
+                                'section_104_profit_or_loss']}
+            order = np.argsort(merged['day'], kind='stable')
+            self.all_assets = TaxReport.cumulative_totals({k: v[order] for k, v in merged.items()})
+        else:
+            self.all_assets = TaxReport.cumulative_totals(None)
+
+    @staticmethod
+    def load(path=None):
+        """
+        Build the report from the checkpoints saved by TaxCalculations
+        """
+
+        path = path or TaxReport.checkpoints_path
+
+        results = {}
+        if os.path.exists(path):
+            for i in sorted(os.listdir(path)):
+                if i.endswith('.npz'):
+                    with np.load(path + i) as npz:
+                        results[i.split('.')[0]] = {k: npz[k] for k in npz.files}
+
+        return TaxReport(results)
+
+    @staticmethod
+    def cumulative_totals(result):
+        """
+        Return the disposal days and prefix sums of each total, with a leading zero so any range is a subtraction
+        """
+
+        if result is None:
+            day = np.array([], dtype='datetime64[D]')
+            columns = {i: np.zeros(0, dtype=np.int64) for i in TaxReport.totals_columns}
+        else:
+            disposal = result['disposal_quantity'] > 0
+            gain = (result['same_day_profit_or_loss'] + result['thirty_day_rule_profit_or_loss']
+                    + result['section_104_profit_or_loss'])[disposal]
+
+            day = result['day'][disposal].astype('datetime64[D]')
+            columns = {
+                'disposals': np.ones(len(day), dtype=np.int64),
+                'disposal_proceeds': result['disposal_proceeds'][disposal],
+                'allowable_costs': (result['same_day_allowable_cost'] + result['thirty_day_rule_allowable_cost']
+                                    + result['section_104_allowable_cost_used'])[disposal],
+                'gains': np.maximum(gain, 0),
+                'losses': np.maximum(-gain, 0)
+            }
+
+        cumulative = {k: np.concatenate([[0], np.cumsum(v, dtype=np.int64)]) for k, v in columns.items()}
+        cumulative['day'] = day
+
+        return cumulative
+
+    @staticmethod
+    def tax_year_bounds(tax_year):
+        """
+        UK tax years run from 6 April to 5 April, tax_year 2021 being 6 April 2021 to 5 April 2022
+        """
+
+        return np.datetime64(f'{tax_year}-04-06'), np.datetime64(f'{tax_year + 1}-04-06')
+
+    @staticmethod
+    def tax_year(day):
+        day = pd.Timestamp(day)
+
+        return day.year if (day.month, day.day) >= (4, 6) else day.year - 1
+
+    def cumulative(self, asset=None):
+        if asset is None:
+            return self.all_assets
+
+        return self.assets.get(asset, TaxReport.cumulative_totals(None))
+
+    def totals(self, start, end, asset=None):
+        """
+        Return totals for disposals from start (inclusive) to end (exclusive), for one asset or all of them
+        """
+
+        cumulative = self.cumulative(asset)
+
+        bounds = np.asarray([start, end], dtype='datetime64[s]').astype('datetime64[D]')
+        i, j = np.searchsorted(cumulative['day'], bounds, side='left')
+
+        totals = {k: int(cumulative[k][j] - cumulative[k][i]) for k in TaxReport.totals_columns}
+
+        for k in TaxReport.totals_columns[1:]:
+            totals[k] = float(from_pence(totals[k]))
+
+        return totals
+
+    def tax_year_totals(self, tax_year, asset=None):
+        return self.totals(*TaxReport.tax_year_bounds(tax_year), asset=asset)
+
+    def sa108_summary(self, asset=None):
+        """
+        Return a dataframe of totals for every tax year with disposals, in the shape of the SA108 capital gains pages
+        """
+
+        cumulative = self.cumulative(asset)
+
+        rows = []
+        if len(cumulative['day']):
+            for tax_year in range(TaxReport.tax_year(cumulative['day'][0]),
+                                  TaxReport.tax_year(cumulative['day'][-1]) + 1):
+                totals = self.tax_year_totals(tax_year, asset=asset)
+                totals['net_gain'] = round(totals['gains'] - totals['losses'], 2)
+                rows.append({'tax_year': f'{tax_year}/{str(tax_year + 1)[-2:]}', **totals})
+
+        return pd.DataFrame(rows, columns=['tax_year'] + TaxReport.totals_columns + ['net_gain'])
+
+    def save(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        self.sa108_summary().to_csv(f'{path}sa108_summary.csv', index=False)
+
+        for asset in self.assets:
+            self.sa108_summary(asset).to_csv(f'{path}sa108_summary_{asset}.csv', index=False)
@@ -1,275 +1,477 @@
 import os
+import numpy as np
 import pandas as pd
-from datetime import datetime as dt
+from collections import deque
+
+from calculations.fixed_point import to_base_units, to_pence, from_base_units, from_pence, scale_divide
+from calculations.pool_timeline import PoolTimeline
+from metrics import metrics
 
 
 class TaxCalculations:
-    def __init__(self):
-        self.asset_paths = {'data/asset_transactions/'+i: False
-                            for i in os.listdir('data/asset_transactions/')
-                            if i.split('.')[0] not in ['GBP', 'EUR']}
+    # Daily inputs to match_disposals, used to find where new data differs from a checkpoint
+    input_columns = ['acquisition_quantity', 'acquisition_cost', 'disposal_quantity', 'disposal_proceeds']
+    # Transaction columns summed when aggregating each day's acquisitions and disposals
+    amount_columns = ['initial_asset_quantity', 'final_asset_quantity', 'final_asset_gbp']
+    # Columns holding asset quantities (int64 base units of 1e-8) and GBP values (int64 pence)
+    quantity_columns = ['acquisition_quantity', 'disposal_quantity', 'same_day_quantity', 'thirty_day_rule_quantity',
+                        'section_104_quantity', 'section_104_pool']
+    gbp_columns = ['acquisition_cost', 'disposal_proceeds', 'same_day_allowable_cost',
+                   'thirty_day_rule_allowable_cost', 'section_104_allowable_cost_used', 'section_104_allowable_cost',
+                   'same_day_profit_or_loss', 'thirty_day_rule_profit_or_loss', 'section_104_profit_or_loss']
+
+    def __init__(self, asset_transactions_path='data/asset_transactions/', assets=None):
+        self.asset_transactions_path = asset_transactions_path
+        self.asset_paths = {asset_transactions_path+i: False
+                            for i in sorted(os.listdir(asset_transactions_path))
+                            if i.endswith('.csv') and i.split('.')[0] not in ['GBP', 'EUR']
+                            and (assets is None or i.split('.')[0] in assets)}
+        self.checkpoints_path = 'data/tax_checkpoints/'
+        self.asset_pools_path = 'data/asset_pools/'
+        self.results = {}
 
     def tax_calculations(self):
+        self.remove_stale_checkpoints()
+
         for asset_path in self.asset_paths:
-            if asset_path.split('/')[-1].split('.')[0] == 'BTC':  # TODO: For dev purposes only, remove later
+            asset = asset_path.split('/')[-1].split('.')[0]
+
+            with metrics.stage('read_asset_transactions') as stage:
                 df = pd.read_csv(asset_path)
+                stage['rows_out'] = len(df)
+            metrics.file_read(asset_path)
+
+            # Aggregate transactions into aligned daily acquisitions and disposals
+            with metrics.stage('prepare_transactions', rows_in=len(df)) as stage:
+                daily = TaxCalculations.prepare_transactions(df)
+                stage['rows_out'] = len(daily['day'])
+
+            # Order of calculation priority:
+            # - Same day
+            # - 30 day rule
+            # - Section 104
+            # Only recalculate from the earliest day new transactions can affect if there is a checkpoint
+            with metrics.stage('match_disposals', rows_in=len(daily['day'])) as stage:
+                checkpoint = self.load_checkpoint(asset)
+                if checkpoint is None:
+                    result, queue = TaxCalculations.match_disposals(**daily)
+                else:
+                    result, queue = TaxCalculations.incremental_match_disposals(daily, checkpoint)
+                stage['rows_out'] = len(result['day'])
+
+            metrics.cache('tax_checkpoints', hits=checkpoint is not None, misses=checkpoint is None)
+
+            with metrics.stage('save_tax_results'):
+                self.save_checkpoint(asset, result, queue)
+
+                # Save the pool history for point in time queries
+                PoolTimeline.from_result(asset, result).save(self.asset_pools_path)
 
-                # Tag rows as acquisitions or disposals
-                df = TaxCalculations.tag_acquisition_or_disposal(df)
-
-                # Add day field
-                df['day'] = df['datetime'].apply(lambda x: x.split(' ')[0])
-
-                # Drop rows not required for tax calculations
-                df.drop(['action', 'type', 'disposal', 'datetime', 'initial_asset_currency',
-                         'initial_asset_location', 'initial_asset_address', 'price', 'final_asset_currency',
-                         'final_asset_location', 'final_asset_address', 'fee_type', 'fee_quantity', 'fee_gbp',
-                         'fee_currency', 'source_transaction_id', 'source_trade_id'], axis=1, inplace=True)
-
-                # Tag same day transactions
-                # df will have max one acquisition and max one disposal per day according to the same day rule
-                df = TaxCalculations.tag_same_day_transactions(df)
-
-                # Add required columns that will be populated as we loop through df
-                df['section_104_pool'] = None
-                df['section_104_allowable_cost'] = None
-                df['section_104_pool_update'] = None
-                # df['same_day_remainder_pool'] = None
-                # df['same_day_allowable_cost'] = None
-                df['thirty_day_rule_remainder_pool'] = None
-                df['thirty_day_rule_allowable_cost'] = None
-                df['same_day_profit_or_loss'] = None
-                df['thirty_day_rule_profit_or_loss'] = None
-                df['section_104_profit_or_loss'] = None
-
-                # Loop through dataframe and perform required calculations
-                # Order of calculation priority:
-                # - Same day
-                # - 30 day rule
-                # - Section 104
-
-                # Handle the very first acquisition
-                df['section_104_pool'] = round(df.at[0, 'final_asset_quantity'], 8)
-                df['section_104_allowable_cost'] = round(df.at[0, 'final_asset_gbp'], 2)
-
-                unmatched_transactions = []
-                for row in df.itertuples():
-                    if row.same_day:
-                        df_tuple = TaxCalculations.same_day_transaction_calculations(row, df)
-                        df = df_tuple[0]
-                        if df_tuple[1] is not None:
-                            unmatched_transactions.append(df_tuple[1])
-
-                df = pd.concat([df, pd.concat(unmatched_transactions)])\
-                    .sort_values(by=['day', 'same_day'], ascending=[True, False]).reset_index(drop=True)
-
-                # Update section_104_pool accordingly
-                # section_104_pool = df['section_104_pool'].tolist()
-                # for i, row in enumerate(df.itertuples()):
-                #     if row.section_104_pool_update:
-                #         section_104_pool[i:] = [section_104_pool[i] + row.section_104_pool_update]\
-                #                                * (len(section_104_pool) - i)
-
-                # Tag 30 day rule transactions
-                # If there is an acquisition within 30 days of the most recent disposal the 30 day rule applies
-                df = TaxCalculations.tag_thirty_day_rule_transactions(df)
-
-                # Reorder columns
-                df = df[['day', 'action_type', 'initial_asset_quantity', 'final_asset_quantity',
-                         'final_asset_gbp', 'same_day', 'thirty_day_rule', 'section_104_pool',
-                         'section_104_allowable_cost', 'section_104_pool_update', 'thirty_day_rule_remainder_pool',
-                         'thirty_day_rule_allowable_cost', 'same_day_profit_or_loss',
-                         'thirty_day_rule_profit_or_loss', 'section_104_profit_or_loss']]
-
-                # TODO: It's still all wrong because you're updating the S104 pool straight after the same day calcs...
-                #   Need to add a section_104_allowable_cost_update field
-                #   Update 30D tag method to ignore SD acquisitions that have been accounted for in SD calculations
-
-
-                # for row in df.itertuples():
-                #     if row.same_day:
-                #         df = TaxCalculations.same_day_transaction_calculations(row, df)
-                #     if row.thirty_day_rule:
-                #         df = TaxCalculations.thirty_day_rule_transaction_calculations(row, df)
-                #
-                #     df = TaxCalculations.section_104_transaction_calculations(row, df)
-
-                pass
+                # Convert back to asset quantities and GBP for output
+                self.results[asset] = TaxCalculations.to_dataframe(result)
+            metrics.file_written(f'{self.checkpoints_path}{asset}.npz')
+
+        return self.results
 
     @staticmethod
-    def tag_acquisition_or_disposal(df):
-        action_types = []
-        for row in df.itertuples():
-            if row.disposal:
-                action_type = 'disposal'
-            elif row.action in ['exchange_fiat_for_crypto', 'exchange_crypto_for_crypto']:
-                action_type = 'acquisition'
-            else:
-                action_type = None
+    def prepare_transactions(df):
+        """
+        Turn an asset's transactions into aligned int64 arrays of acquisitions and disposals, one element per day
+        """
+
+        # Move quantities to integer base units and GBP values to pence, everything after this is exact
+        df = TaxCalculations.to_fixed_point(df)
+
+        # Tag rows as acquisitions or disposals
+        df = TaxCalculations.tag_acquisition_or_disposal(df)
+
+        # Add day field
+        df['day'] = pd.to_datetime(df['datetime']).dt.floor('D')
+
+        # Keep only the columns required for tax calculations
+        df = df[['day', 'action_type'] + TaxCalculations.amount_columns]
+
+        # Tag same day transactions
+        # df will have max one acquisition and max one disposal per day according to the same day rule
+        df = TaxCalculations.tag_same_day_transactions(df)
+
+        # Line acquisitions and disposals up against each other
+        return TaxCalculations.daily_totals(df)
+
+    def remove_stale_checkpoints(self):
+        """
+        Remove the checkpoints and pool histories of assets no longer in the asset transactions, as the report and
+        holdings are built from every one saved
+        """
+
+        assets = {i.split('.')[0] for i in os.listdir(self.asset_transactions_path) if i.endswith('.csv')}
+
+        for path in [self.checkpoints_path, self.asset_pools_path]:
+            if not os.path.isdir(path):
+                continue
+
+            for i in sorted(os.listdir(path)):
+                if i.endswith('.npz') and i.split('.')[0] not in assets:
+                    os.remove(path + i)
+
+    def load_checkpoint(self, asset):
+        """
+        Return the saved result and pending queue arrays for an asset, or None if there is no checkpoint yet
+        """
+
+        if not os.path.isfile(f'{self.checkpoints_path}{asset}.npz'):
+            return None
+
+        with np.load(f'{self.checkpoints_path}{asset}.npz') as npz:
+            return {k: npz[k] for k in npz.files}
+
+    def save_checkpoint(self, asset, result, queue):
+        if not os.path.exists(self.checkpoints_path):
+            os.makedirs(self.checkpoints_path)
+
+        np.savez(f'{self.checkpoints_path}{asset}.npz', **result, **queue)
+
+    @staticmethod
+    def to_fixed_point(df):
+        """
+        Convert the quantity and GBP columns used by the calculations from floats to int64 base units and pence
+        """
+
+        df['initial_asset_quantity'] = to_base_units(df['initial_asset_quantity'])
+        df['final_asset_quantity'] = to_base_units(df['final_asset_quantity'])
+        df['final_asset_gbp'] = to_pence(df['final_asset_gbp'])
 
-            action_types.append(action_type)
+        return df
+
+    @staticmethod
+    def to_dataframe(result):
+        """
+        Convert the int64 output of match_disposals back to asset quantities and GBP
+        """
+
+        df = pd.DataFrame(result)
+
+        for column in TaxCalculations.quantity_columns:
+            df[column] = from_base_units(df[column])
+
+        for column in TaxCalculations.gbp_columns:
+            df[column] = from_pence(df[column])
+
+        return df
+
+    @staticmethod
+    def tag_acquisition_or_disposal(df):
+        # disposal may be read back as bools or as 'True'/'False' strings depending on the source file
+        disposal = df['disposal'].astype(str) == 'True'
+        acquisition = df['action'].isin(['exchange_fiat_for_crypto', 'exchange_crypto_for_crypto'])
 
-        df['action_type'] = action_types
+        df['action_type'] = np.select([disposal, acquisition], ['disposal', 'acquisition'], default='')
 
-        return df.loc[df['action_type'].notnull()]
+        return df.loc[df['action_type'] != '']
 
     @staticmethod
     def tag_same_day_transactions(df):
-        df_g = df.groupby(['day', 'action_type'], as_index=False).sum()
+        df_g = df.groupby(['day', 'action_type'], as_index=False)[TaxCalculations.amount_columns].sum()
 
-        df_gc = df_g.merge(df_g.groupby('day').size().reset_index(name='count'), left_on='day', right_on='day')
+        # A day with both an acquisition and a disposal is a same day transaction
+        df_g['same_day'] = df_g.groupby('day')['action_type'].transform('size') > 1
+
+        return df_g
+
+    @staticmethod
+    def daily_totals(df):
+        """
+        Return aligned int64 arrays of acquisitions and disposals with one element per day
+        """
 
-        df_gc['same_day'] = df_gc['count'].apply(lambda x: True if x > 1 else False)
+        days = np.sort(df['day'].unique())
 
-        df_gc.drop('count', axis=1, inplace=True)
+        columns = TaxCalculations.amount_columns
+        acquisitions = df.loc[df['action_type'] == 'acquisition'].set_index('day')[columns].reindex(days, fill_value=0)
+        disposals = df.loc[df['action_type'] == 'disposal'].set_index('day')[columns].reindex(days, fill_value=0)
 
-        return df_gc
+        return {
+            'day': np.asarray(days, dtype='datetime64[D]'),
+            'acquisition_quantity': acquisitions['final_asset_quantity'].to_numpy(dtype=np.int64),
+            'acquisition_cost': acquisitions['final_asset_gbp'].to_numpy(dtype=np.int64),
+            'disposal_quantity': disposals['initial_asset_quantity'].to_numpy(dtype=np.int64),
+            'disposal_proceeds': disposals['final_asset_gbp'].to_numpy(dtype=np.int64)
+        }
 
     @staticmethod
-    def tag_thirty_day_rule_transactions(df):
-        most_recent_disposal = dt.strptime('2000-01-01', '%Y-%m-%d')
-        thirty_day_rule_transactions = []
-        for row in df.itertuples():
-            if row.action_type == 'disposal':
-                most_recent_disposal = dt.strptime(row.day, '%Y-%m-%d')
-                thirty_day_rule_transactions.append(False)
-            else:
-                if (dt.strptime(row.day, '%Y-%m-%d') - most_recent_disposal).days <= 30:
-                    thirty_day_rule_transactions.append(True)
-                else:
-                    thirty_day_rule_transactions.append(False)
+    def match_disposals(day, acquisition_quantity, acquisition_cost, disposal_quantity, disposal_proceeds,
+                        pool_quantity=0, pool_allowable_cost=0, pending=None):
+        """
+        Match disposals against acquisitions using the same day rule, then the 30 day rule, then the Section 104 pool.
+
+        All inputs are aligned int64 arrays with one element per day (quantities in base units, GBP in pence) and
+        all outputs are int64 arrays of the same length. The pool and pending 30 day queue can be given to carry on
+        from a checkpoint rather than starting from an empty history.
+
+        Returns the result arrays and the pending 30 day queue at the end of each day.
+        """
+
+        # Same day rule
+        same_day_quantity, same_day_allowable_cost = TaxCalculations.same_day_matching(
+            acquisition_quantity, acquisition_cost, disposal_quantity)
+
+        # Whatever is left of each acquisition is available to the 30 day rule and then the Section 104 pool
+        pool_quantity_in = acquisition_quantity - same_day_quantity
+        pool_cost_in = acquisition_cost - same_day_allowable_cost
+
+        # 30 day rule
+        # Disposals are matched with acquisitions in the following 30 days, earliest acquisition first
+        disposal_remaining = disposal_quantity - same_day_quantity
+        thirty_day_rule, queue = TaxCalculations.thirty_day_rule_matching(day.astype(np.int64), pool_quantity_in,
+                                                                          pool_cost_in, disposal_remaining, pending)
+        thirty_day_rule_quantity, thirty_day_rule_allowable_cost, matched_quantity, matched_cost = thirty_day_rule
+
+        # Section 104
+        # Anything not matched by the rules above goes into, or comes out of, the pool
+        section_104_quantity = disposal_remaining - thirty_day_rule_quantity
+        section_104_allowable_cost_used, section_104_pool, section_104_allowable_cost = \
+            TaxCalculations.section_104_pool_calculations(pool_quantity_in - matched_quantity,
+                                                          pool_cost_in - matched_cost, section_104_quantity,
+                                                          pool_quantity, pool_allowable_cost)
+
+        # Split disposal proceeds between the rules in proportion to the quantity each rule matched
+        same_day_proceeds = TaxCalculations.apportion(disposal_proceeds, same_day_quantity, disposal_quantity)
+        thirty_day_rule_proceeds = TaxCalculations.apportion(disposal_proceeds, thirty_day_rule_quantity,
+                                                             disposal_quantity)
+        section_104_proceeds = disposal_proceeds - same_day_proceeds - thirty_day_rule_proceeds
+
+        result = {
+            'day': day,
+            'acquisition_quantity': acquisition_quantity,
+            'acquisition_cost': acquisition_cost,
+            'disposal_quantity': disposal_quantity,
+            'disposal_proceeds': disposal_proceeds,
+            'same_day_quantity': same_day_quantity,
+            'same_day_allowable_cost': same_day_allowable_cost,
+            'thirty_day_rule_quantity': thirty_day_rule_quantity,
+            'thirty_day_rule_allowable_cost': thirty_day_rule_allowable_cost,
+            'section_104_quantity': section_104_quantity,
+            'section_104_allowable_cost_used': section_104_allowable_cost_used,
+            'section_104_pool': section_104_pool,
+            'section_104_allowable_cost': section_104_allowable_cost,
+            'same_day_profit_or_loss': np.where(same_day_quantity > 0,
+                                                same_day_proceeds - same_day_allowable_cost, 0),
+            'thirty_day_rule_profit_or_loss': thirty_day_rule_proceeds - thirty_day_rule_allowable_cost,
+            'section_104_profit_or_loss': section_104_proceeds - section_104_allowable_cost_used
+        }
+
+        return result, queue
+
+    @staticmethod
+    def same_day_matching(acquisition_quantity, acquisition_cost, disposal_quantity):
+        """
+        Return the quantity matched and its allowable cost for each day under the same day rule
+        """
 
-        df['thirty_day_rule'] = thirty_day_rule_transactions
+        # There is at most one acquisition and one disposal per day so this is a straight element-wise match
+        same_day_quantity = np.minimum(acquisition_quantity, disposal_quantity)
+        same_day_allowable_cost = TaxCalculations.apportion(acquisition_cost, same_day_quantity, acquisition_quantity)
 
-        return df
+        return same_day_quantity, same_day_allowable_cost
 
     @staticmethod
-    def same_day_transaction_calculations(row, df):
-        if row.action_type == 'acquisition':
-            df_day = df.loc[df['day'] == row.day]
-            acquisition_quantity = df_day.loc[df_day['action_type'] == 'acquisition']['final_asset_quantity'].tolist()[0]
-            acquisition_ac = df_day.loc[df_day['action_type'] == 'acquisition']['final_asset_gbp'].tolist()[0]
-            disposal_quantity = df_day.loc[df_day['action_type'] == 'disposal']['initial_asset_quantity'].tolist()[0]
-            disposal_ac = df_day.loc[df_day['action_type'] == 'disposal']['final_asset_gbp'].tolist()[0]
-
-            new_transaction = None
-
-            if disposal_quantity == acquisition_quantity:
-                # Disposal is equal to acquisition so calculation is isolated and Section 104 pool does not change
-                # Update acquisition row
-                df.at[row.Index, 'section_104_pool'] = df.at[row.Index - 1, 'section_104_pool']
-                df.at[row.Index, 'section_104_allowable_cost'] = df.at[row.Index - 1, 'section_104_allowable_cost']
-                # Update disposal row
-                df.at[row.Index + 1, 'section_104_pool'] = df.at[row.Index - 1, 'section_104_pool']
-                df.at[row.Index + 1, 'section_104_allowable_cost'] = df.at[row.Index - 1, 'section_104_allowable_cost']
-                df.at[row.Index + 1, 'same_day_profit_or_loss'] = disposal_ac - acquisition_ac
-            elif disposal_quantity > acquisition_quantity:
-                # Disposal is greater than acquisition so same day gain is only calculated for matched assets
-                # Remaining acquisition is held separate to S104 pool in case 30 day rule applies
-                less_allowable_costs = acquisition_ac * (disposal_quantity / acquisition_quantity)
-                gain = round(disposal_ac - less_allowable_costs, 2)
-                remaining_disposal = round(disposal_quantity - acquisition_quantity, 8)
-
-                # Update acquisition row (could be overwritten when applying 30 day rule)
-                df.at[row.Index, 'section_104_pool'] = df.at[row.Index - 1, 'section_104_pool']
-                df.at[row.Index, 'section_104_allowable_cost'] = df.at[row.Index - 1, 'section_104_allowable_cost']
-                # Update disposal row (could be overwritten when applying 30 day rule)
-                df.at[row.Index + 1, 'section_104_pool'] = df.at[row.Index - 1, 'section_104_pool']
-                df.at[row.Index + 1, 'section_104_allowable_cost'] = df.at[row.Index - 1, 'section_104_allowable_cost']
-                # df.at[row.Index + 1, 'same_day_remainder_pool'] = remaining_disposal
-                # df.at[row.Index + 1, 'same_day_profit_or_loss'] = gain
-
-                # Add excess disposal as a new disposal record that will be handled by the Section 104 method
-                d = {
-                    'day': row.day,
-                    'action_type': 'disposal',
-                    'initial_asset_quantity': remaining_disposal,
-                    'final_asset_quantity': None,
-                    'final_asset_gbp': round(acquisition_ac * (remaining_disposal / acquisition_quantity), 2),
-                    'same_day': False,
-                    'thirty_day_rule': False,
-                    'section_104_pool': round(df.at[row.Index - 1, 'section_104_pool'], 8),
-                    'section_104_allowable_cost': round(df.at[row.Index - 1, 'section_104_allowable_cost'] - (acquisition_ac * (remaining_disposal / acquisition_quantity)), 2),
-                    'section_104_pool_update': round(-1 * remaining_disposal, 8),
-                    'thirty_day_rule_remainder_pool': 0,
-                    'thirty_day_rule_allowable_cost': 0,
-                    'same_day_profit_or_loss': 0,
-                    'thirty_day_rule_profit_or_loss': 0,
-                    'section_104_profit_or_loss': 0
-                }
-                new_transaction = pd.DataFrame(d, index=[0])
-            else:
-                # Acquisition is greater than disposal so gain is calculated for entire disposal
-                # Remaining acquisition is held separate to S104 pool in case 30 day rule applies
-                less_allowable_costs = acquisition_ac * (disposal_quantity / acquisition_quantity)
-                gain = round(disposal_ac - less_allowable_costs, 2)
-                remaining_acquisition = round(acquisition_quantity - disposal_quantity, 8)
-
-                # Update acquisition row (could be overwritten when applying 30 day rule)
-                df.at[row.Index, 'section_104_pool'] = df.at[row.Index - 1, 'section_104_pool']
-                df.at[row.Index, 'section_104_allowable_cost'] = df.at[row.Index - 1, 'section_104_allowable_cost']
-                # df.at[row.Index, 'same_day_remainder_pool'] = remaining_acquisition
-                # Update disposal row (could be overwritten when applying 30 day rule)
-                df.at[row.Index + 1, 'section_104_pool'] = df.at[row.Index - 1, 'section_104_pool']
-                df.at[row.Index + 1, 'section_104_allowable_cost'] = df.at[row.Index - 1, 'section_104_allowable_cost']
-                df.at[row.Index + 1, 'same_day_profit_or_loss'] = gain
-
-                # Add excess acquisition as a new acquisition record that will be handled by the Section 104 method
-                d = {
-                    'day': row.day,
-                    'action_type': 'acquisition',
-                    'initial_asset_quantity': remaining_acquisition,
-                    'final_asset_quantity': None,
-                    'final_asset_gbp': None,
-                    'same_day': False,
-                    'thirty_day_rule': False,
-                    'section_104_pool': round(df.at[row.Index - 1, 'section_104_pool'], 8),
-                    'section_104_allowable_cost': df.at[row.Index - 1, 'section_104_allowable_cost'],
-                    'section_104_pool_update': round(remaining_acquisition, 8),
-                    'thirty_day_rule_remainder_pool': 0,
-                    'thirty_day_rule_allowable_cost': 0,
-                    'same_day_profit_or_loss': 0,
-                    'thirty_day_rule_profit_or_loss': 0,
-                    'section_104_profit_or_loss': 0
-                }
-                new_transaction = pd.DataFrame(d, index=[0])
+    def incremental_match_disposals(daily, checkpoint):
+        """
+        Recalculate only the days that new or changed transactions can affect, carrying on from a checkpoint.
+
+        An acquisition can be matched under the 30 day rule with disposals up to 30 days before it, so everything
+        from 30 days before the earliest changed day is recalculated, starting from the pool and pending 30 day
+        queue saved at that day boundary. Earlier days are taken from the checkpoint as they are.
+        """
+
+        day = daily['day']
+        previous_day = checkpoint['day']
+
+        # Find the earliest day where the inputs differ from the ones the checkpoint was made from
+        n = min(len(day), len(previous_day))
+        changed = day[:n] != previous_day[:n]
+        for column in TaxCalculations.input_columns:
+            changed |= daily[column][:n] != checkpoint[column][:n]
+
+        if changed.any():
+            first_changed = int(np.argmax(changed))
+        elif len(day) != len(previous_day):
+            first_changed = n
         else:
-            new_transaction = None
+            first_changed = None
 
-        return df, new_transaction
+        if first_changed is None:
+            # Nothing has changed
+            restart = len(day)
+        else:
+            changed_day = min(i[first_changed] for i in (day, previous_day) if first_changed < len(i))
+            restart = int(np.searchsorted(day, changed_day - np.timedelta64(30, 'D'), side='left'))
+
+        # Pool and pending queue at the start of the restart day
+        if restart == 0:
+            pool_quantity, pool_allowable_cost, pending = 0, 0, None
+        else:
+            pool_quantity = checkpoint['section_104_pool'][restart - 1]
+            pool_allowable_cost = checkpoint['section_104_allowable_cost'][restart - 1]
+            start, end = checkpoint['queue_offsets'][restart - 1:restart + 1]
+            pending = list(zip(checkpoint['queue_day'][start:end].tolist(),
+                               checkpoint['queue_quantity'][start:end].tolist()))
+
+        result, queue = TaxCalculations.match_disposals(**{k: v[restart:] for k, v in daily.items()},
+                                                        pool_quantity=pool_quantity,
+                                                        pool_allowable_cost=pool_allowable_cost,
+                                                        pending=pending)
+
+        # Stitch the untouched days from the checkpoint onto the recalculated ones
+        result = {k: np.concatenate([checkpoint[k][:restart], v]) for k, v in result.items()}
+
+        previous_offsets = checkpoint['queue_offsets'][:restart + 1]
+        queue = {
+            'queue_offsets': np.concatenate([previous_offsets, queue['queue_offsets'][1:] + previous_offsets[-1]]),
+            'queue_day': np.concatenate([checkpoint['queue_day'][:previous_offsets[-1]], queue['queue_day']]),
+            'queue_quantity': np.concatenate([checkpoint['queue_quantity'][:previous_offsets[-1]],
+                                              queue['queue_quantity']])
+        }
+
+        return result, queue
 
     @staticmethod
-    def thirty_day_rule_transaction_calculations(row, df):
+    def thirty_day_rule_matching(day_number, acquisition_quantity, acquisition_cost, disposal_quantity, pending=None):
+        """
+        Match each disposal with acquisitions made in the 30 days that follow it.
+
+        Days are swept in order while keeping a queue of disposals that still have quantity left to match. Each
+        acquisition is offered to the earliest pending disposal first, which is the same as matching each disposal
+        in turn against the earliest acquisitions in its window.
+
+        pending is a list of (day number, quantity) for disposals before the first day that are still waiting to be
+        matched. Those disposals take their share of acquisitions but their own results are not returned, as they
+        were already settled when the checkpoint was made.
+
+        Returns the quantity and allowable cost matched for each disposal day, the quantity and cost taken from
+        each acquisition day and the pending queue at the end of each day in compressed row form.
+        """
+
+        n = len(day_number)
+        day_number = day_number.tolist()
+        acquisition_quantity = acquisition_quantity.tolist()
+        acquisition_cost = acquisition_cost.tolist()
+        disposal_quantity = disposal_quantity.tolist()
+
+        thirty_day_rule_quantity = [0] * n
+        thirty_day_rule_allowable_cost = [0] * n
+        matched_quantity = [0] * n
+        matched_cost = [0] * n
+
+        queue_offsets = [0]
+        queue_day = []
+        queue_quantity = []
+
+        # Each entry is [day number of the disposal, quantity still to be matched, index of the disposal day]
+        pending = deque([day, quantity, None] for day, quantity in (pending or []))
+        for i in range(n):
+            # Disposals more than 30 days ago can no longer be matched
+            while pending and day_number[i] - pending[0][0] > 30:
+                pending.popleft()
+
+            available_quantity = acquisition_quantity[i]
+            available_cost = acquisition_cost[i]
+            for entry in pending:
+                if not available_quantity:
+                    break
+
+                quantity = min(entry[1], available_quantity)
+                cost = scale_divide(available_cost, quantity, available_quantity)
+
+                if entry[2] is not None:
+                    thirty_day_rule_quantity[entry[2]] += quantity
+                    thirty_day_rule_allowable_cost[entry[2]] += cost
+                matched_quantity[i] += quantity
+                matched_cost[i] += cost
+
+                entry[1] -= quantity
+                available_quantity -= quantity
+                available_cost -= cost
+
+            while pending and not pending[0][1]:
+                pending.popleft()
+
+            if disposal_quantity[i]:
+                pending.append([day_number[i], disposal_quantity[i], i])
+
+            # Checkpoint the queue at the day boundary
+            for entry in pending:
+                queue_day.append(entry[0])
+                queue_quantity.append(entry[1])
+            queue_offsets.append(len(queue_day))
+
+        queue = {
+            'queue_offsets': np.array(queue_offsets, dtype=np.int64),
+            'queue_day': np.array(queue_day, dtype=np.int64),
+            'queue_quantity': np.array(queue_quantity, dtype=np.int64)
+        }
+
+        return (np.array(thirty_day_rule_quantity, dtype=np.int64),
+                np.array(thirty_day_rule_allowable_cost, dtype=np.int64),
+                np.array(matched_quantity, dtype=np.int64),
+                np.array(matched_cost, dtype=np.int64)), queue
 
-        # Any remaining assets outside of the Section 104 pool are now added back in and the allowable cost updated
+    @staticmethod
+    def section_104_pool_calculations(quantity_in, cost_in, quantity_out, quantity=0, allowable_cost=0):
+        """
+        Run the Section 104 pool forward one day at a time.
+
+        Returns the allowable cost taken out of the pool each day and the pool quantity and allowable cost at the
+        end of each day. The pool cost is a running average so each day depends on the last and the loop cannot be
+        replaced by a cumulative sum, but it only runs once per day and stays in exact integer arithmetic. quantity
+        and allowable_cost are the pool going into the first day.
+        """
+
+        n = len(quantity_in)
+        quantity_in = quantity_in.tolist()
+        cost_in = cost_in.tolist()
+        quantity_out = quantity_out.tolist()
+
+        allowable_cost_used = [0] * n
+        pool_quantity = [0] * n
+        pool_allowable_cost = [0] * n
+
+        quantity = int(quantity)
+        allowable_cost = int(allowable_cost)
+        for i in range(n):
+            quantity += quantity_in[i]
+            allowable_cost += cost_in[i]
+
+            if quantity_out[i]:
+                if quantity_out[i] >= quantity:
+                    # Disposing of more than the pool holds, most likely due to missing acquisition history
+                    cost = allowable_cost
+                    quantity = 0
+                else:
+                    cost = scale_divide(allowable_cost, quantity_out[i], quantity)
+                    quantity -= quantity_out[i]
 
+                allowable_cost -= cost
+                allowable_cost_used[i] = cost
 
-        return df
+            pool_quantity[i] = quantity
+            pool_allowable_cost[i] = allowable_cost
+
+        return (np.array(allowable_cost_used, dtype=np.int64),
+                np.array(pool_quantity, dtype=np.int64),
+                np.array(pool_allowable_cost, dtype=np.int64))
 
     @staticmethod
-    def section_104_transaction_calculations(row, df):
-        if row.action_type == 'acquisition':  # TODO: Ensure this only considers funds not already accounted for with SD or 30D
-            # Handle very first acquisition
-            if row.Index == 0:
-                df.at[row.Index, 'section_104_pool'] = round(row.final_asset_quantity, 8)
-                df.at[row.Index, 'section_104_allowable_cost'] = round(row.final_asset_gbp, 2)
-            else:
-                df.at[row.Index, 'section_104_pool'] = round(df.at[row.Index - 1, 'section_104_pool']\
-                                                             + row.final_asset_quantity, 8)
-                df.at[row.Index, 'section_104_allowable_cost'] = round(df.at[row.Index - 1, 'section_104_allowable_cost']\
-                                                                    + row.final_asset_gbp, 2)
-        else:
-            less_allowable_costs = df.at[row.Index-1, 'section_104_allowable_cost']\
-                                   * (row.initial_asset_quantity / df.at[row.Index - 1, 'section_104_pool'])
-            gain = row.final_asset_gbp - less_allowable_costs
+    def apportion(amount, part, whole):
+        """
+        Return the share of amount that part represents of whole, zero where whole is zero
+        """
 
-            df.at[row.Index, 'section_104_pool'] = round(df.at[row.Index - 1, 'section_104_pool']\
-                                                         - row.initial_asset_quantity, 8)
-            df.at[row.Index, 'section_104_allowable_cost'] = round(df.at[row.Index - 1, 'section_104_allowable_cost']\
-                                                             - less_allowable_costs, 2)
-            df.at[row.Index, 'section_104_profit_or_loss'] = round(gain, 2)
+        share = np.zeros(len(amount), dtype=np.int64)
+        mask = (part != 0) & (whole != 0)
+        share[mask] = scale_divide(amount[mask], part[mask], whole[mask])
 
-        return df
+        return share
 
 
 if __name__ == '__main__':
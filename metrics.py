@@ -0,0 +1,171 @@
+import os
+import re
+import json
+import time
+import bisect
+import platform
+import threading
+import requests
+from contextlib import contextmanager
+from datetime import datetime as dt
+from urllib.parse import urlsplit
+
+# Upper bounds (ms) of the HTTP latency histogram buckets, anything slower goes in the last '+inf' bucket
+LATENCY_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+# Path segments that are ids rather than part of the endpoint (uuids, long numbers and hashes)
+ID_SEGMENT = re.compile(r'^([0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}|\d{4,}|[0-9a-fA-F]{24,})$')
+
+
+def endpoint_name(url):
+    """
+    Endpoint an HTTP call counts towards, host and path with ids replaced, e.g. 'api.coinbase.com/v2/accounts/{id}/buys'
+    """
+
+    parts = urlsplit(url)
+    path = '/'.join('{id}' if ID_SEGMENT.match(i) else i for i in parts.path.split('/'))
+
+    return f'{parts.netloc}{path}'
+
+
+class Metrics:
+    """
+    Run wide stage timings and counters, collected from every part of the pipeline and written as a JSON run report.
+
+    Stages are timed with the stage context manager and can record rows in and out. HTTP calls made through requests
+    are timed per endpoint once install_http_hook has been called. Cache hits, misses and evictions and file
+    bytes are counted by name. All methods are thread safe so concurrent connectors can share the run's instance.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.original_send = None
+        self.reset()
+
+    def reset(self):
+        self.started = dt.now()
+        self.stages = {}
+        self.http = {}
+        self.caches = {}
+        self.bytes = {'read': {}, 'written': {}}
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        """
+        Time a block of work, the yielded dict can be given rows_out (and rows_in) before the block ends
+
+        with metrics.stage('binance') as stage:
+            df = binance.get_binance_transactions()
+            stage['rows_out'] = len(df)
+        """
+
+        record = {'rows_in': rows_in, 'rows_out': None}
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'rows_in': 0, 'rows_out': 0})
+                stage['calls'] += 1
+                stage['seconds'] += seconds
+                for k in ['rows_in', 'rows_out']:
+                    if record[k] is not None:
+                        stage[k] += int(record[k])
+
+    def http_call(self, endpoint, seconds, status, size):
+        milliseconds = seconds * 1000
+        with self.lock:
+            call = self.http.setdefault(endpoint, {'calls': 0, 'errors': 0, 'seconds': 0.0, 'bytes': 0,
+                                                   'histogram': [0] * (len(LATENCY_BUCKETS) + 1)})
+            call['calls'] += 1
+            call['errors'] += status >= 400
+            call['seconds'] += seconds
+            call['bytes'] += size
+            call['histogram'][bisect.bisect_left(LATENCY_BUCKETS, milliseconds)] += 1
+
+    def cache(self, name, hits=0, misses=0, evictions=0):
+        with self.lock:
+            cache = self.caches.setdefault(name, {'hits': 0, 'misses': 0, 'evictions': 0})
+            cache['hits'] += hits
+            cache['misses'] += misses
+            cache['evictions'] += evictions
+
+    def file_read(self, path):
+        self.count_bytes('read', path)
+
+    def file_written(self, path):
+        self.count_bytes('written', path)
+
+    def count_bytes(self, direction, path):
+        if not os.path.isfile(path):
+            return
+
+        size = os.path.getsize(path)
+        with self.lock:
+            self.bytes[direction][path] = self.bytes[direction].get(path, 0) + size
+
+    def install_http_hook(self):
+        """
+        Time every request sent through requests, the connectors call requests.get directly
+        """
+
+        if self.original_send is not None:
+            return
+
+        self.original_send = requests.Session.send
+        metrics = self
+
+        def send(session, request, **kwargs):
+            start = time.perf_counter()
+            response = metrics.original_send(session, request, **kwargs)
+            metrics.http_call(endpoint_name(request.url), time.perf_counter() - start, response.status_code,
+                              len(response.content))
+            return response
+
+        requests.Session.send = send
+
+    def remove_http_hook(self):
+        if self.original_send is not None:
+            requests.Session.send = self.original_send
+            self.original_send = None
+
+    def report(self):
+        with self.lock:
+            caches = {k: {**v, 'hit_ratio': round(v['hits'] / (v['hits'] + v['misses']), 4)
+                          if v['hits'] + v['misses'] else None}
+                      for k, v in self.caches.items()}
+
+            http = {}
+            for endpoint, call in self.http.items():
+                http[endpoint] = {
+                    'calls': call['calls'],
+                    'errors': call['errors'],
+                    'seconds': round(call['seconds'], 6),
+                    'mean_ms': round(call['seconds'] * 1000 / call['calls'], 3),
+                    'bytes': call['bytes'],
+                    'histogram_ms': dict(zip([str(i) for i in LATENCY_BUCKETS] + ['+inf'], call['histogram']))
+                }
+
+            return {
+                'started': self.started.strftime('%Y-%m-%d %H:%M:%S'),
+                'wall_seconds': round((dt.now() - self.started).total_seconds(), 6),
+                'python': platform.python_version(),
+                'stages': {k: {**v, 'seconds': round(v['seconds'], 6)} for k, v in self.stages.items()},
+                'http': http,
+                'http_calls': sum(i['calls'] for i in self.http.values()),
+                'caches': caches,
+                'bytes': {k: {'total': sum(v.values()), 'files': dict(v)} for k, v in self.bytes.items()}
+            }
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=4)
+
+
+# Shared by the whole run
+metrics = Metrics()
@@ -1,20 +1,40 @@
 from apis.get_all_transactions import GetAllTransactions
+from calculations.tax import TaxCalculations
+from calculations.report import TaxReport
+from metrics import metrics
 
 
 class CryptoTaxUK:
-    def __init__(self):
-        self.save_path = 'todo'  # TODO: Fix this
+    def __init__(self, concurrent_ingestion=False, statements_only=False):
+        self.concurrent_ingestion = concurrent_ingestion
+        self.statements_only = statements_only
+        self.save_path = 'data/reports/'
+        self.run_report_path = 'data/reports/run_report.json'
 
     def execute(self):
-        # Generate complete dataset of transactions for each asset
-        x = GetAllTransactions()
-        x.get_all_transactions()
-
-        # Perform all tax related calculations
-
-        # Generate a final report
-
-        pass
+        # Time every stage and HTTP call of the run
+        metrics.reset()
+        metrics.install_http_hook()
+
+        try:
+            # Generate complete dataset of transactions for each asset
+            with metrics.stage('get_all_transactions'):
+                x = GetAllTransactions(concurrent=self.concurrent_ingestion, statements_only=self.statements_only)
+                x.get_all_transactions()
+
+            # Perform all tax related calculations
+            with metrics.stage('tax_calculations'):
+                tax = TaxCalculations()
+                tax.tax_calculations()
+
+            # Generate a final report
+            with metrics.stage('tax_report'):
+                report = TaxReport.load(tax.checkpoints_path)
+                report.save(self.save_path)
+            print(report.sa108_summary().to_string(index=False))
+        finally:
+            metrics.remove_http_hook()
+            metrics.save(self.run_report_path)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,126 @@
+import pandas as pd
+import pytest
+
+from apis.exchanges.coinbase import Coinbase
+
+
+def transaction(type, amount, gbp, title='', subtitle='', status='completed', **extra):
+    """
+    Return a raw transaction as the Coinbase API gives it, with the asset's amount and its value in GBP
+    """
+
+    return {'id': f'{type}-1', 'type': type, 'status': status, 'created_at': '2021-01-04T10:00:00Z',
+            'amount': {'amount': str(amount), 'currency': 'X'},
+            'native_amount': {'amount': str(gbp), 'currency': 'GBP'},
+            'details': {'title': title, 'subtitle': subtitle}, **extra}
+
+
+# One transaction of each type and send action with the columns the previous per type handler gave it, every other
+# column empty
+CASES = {
+    'trade_converted_from': (
+        'BTC', transaction('trade', -0.1, -500, 'Converted from BTC', trade={'id': 't1'}),
+        {'action': 'exchange_crypto_for_crypto', 'type': 'trade', 'disposal': True, 'initial_asset_quantity': 0.1,
+         'initial_asset_currency': 'BTC', 'initial_asset_location': 'Coinbase', 'final_asset_location': 'Coinbase',
+         'fee_type': 'exchange', 'source_transaction_id': 'trade-1', 'source_trade_id': 't1'}),
+    'trade_converted_to': (
+        'ETH', transaction('trade', 1.0, 500, 'Converted to ETH', trade={'id': 't1'}),
+        {'action': 'exchange_crypto_for_crypto', 'type': 'trade', 'disposal': True,
+         'initial_asset_location': 'Coinbase', 'final_asset_quantity': 1.0, 'final_asset_currency': 'ETH',
+         'final_asset_gbp': 500.0, 'final_asset_location': 'Coinbase', 'fee_type': 'exchange',
+         'source_transaction_id': 'trade-1', 'source_trade_id': 't1'}),
+    'send_earn': (
+        'ETH', transaction('send', 0.01, 20, 'Earned', 'From Coinbase Earn', **{'from': {'id': 'f1'}}),
+        {'action': 'gifted_crypto', 'type': 'send', 'disposal': False, 'final_asset_quantity': 0.01,
+         'final_asset_currency': 'ETH', 'final_asset_gbp': 20.0, 'final_asset_location': 'Coinbase',
+         'source_transaction_id': 'send-1', 'source_trade_id': 'f1'}),
+    'send_sent_network_fee': (
+        'BTC', transaction('send', -0.2, -800, 'Sent BTC', 'To x', to={'address': 'addr'}, application={'id': 'a1'},
+                           network={'transaction_fee': {'amount': '0.001', 'currency': 'BTC'}}),
+        {'action': 'withdraw_crypto', 'type': 'send', 'disposal': False, 'initial_asset_quantity': 0.2,
+         'initial_asset_currency': 'BTC', 'initial_asset_location': 'Coinbase', 'final_asset_address': 'addr',
+         'fee_type': 'transfer', 'fee_quantity': 0.001, 'fee_currency': 'BTC', 'source_transaction_id': 'send-1',
+         'source_trade_id': 'a1'}),
+    'send_sent_transaction_fee': (
+        'ETH', transaction('send', -1, -2, 'Sent ETH', to={'address': 'a'},
+                           transaction_fee={'amount': '-0.01', 'currency': 'ETH'}),
+        {'action': 'withdraw_crypto', 'type': 'send', 'disposal': False, 'initial_asset_quantity': 1.0,
+         'initial_asset_currency': 'ETH', 'initial_asset_location': 'Coinbase', 'final_asset_address': 'a',
+         'fee_type': 'transfer', 'fee_quantity': 0.01, 'fee_currency': 'ETH', 'source_transaction_id': 'send-1'}),
+    'send_received': (
+        'BTC', transaction('send', 0.3, 900, 'Received BTC', 'From y'),
+        {'action': 'deposit_crypto', 'type': 'send', 'disposal': False, 'final_asset_quantity': 0.3,
+         'final_asset_currency': 'BTC', 'final_asset_gbp': 900.0, 'final_asset_location': 'Coinbase',
+         'source_transaction_id': 'send-1'}),
+    # Kept without an action to be reported, now with its type where the previous handler left that empty
+    'send_unrecognised': (
+        'ETH', transaction('send', 1, 2, 'Weird ETH'),
+        {'type': 'send', 'disposal': False, 'source_transaction_id': 'send-1'}),
+    'exchange_deposit': (
+        'BTC', transaction('exchange_deposit', -0.1, -300, application={'id': 'a2'}),
+        {'action': 'deposit_crypto', 'type': 'exchange_deposit', 'disposal': False, 'initial_asset_quantity': 0.1,
+         'initial_asset_currency': 'BTC', 'initial_asset_location': 'Coinbase', 'final_asset_quantity': 0.1,
+         'final_asset_currency': 'BTC', 'final_asset_gbp': 300.0, 'final_asset_location': 'Coinbase Pro',
+         'fee_type': 'exchange', 'source_transaction_id': 'exchange_deposit-1', 'source_trade_id': 'a2'}),
+    'exchange_deposit_fiat': (
+        'GBP', transaction('exchange_deposit', -5, -5),
+        {'action': 'deposit_fiat', 'type': 'exchange_deposit', 'disposal': False, 'initial_asset_quantity': 5.0,
+         'initial_asset_currency': 'GBP', 'initial_asset_location': 'Coinbase', 'final_asset_quantity': 5.0,
+         'final_asset_currency': 'GBP', 'final_asset_gbp': 5.0, 'final_asset_location': 'Coinbase Pro',
+         'fee_type': 'exchange'}),
+    'exchange_withdrawal': (
+        'BTC', transaction('exchange_withdrawal', 0.1, 300, subtitle='From Coinbase Pro'),
+        {'action': 'withdraw_crypto', 'type': 'exchange_withdrawal', 'disposal': False, 'initial_asset_quantity': 0.1,
+         'initial_asset_currency': 'BTC', 'initial_asset_location': 'Coinbase Pro', 'final_asset_quantity': 0.1,
+         'final_asset_currency': 'BTC', 'fee_type': 'transfer', 'source_transaction_id': 'exchange_withdrawal-1'}),
+    'pro_deposit': (
+        'BTC', transaction('pro_deposit', -0.1, -300, application={'id': 'a3'}),
+        {'action': 'withdraw_crypto', 'type': 'pro_deposit', 'disposal': False, 'initial_asset_quantity': 0.1,
+         'initial_asset_currency': 'BTC', 'initial_asset_location': 'Coinbase', 'final_asset_quantity': 0.1,
+         'final_asset_currency': 'BTC', 'final_asset_gbp': 300.0, 'final_asset_location': 'Coinbase Pro',
+         'fee_type': 'exchange', 'source_transaction_id': 'pro_deposit-1', 'source_trade_id': 'a3'}),
+    'pro_withdrawal': (
+        'BTC', transaction('pro_withdrawal', 0.1, 300, application={'id': 'a4'}),
+        {'action': 'withdraw_crypto', 'type': 'pro_withdrawal', 'disposal': False, 'initial_asset_quantity': 0.1,
+         'initial_asset_currency': 'BTC', 'initial_asset_location': 'Coinbase Pro', 'final_asset_quantity': 0.1,
+         'final_asset_currency': 'BTC', 'fee_type': 'transfer', 'source_transaction_id': 'pro_withdrawal-1',
+         'source_trade_id': 'a4'}),
+    'fiat_deposit': (
+        'GBP', transaction('fiat_deposit', 100, 100),
+        {'action': 'deposit_fiat', 'type': 'fiat_deposit', 'disposal': False, 'final_asset_quantity': 100.0,
+         'final_asset_currency': 'GBP', 'final_asset_gbp': 100.0, 'final_asset_location': 'Coinbase',
+         'fee_type': 'transfer', 'source_transaction_id': 'fiat_deposit-1'}),
+    'fiat_withdrawal': (
+        'GBP', transaction('fiat_withdrawal', -50, -50),
+        {'action': 'withdraw_fiat', 'type': 'fiat_withdrawal', 'disposal': False, 'initial_asset_quantity': 50.0,
+         'initial_asset_currency': 'GBP', 'initial_asset_location': 'Coinbase', 'final_asset_quantity': 50.0,
+         'final_asset_currency': 'GBP', 'final_asset_gbp': 50.0, 'fee_type': 'transfer',
+         'source_transaction_id': 'fiat_withdrawal-1'}),
+}
+
+
+@pytest.mark.parametrize('case', CASES)
+def test_transaction_map(case):
+    asset, raw, expected = CASES[case]
+
+    df = Coinbase.create_transactions_dataframe({asset: [raw]})
+
+    assert len(df) == 1
+    row = df.iloc[0]
+    assert row['asset'] == asset
+    assert row['datetime'] == pd.Timestamp('2021-01-04 10:00:00')
+
+    given = {k: v for k, v in row.items() if k not in ('asset', 'datetime') and not pd.isna(v)}
+    assert given == expected
+
+
+def test_buys_and_pending_dropped():
+    history = {'BTC': [transaction('buy', 0.1, 300), transaction('send', 1, 1, 'Received BTC', status='pending')],
+               'GBP': [transaction('fiat_deposit', 100, 100)]}
+
+    df = Coinbase.create_transactions_dataframe(history)
+
+    assert df['type'].tolist() == ['fiat_deposit']
+
+    # Nothing left is no dataframe, as for an account without transactions
+    assert Coinbase.create_transactions_dataframe({'BTC': history['BTC'][:2]}) is None
@@ -0,0 +1,50 @@
+import numpy as np
+
+from calculations.fixed_point import INT64_MAX, scale_divide, to_base_units, to_pence, from_pence
+
+
+def test_scale_divide_rounds_half_up():
+    assert scale_divide(5, 1, 2) == 3
+    assert scale_divide(7, 1, 3) == 2
+    assert scale_divide(8, 1, 3) == 3
+    # Half up is towards positive infinity for negative values too
+    assert scale_divide(-5, 1, 2) == -2
+    assert scale_divide(-7, 1, 2) == -3
+
+
+def test_scale_divide_arrays_match_scalars():
+    numerator = np.array([5, 7, 8, -5, 0, 1000001], dtype=np.int64)
+    multiplier = np.array([1, 1, 1, 1, 3, 3], dtype=np.int64)
+    divisor = np.array([2, 3, 3, 2, 7, 4], dtype=np.int64)
+
+    result = scale_divide(numerator, multiplier, divisor)
+
+    assert result.dtype == np.int64
+    assert result.tolist() == [scale_divide(int(n), int(m), int(d)) for n, m, d in zip(numerator, multiplier, divisor)]
+
+
+def test_scale_divide_overflow_stays_exact():
+    # 21 million BTC in base units times a pool cost in pence overflows int64 in the intermediate product
+    numerator = np.array([2_100_000_000_000_000, 123_456_789_012], dtype=np.int64)
+    multiplier = np.array([987_654_321_098, 3], dtype=np.int64)
+    divisor = np.array([1_000_000_000_007, 7], dtype=np.int64)
+    assert 2 * int(numerator[0]) * int(multiplier[0]) > INT64_MAX
+
+    result = scale_divide(numerator, multiplier, divisor)
+
+    expected = [(2 * int(n) * int(m) + int(d)) // (2 * int(d)) for n, m, d in zip(numerator, multiplier, divisor)]
+    assert result.dtype == np.int64
+    assert result.tolist() == expected
+
+
+def test_scale_divide_empty():
+    result = scale_divide(np.array([], dtype=np.int64), 3, 7)
+
+    assert result.dtype == np.int64
+    assert len(result) == 0
+
+
+def test_fixed_point_conversion():
+    assert to_base_units([0.1, 1e-8, np.nan]).tolist() == [10_000_000, 1, 0]
+    assert to_pence([0.1 + 0.2, 19.99]).tolist() == [30, 1999]
+    assert from_pence(np.array([1999])).tolist() == [19.99]
@@ -0,0 +1,79 @@
+import numpy as np
+
+from apis.forex import ForexCache
+
+# Friday evening, the following Monday and a ten day holiday gap after it
+BARS = [
+    ('2021-01-08 21:58', 0.9001),
+    ('2021-01-08 21:59', 0.9002),
+    ('2021-01-11 00:00', 0.9010),
+    ('2021-01-11 00:01', 0.9011),
+    ('2021-01-21 00:00', 0.9100),
+]
+
+
+def cache(tmp_path, monkeypatch, **kwargs):
+    """
+    Return a cache at tmp_path whose downloads are BARS, counting the downloads
+    """
+
+    downloads = []
+
+    def download(url):
+        downloads.append(url)
+        return b''
+
+    def read_download(self, pair, content, start):
+        times = np.array([t for t, _ in BARS], dtype='datetime64[m]')
+        close = np.array([c for _, c in BARS])
+        return times[times >= start], close[times >= start]
+
+    monkeypatch.setattr(ForexCache, 'download', staticmethod(download))
+    monkeypatch.setattr(ForexCache, 'read_download', read_download)
+
+    return ForexCache(path=f'{tmp_path}/', **kwargs), downloads
+
+
+def test_close_as_of(tmp_path, monkeypatch):
+    forex, downloads = cache(tmp_path, monkeypatch)
+
+    # A bar's own minute and the seconds after it
+    assert forex.close('EURGBP', '2021-01-08 21:59:00') == 0.9002
+    assert forex.close('EURGBP', '2021-01-11 00:00:59') == 0.9010
+
+    # Over the weekend the last close before it
+    assert forex.close('EURGBP', '2021-01-09 12:00:00') == 0.9002
+    assert forex.close('EURGBP', '2021-01-10 23:59:59') == 0.9002
+
+    # Nothing before the first bar
+    assert forex.close('EURGBP', '2021-01-08 21:57:59') is None
+
+    assert len(downloads) == 1
+
+
+def test_closes_past_coverage(tmp_path, monkeypatch):
+    forex, downloads = cache(tmp_path, monkeypatch)
+
+    closes = forex.closes('EURGBP', ['2021-01-08 21:58:00', '2021-01-21 00:00:00', '2021-01-21 00:01:00'])
+
+    # The last minute FXDD cover is not carried on past the download
+    assert closes[:2].tolist() == [0.9001, 0.9100]
+    assert np.isnan(closes[2])
+
+    # Asking again within the download interval does not download again
+    assert forex.close('EURGBP', '2021-01-22 00:00:00') is None
+    assert len(downloads) == 1
+
+
+def test_max_staleness(tmp_path, monkeypatch):
+    forex, _ = cache(tmp_path, monkeypatch)
+
+    # Seven days after the last bar is still answered, a minute later is not
+    assert forex.close('EURGBP', '2021-01-18 00:01:00') == 0.9011
+    assert forex.close('EURGBP', '2021-01-18 00:02:00') is None
+    assert forex.close('EURGBP', '2021-01-20 23:59:00') is None
+
+    strict, _ = cache(tmp_path / 'strict', monkeypatch, max_staleness=np.timedelta64(1, 'D'))
+
+    assert strict.close('EURGBP', '2021-01-09 21:59:00') == 0.9002
+    assert strict.close('EURGBP', '2021-01-09 22:00:00') is None
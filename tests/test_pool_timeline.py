@@ -0,0 +1,58 @@
+import numpy as np
+
+from calculations.pool_timeline import PoolTimeline
+
+UNIT = 10 ** 8
+POUND = 100
+
+
+def timelines():
+    # BTC pool changes on 1 and 3 March, ETH on 2 March only
+    return {
+        'BTC': PoolTimeline('BTC', ['2021-03-01', '2021-03-03'], [2 * UNIT, 1 * UNIT], [20000 * POUND, 10000 * POUND]),
+        'ETH': PoolTimeline('ETH', ['2021-03-02'], [10 * UNIT], [15000 * POUND])
+    }
+
+
+def holdings(timestamp):
+    df = PoolTimeline.holdings_at(timestamp, timelines())
+
+    return {i['asset']: (i['section_104_pool'], i['section_104_allowable_cost']) for _, i in df.iterrows()}
+
+
+def test_before_first_change_is_empty():
+    assert holdings('2021-02-28 23:59:59') == {'BTC': (0, 0), 'ETH': (0, 0)}
+
+
+def test_pool_is_end_of_day_from_midnight():
+    # Pools are end of day values, so the first second of a day already has that day's pool
+    assert holdings('2021-03-01 00:00:00') == {'BTC': (2, 20000), 'ETH': (0, 0)}
+    assert holdings('2021-03-01 23:59:59') == {'BTC': (2, 20000), 'ETH': (0, 0)}
+
+
+def test_pool_carries_over_days_without_changes():
+    assert holdings('2021-03-02 12:00:00') == {'BTC': (2, 20000), 'ETH': (10, 15000)}
+    assert holdings('2021-03-03 00:00:00') == {'BTC': (1, 10000), 'ETH': (10, 15000)}
+    assert holdings('2030-01-01') == {'BTC': (1, 10000), 'ETH': (10, 15000)}
+
+
+def test_average_cost():
+    pool = timelines()['ETH'].pool_at(np.datetime64('2021-03-02T08:00'))
+
+    assert pool['average_cost'] == 1500
+
+
+def test_no_timelines():
+    assert PoolTimeline.holdings_at('2021-03-01', {}).empty
+
+
+def test_from_result_keeps_days_the_pool_changed():
+    result = {
+        'day': np.array(['2021-03-01', '2021-03-02', '2021-03-03'], dtype='datetime64[D]'),
+        'section_104_pool': np.array([UNIT, UNIT, 0], dtype=np.int64),
+        'section_104_allowable_cost': np.array([100, 100, 0], dtype=np.int64)
+    }
+
+    timeline = PoolTimeline.from_result('BTC', result)
+
+    assert timeline.day.tolist() == [np.datetime64('2021-03-01').item(), np.datetime64('2021-03-03').item()]
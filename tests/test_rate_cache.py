@@ -0,0 +1,105 @@
+import os
+import json
+import numpy as np
+
+from apis.rate_cache import RateCache
+
+
+def minutes(month, count):
+    return [f'2021-{month:02d}-01 {i // 60:02d}:{i % 60:02d}:00' for i in range(count)]
+
+
+def filled(path, months, count=10):
+    """
+    Return a cache at path with count rates saved in each of months, read back by a new cache
+    """
+
+    cache = RateCache(path=str(path))
+    for month in months:
+        for i, minute in enumerate(minutes(month, count)):
+            cache.set('BTC', minute, float(month * 1000 + i), '1m')
+    cache.flush()
+
+    return RateCache(path=str(path), max_entries=count * 2)
+
+
+def test_flush_writes_partitions_and_index(tmp_path):
+    cache = RateCache(path=str(tmp_path))
+    cache.set('BTC', '2021-03-01 10:00:00', 40000.0, '1m')
+    cache.set('BTC', '2021-04-01 10:00:00', 45000.0, '1h')
+
+    # Queued writes are served before they are flushed
+    assert cache.get('BTC', '2021-03-01 10:00:00') == 40000.0
+
+    cache.flush()
+
+    with open(tmp_path / 'index.json') as j:
+        index = json.load(j)
+    assert sorted(index['BTC']) == ['2021-03', '2021-04']
+    assert index['BTC']['2021-03'] == {'first': '2021-03-01 10:00:00', 'last': '2021-03-01 10:00:00', 'count': 1}
+
+    reread = RateCache(path=str(tmp_path))
+    rates, resolutions = reread.lookup('BTC', ['2021-04-01 10:00:00', '2021-04-01 10:01:00'])
+    assert rates[0] == 45000.0 and np.isnan(rates[1])
+    assert resolutions.tolist() == ['1h', '']
+
+
+def test_flush_merges_with_saved_rates(tmp_path):
+    cache = RateCache(path=str(tmp_path))
+    cache.set('BTC', '2021-03-01 10:00:00', 1.0)
+    cache.flush()
+    cache.set('BTC', '2021-03-01 10:00:00', 2.0)
+    cache.set('BTC', '2021-03-01 10:01:00', 3.0)
+    cache.flush()
+
+    reread = RateCache(path=str(tmp_path))
+    assert reread.lookup('BTC', ['2021-03-01 10:00:00', '2021-03-01 10:01:00'])[0].tolist() == [2.0, 3.0]
+    assert reread.load_index()['BTC']['2021-03']['count'] == 2
+
+
+def test_lru_evicts_least_recently_used_partition(tmp_path):
+    cache = filled(tmp_path, [1, 2, 3])
+
+    cache.get('BTC', minutes(1, 1)[0])
+    cache.get('BTC', minutes(2, 1)[0])
+    cache.get('BTC', minutes(1, 1)[0])
+    # Holding a third month goes over max_entries, so February, used least recently, is dropped
+    cache.get('BTC', minutes(3, 1)[0])
+
+    assert list(cache.partitions) == [('BTC', '2021-01'), ('BTC', '2021-03')]
+    assert cache.size == 20
+
+    # An evicted partition is read again when needed
+    assert cache.get('BTC', minutes(2, 10)[9]) == 2009.0
+
+
+def test_missing_partition_reads_as_empty(tmp_path):
+    cache = filled(tmp_path, [1])
+    os.remove(tmp_path / 'BTC' / '2021-01.npz')
+
+    assert cache.get('BTC', minutes(1, 1)[0]) is None
+
+
+def test_per_asset_json_files_are_migrated(tmp_path):
+    with open(tmp_path / 'ETH.json', 'w') as f:
+        json.dump({'2021-03-01 10:00:00': 1500.0, '2021-05-01 10:00:00': 2500.0, '2021-05-02 10:00:00': None}, f)
+
+    cache = RateCache(path=str(tmp_path))
+
+    assert cache.get('ETH', '2021-03-01 10:00:00') == 1500.0
+    assert cache.get('ETH', '2021-05-01 10:00:00') == 2500.0
+    assert cache.get('ETH', '2021-05-02 10:00:00') is None
+    assert sorted(cache.load_index()['ETH']) == ['2021-03', '2021-05']
+    assert os.path.isfile(tmp_path / 'ETH' / '2021-05.npz')
+
+
+def test_single_legacy_file_is_migrated(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('data')
+    with open(RateCache.legacy_path, 'w') as f:
+        json.dump({'BTC': {'2021-03-01 10:00:00': 40000.0}}, f)
+
+    cache = RateCache()
+
+    assert cache.get('BTC', '2021-03-01 10:00:00') == 40000.0
+    assert os.path.isfile(os.path.join(RateCache.path, 'index.json'))
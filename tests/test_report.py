@@ -0,0 +1,51 @@
+import os
+import numpy as np
+
+from benchmarks.synthetic_portfolio import write_transactions
+from calculations.report import TaxReport
+from calculations.tax import TaxCalculations
+
+UNIT = 10 ** 8
+POUND = 100
+
+
+def test_tax_year_boundaries():
+    assert TaxReport.tax_year('2021-04-05') == 2020
+    assert TaxReport.tax_year('2021-04-05 23:59:59') == 2020
+    assert TaxReport.tax_year('2021-04-06') == 2021
+    assert TaxReport.tax_year('2022-04-05') == 2021
+    assert TaxReport.tax_year('2022-01-01') == 2021
+
+
+def test_tax_year_totals_split_on_6_april():
+    # Disposals on the last day of 2020/21 and the first of 2021/22, each at a £100 gain
+    day = np.array(['2021-01-01', '2021-04-05', '2021-04-06'], dtype='datetime64[D]')
+    result, _ = TaxCalculations.match_disposals(
+        day, np.array([10 * UNIT, 0, 0]), np.array([1000 * POUND, 0, 0]), np.array([0, UNIT, UNIT]),
+        np.array([0, 200 * POUND, 200 * POUND]))
+
+    report = TaxReport({'BTC': result})
+
+    for tax_year in [2020, 2021]:
+        totals = report.tax_year_totals(tax_year)
+        assert totals['disposals'] == 1
+        assert totals['disposal_proceeds'] == 200
+        assert totals['gains'] == 100
+
+    summary = report.sa108_summary()
+    assert summary['tax_year'].tolist() == ['2020/21', '2021/22']
+    assert summary['net_gain'].tolist() == [100, 100]
+
+
+def test_report_only_counts_assets_still_transacted(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_transactions('data/asset_transactions/BTC.csv', 200, asset='BTC')
+    write_transactions('data/asset_transactions/ETH.csv', 200, asset='ETH', seed=1)
+    TaxCalculations().tax_calculations()
+
+    os.remove('data/asset_transactions/ETH.csv')
+    tax = TaxCalculations()
+    tax.tax_calculations()
+
+    assert list(TaxReport.load(tax.checkpoints_path).assets) == ['BTC']
+    assert os.listdir(tax.asset_pools_path) == ['BTC.npz']
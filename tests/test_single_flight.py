@@ -0,0 +1,94 @@
+import time
+import threading
+import pytest
+
+from metrics import metrics
+from apis.single_flight import SingleFlight
+
+FOLLOWERS = 4
+
+
+def coalesced(name):
+    return metrics.caches.get(f'{name}_coalesced', {}).get('hits', 0)
+
+
+def fly(flights, function):
+    """
+    Call function through flights from a leader and FOLLOWERS concurrent callers, returning what each got
+    """
+
+    started = threading.Event()
+    release = threading.Event()
+    outcomes = []
+
+    def leading():
+        started.set()
+        release.wait(5)
+        return function()
+
+    def call(fn):
+        try:
+            outcomes.append(('result', flights.do('BTCGBP', fn)))
+        except Exception as e:
+            outcomes.append(('error', e))
+
+    before = coalesced(flights.name)
+
+    leader = threading.Thread(target=call, args=(leading,))
+    leader.start()
+    started.wait(5)
+
+    followers = [threading.Thread(target=call, args=(function,)) for _ in range(FOLLOWERS)]
+    for thread in followers:
+        thread.start()
+
+    # Let the leader finish once every follower has joined its flight
+    deadline = time.monotonic() + 5
+    while coalesced(flights.name) - before < FOLLOWERS and time.monotonic() < deadline:
+        time.sleep(0.001)
+    release.set()
+
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    return outcomes
+
+
+def test_concurrent_callers_share_one_call():
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return {'close': 25000.0}
+
+    flights = SingleFlight('test_shared')
+    outcomes = fly(flights, fetch)
+
+    assert len(calls) == 1
+    assert len(outcomes) == FOLLOWERS + 1
+    assert all(kind == 'result' and result is outcomes[0][1] for kind, result in outcomes)
+
+    # The key is released once the call finishes, a later caller runs it again
+    assert flights.do('BTCGBP', fetch) == {'close': 25000.0}
+    assert len(calls) == 2
+
+
+def test_leader_exception_raised_in_all_callers():
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        raise ConnectionError('binance unavailable')
+
+    flights = SingleFlight('test_failed')
+    outcomes = fly(flights, fetch)
+
+    assert len(calls) == 1
+    assert len(outcomes) == FOLLOWERS + 1
+    assert all(kind == 'error' and error is outcomes[0][1] for kind, error in outcomes)
+    assert isinstance(outcomes[0][1], ConnectionError)
+
+    # A failed call is not remembered
+    with pytest.raises(ConnectionError):
+        flights.do('BTCGBP', fetch)
+    assert len(calls) == 2
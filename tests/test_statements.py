@@ -0,0 +1,51 @@
+import os
+import time
+import pytest
+
+from apis import statements
+from apis.exchanges.binance import Binance
+from apis.statements import Statements
+
+SYMBOL = {'symbol': 'BTCGBP', 'baseAsset': 'BTC', 'quoteAsset': 'GBP'}
+
+TRADE = {'id': 123, 'time': 1614772800000, 'isBuyer': True, 'qty': '0.01', 'quoteQty': '350.5', 'price': '35050',
+         'commission': '0.00001', 'commissionAsset': 'BTC'}
+
+STATEMENT = '''Date(UTC),Pair,Side,Price,Executed,Amount,Fee
+2021-03-03 12:00:00,BTCGBP,BUY,35050,0.01BTC,350.5GBP,0.00001BTC
+2021-03-04 09:30:00,BTCGBP,SELL,36000,0.02BTC,720GBP,0.72GBP
+'''
+
+
+def no_conversion(df, cache, exchanges):
+    return df['final_asset_gbp'], df['fee_quantity'] * 0, [None] * len(df), 0, 0
+
+
+@pytest.fixture
+def utc(monkeypatch):
+    """
+    Run in UTC, Binance.create_trades_dataframes gives trade times in local time and the statement in UTC
+    """
+
+    monkeypatch.setenv('TZ', 'UTC')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_binance_trade_in_statement_and_api_is_merged_once(tmp_path, monkeypatch, utc):
+    monkeypatch.setattr(statements, 'convert_columns_to_gbp', no_conversion)
+    monkeypatch.setattr(statements.rate_cache, 'flush', lambda: None)
+
+    os.makedirs(tmp_path / 'binance')
+    (tmp_path / 'binance' / 'trade_history.csv').write_text(STATEMENT)
+
+    api_transactions = Binance.create_trades_dataframes(SYMBOL, TRADE).reset_index(drop=True)
+    merged = Statements(path=str(tmp_path)).merge('binance', api_transactions)
+
+    # The API's trade once on each side, the statement's second trade added on each side
+    assert len(merged) == 4
+    bought = merged[(merged['asset'] == 'BTC') & (merged['action'] == 'exchange_fiat_for_crypto')]
+    assert len(bought) == 1
+    assert bought['source_transaction_id'].iloc[0] == 123
@@ -0,0 +1,129 @@
+import numpy as np
+
+from benchmarks.synthetic_portfolio import generate_transactions
+from calculations.tax import TaxCalculations
+
+UNIT = 10 ** 8
+POUND = 100
+
+
+def daily(rows):
+    """
+    Return match_disposals inputs from rows of (day, acquired, cost in pounds, disposed, proceeds in pounds)
+    """
+
+    return {
+        'day': np.array([i[0] for i in rows], dtype='datetime64[D]'),
+        'acquisition_quantity': np.array([i[1] * UNIT for i in rows], dtype=np.int64),
+        'acquisition_cost': np.array([i[2] * POUND for i in rows], dtype=np.int64),
+        'disposal_quantity': np.array([i[3] * UNIT for i in rows], dtype=np.int64),
+        'disposal_proceeds': np.array([i[4] * POUND for i in rows], dtype=np.int64)
+    }
+
+
+def gain(result, i):
+    return int(result['same_day_profit_or_loss'][i] + result['thirty_day_rule_profit_or_loss'][i]
+               + result['section_104_profit_or_loss'][i]) // POUND
+
+
+def test_section_104_pool():
+    # HMRC CRYPTO22250: 100,000 tokens for £1,000 and 50,000 for £125,000, then 50,000 sold for £300,000
+    result, _ = TaxCalculations.match_disposals(**daily([
+        ('2018-01-01', 100000, 1000, 0, 0),
+        ('2018-06-01', 50000, 125000, 0, 0),
+        ('2019-01-01', 0, 0, 50000, 300000)
+    ]))
+
+    assert result['section_104_allowable_cost_used'][2] == 42000 * POUND
+    assert gain(result, 2) == 258000
+    assert result['section_104_pool'][2] == 100000 * UNIT
+    assert result['section_104_allowable_cost'][2] == 84000 * POUND
+
+
+def test_same_day_rule_before_pool():
+    # 150 sold on a day 100 were bought, the 100 are matched with that day's acquisition and 50 with the pool
+    result, _ = TaxCalculations.match_disposals(**daily([
+        ('2020-01-01', 1000, 10000, 0, 0),
+        ('2020-03-01', 100, 2000, 150, 3000)
+    ]))
+
+    assert result['same_day_quantity'][1] == 100 * UNIT
+    assert result['same_day_allowable_cost'][1] == 2000 * POUND
+    assert result['same_day_profit_or_loss'][1] == 0
+    assert result['section_104_quantity'][1] == 50 * UNIT
+    assert result['section_104_allowable_cost_used'][1] == 500 * POUND
+    assert result['section_104_profit_or_loss'][1] == 500 * POUND
+    assert result['section_104_pool'][1] == 950 * UNIT
+
+
+def test_thirty_day_rule_before_pool():
+    # 500 sold and 300 bought back 10 days later, the 300 are matched with the repurchase and 200 with the pool.
+    # A purchase more than 30 days after the disposal is not matched.
+    result, _ = TaxCalculations.match_disposals(**daily([
+        ('2020-01-01', 1000, 10000, 0, 0),
+        ('2020-03-01', 0, 0, 500, 20000),
+        ('2020-03-11', 300, 9000, 0, 0),
+        ('2020-04-15', 100, 4000, 0, 0)
+    ]))
+
+    assert result['thirty_day_rule_quantity'][1] == 300 * UNIT
+    assert result['thirty_day_rule_allowable_cost'][1] == 9000 * POUND
+    assert result['thirty_day_rule_profit_or_loss'][1] == 3000 * POUND
+    assert result['section_104_quantity'][1] == 200 * UNIT
+    assert result['section_104_profit_or_loss'][1] == 6000 * POUND
+    assert gain(result, 1) == 9000
+
+    # The repurchase never enters the pool, the later one does
+    assert result['section_104_pool'][2] == 800 * UNIT
+    assert result['section_104_allowable_cost'][2] == 8000 * POUND
+    assert result['section_104_pool'][3] == 900 * UNIT
+    assert result['section_104_allowable_cost'][3] == 12000 * POUND
+
+
+def synthetic_daily(rows=3000, seed=0):
+    return TaxCalculations.prepare_transactions(generate_transactions(rows, days=400, seed=seed))
+
+
+def checkpoint(inputs):
+    result, queue = TaxCalculations.match_disposals(**inputs)
+
+    return {**result, **queue}
+
+
+def assert_same(incremental, full):
+    for part, expected in zip(incremental, full):
+        assert part.keys() == expected.keys()
+        for k in expected:
+            np.testing.assert_array_equal(part[k], expected[k], err_msg=k)
+
+
+def test_incremental_after_appending_days():
+    inputs = synthetic_daily()
+    earlier = {k: v[:len(v) * 2 // 3] for k, v in inputs.items()}
+
+    incremental = TaxCalculations.incremental_match_disposals(inputs, checkpoint(earlier))
+
+    assert_same(incremental, TaxCalculations.match_disposals(**inputs))
+
+
+def test_incremental_after_editing_an_earlier_day():
+    inputs = synthetic_daily()
+    saved = checkpoint(inputs)
+
+    edited = {k: v.copy() for k, v in inputs.items()}
+    middle = len(edited['day']) // 2
+    edited['acquisition_quantity'][middle] += 5 * UNIT
+    edited['acquisition_cost'][middle] += 100 * POUND
+    edited['disposal_quantity'][middle + 3] += UNIT // 2
+
+    incremental = TaxCalculations.incremental_match_disposals(edited, saved)
+
+    assert_same(incremental, TaxCalculations.match_disposals(**edited))
+
+
+def test_incremental_without_changes():
+    inputs = synthetic_daily()
+
+    incremental = TaxCalculations.incremental_match_disposals(inputs, checkpoint(inputs))
+
+    assert_same(incremental, TaxCalculations.match_disposals(**inputs))